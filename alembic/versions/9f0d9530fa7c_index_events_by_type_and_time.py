@@ -0,0 +1,12 @@
+revision = '9f0d9530fa7c'
+down_revision = '8b4886759bd5'
+branch_labels = None
+depends_on = None
+
+import alembic
+
+def upgrade():
+	alembic.op.create_index("events_event_time_idx", "events", ["event", "time"])
+
+def downgrade():
+	alembic.op.drop_index("events_event_time_idx")
@@ -1,27 +1,136 @@
+import itertools
 import re
+from re import _constants as sre_constants
+from re import _parser as sre_parse
+
 from common.config import config
 from common import utils
 
+# Give up on indexing a pattern by its prefixes if it has more than this many
+MAX_PREFIXES = 64
+
+def _sequence_prefixes(parsed):
+	"""
+	Find the literal strings that a match of a parsed regex has to start with.
+
+	Returns a list of tuples `(prefix, complete)`, where `complete` is true if
+	the prefix is the entire match, or `None` if there's no way to tell.
+	"""
+	prefixes = [('', True)]
+	for op, av in parsed:
+		alternatives = _op_prefixes(op, av)
+		if alternatives is None:
+			return [(prefix, False) for prefix, complete in prefixes]
+		new_prefixes = []
+		for prefix, complete in prefixes:
+			if complete:
+				new_prefixes.extend((prefix + suffix, suffix_complete) for suffix, suffix_complete in alternatives)
+			else:
+				new_prefixes.append((prefix, False))
+		if len(new_prefixes) > MAX_PREFIXES:
+			return None
+		prefixes = new_prefixes
+	return prefixes
+
+def _op_prefixes(op, av):
+	if op is sre_constants.LITERAL:
+		return [(chr(av), True)]
+	elif op is sre_constants.IN:
+		if all(item_op is sre_constants.LITERAL for item_op, item_av in av):
+			return [(chr(item_av), True) for item_op, item_av in av]
+	elif op is sre_constants.SUBPATTERN:
+		group, add_flags, del_flags, subpattern = av
+		if not add_flags and not del_flags:
+			return _sequence_prefixes(subpattern)
+	elif op is sre_constants.BRANCH:
+		alternatives = []
+		for item in av[1]:
+			prefixes = _sequence_prefixes(item)
+			if prefixes is None:
+				return None
+			alternatives.extend(prefixes)
+		return alternatives
+	elif op is sre_constants.MAX_REPEAT or op is sre_constants.MIN_REPEAT:
+		min, max, item = av
+		prefixes = _sequence_prefixes(item)
+		if prefixes is None:
+			return None
+		if max != 1:
+			prefixes = [(prefix, False) for prefix, complete in prefixes]
+		if min == 0:
+			prefixes = [('', True)] + prefixes
+		return prefixes
+	return None
+
+def command_prefixes(pattern):
+	"""
+	Find the strings that the first word of a command has to start with for the
+	pattern to match it, case-folded. Returns `None` if the pattern could start
+	with anything.
+	"""
+	try:
+		parsed = sre_parse.parse(pattern, re.IGNORECASE)
+	except Exception:
+		return None
+	prefixes = _sequence_prefixes(parsed)
+	if prefixes is None:
+		return None
+	prefixes = {re.split(r"\s", prefix, maxsplit=1)[0].casefold() for prefix, complete in prefixes}
+	if '' in prefixes:
+		return None
+	return prefixes
+
 class CommandParser:
+	"""
+	Match chat messages against the registered command patterns.
+
+	Rather than trying every pattern against every message, each pattern is
+	indexed by the literal text its first word has to start with, so only the
+	handful of patterns that could possibly match are tried. Patterns are tried
+	in the order they were added, so if more than one matches, the oldest wins.
+	"""
 	def __init__(self, loop):
 		self.loop = loop
 
 		self.commands = {}
-		self.command_groups = {}
-		self.re_botcommand = None
+		self.index = {}
+		self.unindexed = set()
+		self.longest_prefix = 0
+		self.sequence = itertools.count()
+		self.re_prefix = re.compile(r"\s*%s\s*" % re.escape(config["commandprefix"]))
+
+	def normalise_pattern(self, pattern):
+		return pattern.replace(" ", r"(?:\s+)")
 
 	def add(self, pattern, function):
 		function = utils.wrap_as_coroutine(function)
-		pattern = pattern.replace(" ", r"(?:\s+)")
+		pattern = self.normalise_pattern(pattern)
+		if pattern in self.commands:
+			self.remove(pattern)
+		prefixes = command_prefixes(pattern)
 		self.commands[pattern] = {
-			"groups": re.compile(pattern, re.IGNORECASE).groups,
+			"re": re.compile(r"(?:%s)\s*$" % pattern, re.IGNORECASE),
 			"func": function,
+			"order": next(self.sequence),
+			"prefixes": prefixes,
 		}
-		self.re_botcommand = None
+		if prefixes is None:
+			self.unindexed.add(pattern)
+		else:
+			for prefix in prefixes:
+				self.index.setdefault(prefix, set()).add(pattern)
+				self.longest_prefix = max(self.longest_prefix, len(prefix))
 
 	def remove(self, pattern):
-		del self.commands[pattern.replace(" ", r"(?:\s+)")]
-		self.re_botcommand = None
+		pattern = self.normalise_pattern(pattern)
+		command = self.commands.pop(pattern)
+		if command["prefixes"] is None:
+			self.unindexed.discard(pattern)
+		else:
+			for prefix in command["prefixes"]:
+				self.index[prefix].discard(pattern)
+				if not self.index[prefix]:
+					del self.index[prefix]
 
 	def decorator(self, pattern):
 		def wrapper(function):
@@ -29,24 +138,26 @@ class CommandParser:
 			return function
 		return wrapper
 
-	def compile(self):
-		self.re_botcommand = r"^\s*%s\s*(?:" % re.escape(config["commandprefix"])
-		self.re_botcommand += "|".join(map(lambda re: '(%s)' % re, self.commands))
-		self.re_botcommand += r")\s*$"
-		self.re_botcommand = re.compile(self.re_botcommand, re.IGNORECASE)
-
-		i = 1
-		for val in self.commands.values():
-			self.command_groups[i] = (val["func"], i+val["groups"])
-			i += 1 + val["groups"]
+	def candidates(self, command):
+		"""
+		Get the patterns that could match the command text (ie the message without
+		the command prefix), in the order they should be tried.
+		"""
+		word = command[:self.longest_prefix].split(None, 1)[0].casefold() if command else ''
+		patterns = set(self.unindexed)
+		for i in range(1, min(len(word), self.longest_prefix) + 1):
+			patterns.update(self.index.get(word[:i], ()))
+		if len(patterns) <= 1:
+			return list(patterns)
+		return sorted(patterns, key=lambda pattern: self.commands[pattern]["order"])
 
 	def get_match(self, message):
-		if self.re_botcommand is None:
-			self.compile()
-		command_match = self.re_botcommand.match(message)
-		if command_match:
-			command = command_match.group(command_match.lastindex)
-			proc, end = self.command_groups[command_match.lastindex]
-			params = command_match.groups()[command_match.lastindex:end]
-			return proc, params
+		prefix_match = self.re_prefix.match(message)
+		if prefix_match is None:
+			return None
+		command = message[prefix_match.end():]
+		for pattern in self.candidates(command):
+			match = self.commands[pattern]["re"].match(command)
+			if match is not None:
+				return self.commands[pattern]["func"], match.groups()
 		return None
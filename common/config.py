@@ -31,6 +31,8 @@ config.setdefault('channel', 'loadingreadyrun')
 # postgres - libpg connection string
 # See https://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-CONNSTRING
 config.setdefault('postgres', 'postgresql:///lrrbot')
+# postgres_threads - number of threads for running database queries off the event loop
+config['postgres_threads'] = int(config.get('postgres_threads', 4))
 
 # reconnecttime - seconds to wait before reconnecting after a disconnect
 config['reconnecttime'] = int(config.get('reconnecttime', 15))
@@ -56,6 +58,34 @@ config.setdefault('siteurl', 'https://lrrbot.com/')
 # datafile - file to store save data to
 config.setdefault('datafile', 'data.json')
 
+# chatlog_batch_size - maximum number of chat log lines to write to the database in one INSERT
+config['chatlog_batch_size'] = int(config.get('chatlog_batch_size', 100))
+# chatlog_batch_latency - milliseconds to wait for more chat log lines before writing a partial batch
+config['chatlog_batch_latency'] = int(config.get('chatlog_batch_latency', 500))
+
+# http_connections - maximum number of open HTTP connections to any one host
+config['http_connections'] = int(config.get('http_connections', 6))
+# http_max_connections - maximum number of open HTTP connections in the shared pool, across all hosts
+config['http_max_connections'] = int(config.get('http_max_connections', 100))
+# http_host_pools - hosts that get a connection pool of their own, so they don't compete with other traffic
+# Comma-separated list of host:connections
+config['http_host_pools'] = {
+	host.strip(): int(limit)
+	for host, limit in (
+		pool.rsplit(':', 1)
+		for pool in config.get('http_host_pools', 'api.twitch.tv:16,id.twitch.tv:4,www.googleapis.com:6,hooks.slack.com:2').split(',')
+		if pool.strip()
+	)
+}
+# http_keepalive - seconds to keep idle HTTP connections open for reuse
+config['http_keepalive'] = float(config.get('http_keepalive', 30))
+# http_dns_ttl - seconds to cache DNS lookups for
+config['http_dns_ttl'] = int(config.get('http_dns_ttl', 300))
+
+# http_cache_dir - directory to keep cached HTTP responses in, so they survive restarts
+# If not set, responses are only cached in memory
+config.setdefault('http_cache_dir', None)
+
 # timezone - timezone to use for display purposes - default to Pacific Time
 config['timezone'] = pytz.timezone(config.get('timezone', 'America/Vancouver'))
 
@@ -66,6 +96,10 @@ config.setdefault('eventsocket', "/tmp/eventserver.sock")
 # eris_socket - Filename for the UDS channel that the Discord bot uses.
 config.setdefault('eris_socket', 'eris.sock')
 
+# eventserver_workers - number of event server processes to serve clients from
+# With more than one, events are passed between them with Postgres LISTEN/NOTIFY
+config['eventserver_workers'] = int(config.get('eventserver_workers', 1))
+
 # socket_port - TCP port to use when Unix domain sockets are not available.
 config['socket_port'] = int(config.get('socket_port', 49601))
 # event_port - TCP port to use when Unix domain sockets are not available.
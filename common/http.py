@@ -1,7 +1,10 @@
 import asyncio
 import atexit
+import collections
 import contextlib
-import gc
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
@@ -14,41 +17,467 @@ import aiohttp
 import dateutil.parser
 
 from common import utils
+from common.config import config
 
 log = logging.getLogger("common.http")
 
 USER_AGENT = "LRRbot/2.0 (https://lrrbot.com/)"
 
+# Number of hosts to keep connection statistics for
+HOST_STATS_SIZE = 1000
+
+class HostStats:
+	def __init__(self):
+		self.requests = 0
+		self.inflight = 0
+		self.failures = 0
+		self.redirects = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+		self.connections = 0
+		self.reused = 0
+
+	def as_dict(self):
+		return {
+			'requests': self.requests,
+			'inflight': self.inflight,
+			'failures': self.failures,
+			'redirects': self.redirects,
+			'mean_latency': self.total_latency / self.requests if self.requests else 0.0,
+			'max_latency': self.max_latency,
+			'connections': self.connections,
+			'reused': self.reused,
+		}
+
+_host_stats = collections.OrderedDict()
+def _get_host_stats(host):
+	stats = _host_stats.get(host)
+	if stats is None:
+		stats = _host_stats[host] = HostStats()
+		while len(_host_stats) > HOST_STATS_SIZE:
+			_host_stats.popitem(last=False)
+	_host_stats.move_to_end(host)
+	return stats
+
+def host_stats():
+	"""
+	Get the latency, in-flight request and connection reuse statistics for every
+	host that's been contacted recently.
+	"""
+	return {host: stats.as_dict() for host, stats in _host_stats.items()}
+
+async def _on_request_start(session, ctx, params):
+	ctx.host = params.url.host
+	ctx.start = time.monotonic()
+	stats = _get_host_stats(ctx.host)
+	stats.inflight += 1
+
+def _on_request_finish(failed):
+	async def callback(session, ctx, params):
+		stats = _get_host_stats(ctx.host)
+		latency = time.monotonic() - ctx.start
+		stats.inflight -= 1
+		stats.requests += 1
+		stats.total_latency += latency
+		stats.max_latency = max(stats.max_latency, latency)
+		if failed:
+			stats.failures += 1
+	return callback
+
+async def _on_request_redirect(session, ctx, params):
+	# aiohttp signals request_start again for every hop of a redirect, but only
+	# signals request_end/request_exception once at the very end, so close out
+	# this hop here to keep the in-flight count balanced.
+	stats = _get_host_stats(ctx.host)
+	stats.inflight -= 1
+	stats.redirects += 1
+
+async def _on_connection_create_end(session, ctx, params):
+	_get_host_stats(ctx.host).connections += 1
+
+async def _on_connection_reuseconn(session, ctx, params):
+	_get_host_stats(ctx.host).reused += 1
+
+def _trace_config():
+	trace_config = aiohttp.TraceConfig()
+	trace_config.on_request_start.append(_on_request_start)
+	trace_config.on_request_end.append(_on_request_finish(False))
+	trace_config.on_request_exception.append(_on_request_finish(True))
+	trace_config.on_request_redirect.append(_on_request_redirect)
+	trace_config.on_connection_create_end.append(_on_connection_create_end)
+	trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+	return trace_config
+
+def _new_session(pool):
+	"""
+	Create a session for a connection pool: either one of the hosts in
+	`http_host_pools`, or `None` for the pool shared by every other host.
+	"""
+	if pool is None:
+		limit, limit_per_host = config['http_max_connections'], config['http_connections']
+	else:
+		limit = limit_per_host = config['http_host_pools'][pool]
+	connector = aiohttp.TCPConnector(
+		limit=limit,
+		limit_per_host=limit_per_host,
+		keepalive_timeout=config['http_keepalive'],
+		use_dns_cache=True,
+		ttl_dns_cache=config['http_dns_ttl'],
+	)
+	return aiohttp.ClientSession(connector=connector, trace_configs=[_trace_config()])
+
+# event loop -> {pool: session}
 _http_request_sessions = {}
-async def get_http_request_session():
+async def get_http_request_session(url=None):
+	"""
+	Get the session to use for a request to `url`, on the current event loop.
+
+	Each of the hosts in `http_host_pools` has its own connection pool, so a
+	slow host elsewhere can't hold up requests to it. Every other host shares a
+	pool, with at most `http_connections` connections to any one of them.
+	"""
 	loop = asyncio.get_running_loop()
 	if loop not in _http_request_sessions:
 		# clean up any closed event loops from the cache
 		# just doing this when making new sessions, so we don't do it too much for performance
 		# but still do it often enough that the cache can't just grow forever
-		
-		# first make sure any lingering network transports have been cleaned up
-		# because apparently something in asyncio or aiohttp is leaking these things
-		gc.collect()
-		# now close down the sessions
-		to_del = [(l, s) for l, s in _http_request_sessions.items() if l.is_closed()]
-		for l, s in to_del:
-			await s.close()
+		to_del = [(l, sessions) for l, sessions in _http_request_sessions.items() if l.is_closed()]
+		for l, sessions in to_del:
+			for s in sessions.values():
+				await s.close()
 			del _http_request_sessions[l]
-		# again for good measure
-		gc.collect()
+		_http_request_sessions[loop] = {}
+	sessions = _http_request_sessions[loop]
 
-		_http_request_sessions[loop] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=6, loop=loop))
-	return _http_request_sessions[loop]
-async def _cleanup_sessions():
-	gc.collect()
-	for l, s in _http_request_sessions.items():
+	host = urllib.parse.urlsplit(url).hostname if url is not None else None
+	pool = host if host in config['http_host_pools'] else None
+	if pool not in sessions:
+		sessions[pool] = _new_session(pool)
+	return sessions[pool]
+
+async def close_http_request_sessions():
+	"""
+	Close the sessions for the current event loop. Call this before a short-lived
+	event loop (eg from `asyncio.run`) finishes, so its connections aren't left open.
+	"""
+	sessions = _http_request_sessions.pop(asyncio.get_running_loop(), {})
+	for s in sessions.values():
 		await s.close()
+
+async def _cleanup_sessions():
+	for l, sessions in _http_request_sessions.items():
+		for s in sessions.values():
+			await s.close()
 	_http_request_sessions.clear()
-	gc.collect()
 atexit.register(asyncio.run, _cleanup_sessions())
 
-async def request(url, data=None, method='GET', maxtries=3, headers=None, timeout=30, allow_redirects=True, asjson=False):
+# Priorities for rate-limited requests, lower numbers are sent first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class RateLimiter:
+	"""
+	Token bucket for an API that reports its rate limit in the response headers,
+	like Twitch's:
+	https://dev.twitch.tv/docs/api/guide/#twitch-rate-limits
+
+	Each request waits for a token before it's sent, highest priority first. The
+	bucket refills continuously, and is corrected from the `Ratelimit-Limit`,
+	`Ratelimit-Remaining` and `Ratelimit-Reset` headers of every response. A 429
+	response stops everything until the time given by `Retry-After` (or
+	`Ratelimit-Reset`).
+
+	Waiters belong to the event loop that created them, so don't share a limiter
+	between loops.
+	"""
+	def __init__(self, limit, period=60):
+		self.limit = limit
+		self.period = period
+		self.tokens = limit
+		self.updated = time.monotonic()
+		self.blocked_until = 0
+		self.inflight = 0
+		# Heap of (priority, sequence, future)
+		self.waiting = []
+		self.sequence = itertools.count()
+		self.timer = None
+
+		self.requests = 0
+		self.throttled = 0
+		# priority -> [requests, total delay, max delay]
+		self.delays = {}
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+		self.updated = now
+		return now
+
+	def _dispatch(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		now = self._refill()
+		while self.waiting:
+			priority, sequence, future = self.waiting[0]
+			if future.done():
+				# Waiter gave up
+				heapq.heappop(self.waiting)
+			elif now < self.blocked_until:
+				self.timer = future.get_loop().call_later(self.blocked_until - now, self._dispatch)
+				break
+			elif self.tokens < 1:
+				self.timer = future.get_loop().call_later((1 - self.tokens) * self.period / self.limit, self._dispatch)
+				break
+			else:
+				heapq.heappop(self.waiting)
+				self.tokens -= 1
+				future.set_result(None)
+
+	async def acquire(self, priority=PRIORITY_NORMAL):
+		"""
+		Wait until a request can be sent. Call `release` once it's done.
+		"""
+		start = time.monotonic()
+		future = asyncio.get_running_loop().create_future()
+		heapq.heappush(self.waiting, (priority, next(self.sequence), future))
+		self._dispatch()
+		await future
+		self.inflight += 1
+		self.requests += 1
+
+		delay = time.monotonic() - start
+		stats = self.delays.setdefault(priority, [0, 0.0, 0.0])
+		stats[0] += 1
+		stats[1] += delay
+		stats[2] = max(stats[2], delay)
+
+	def update(self, status, headers):
+		"""
+		Correct the bucket from the response to a request.
+		"""
+		now = self._refill()
+		try:
+			if 'Ratelimit-Limit' in headers:
+				self.limit = int(headers['Ratelimit-Limit'])
+			reset = float(headers['Ratelimit-Reset']) - time.time() if 'Ratelimit-Reset' in headers else None
+			if 'Ratelimit-Remaining' in headers:
+				# Requests still in flight haven't been counted by the server yet.
+				self.tokens = int(headers['Ratelimit-Remaining']) - (self.inflight - 1)
+			if status == 429:
+				self.throttled += 1
+				if 'Retry-After' in headers:
+					self.blocked_until = max(self.blocked_until, now + float(headers['Retry-After']))
+				elif reset is not None:
+					self.blocked_until = max(self.blocked_until, now + reset)
+				else:
+					self.blocked_until = max(self.blocked_until, now + 1)
+		except ValueError:
+			log.warning("Couldn't parse rate limit headers: %r", headers)
+
+	def release(self):
+		self.inflight -= 1
+		self._dispatch()
+
+	def stats(self):
+		return {
+			'limit': self.limit,
+			'tokens': self.tokens,
+			'waiting': len(self.waiting),
+			'inflight': self.inflight,
+			'requests': self.requests,
+			'throttled': self.throttled,
+			'delays': {
+				priority: {
+					'requests': count,
+					'mean': total / count,
+					'max': max_delay,
+				}
+				for priority, (count, total, max_delay) in self.delays.items()
+			},
+		}
+
+# Number of responses to keep in memory in a ResponseCache
+RESPONSE_CACHE_SIZE = 1000
+# Request headers that are either part of a ResponseCache key or the same on
+# every request, so responses that vary on them can still be cached
+RESPONSE_CACHE_VARY = {'authorization', 'accept-encoding', 'user-agent'}
+
+class ResponseCache:
+	"""
+	Cache of the bodies of GET requests, for `request(..., cache=...)`.
+
+	Responses are stored along with their `ETag` and `Last-Modified` validators,
+	so that the next request for the same URL can be made conditional, and a
+	`304 Not Modified` response is answered with the stored body. Responses
+	that are still fresh according to `Cache-Control: max-age` are served
+	without making a request at all. Responses marked `no-store` or `private`
+	aren't stored, and neither are responses that `Vary` on request headers
+	that aren't in the key.
+
+	The most recently used responses are kept in memory. If `directory` is set,
+	every response is also written there, so it survives restarts.
+	"""
+	def __init__(self, directory=None, size=RESPONSE_CACHE_SIZE):
+		self.directory = directory
+		self.size = size
+		self.entries = collections.OrderedDict()
+
+		self.hits = 0
+		self.revalidated = 0
+		self.misses = 0
+		self.bytes_saved = 0
+		self.time_saved = 0.0
+
+	def key(self, url, params, headers):
+		# Responses can depend on who's asking, but keys are written to disk, so
+		# only keep a hash of the credentials.
+		if isinstance(params, dict):
+			params = sorted(params.items())
+		authorization = headers.get('Authorization')
+		if authorization is not None:
+			authorization = hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+		return json.dumps([url, params, authorization], default=str)
+
+	def _filename(self, key):
+		return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None and self.directory is not None:
+			try:
+				with open(self._filename(key)) as fp:
+					entry = json.load(fp)
+			except (OSError, ValueError):
+				return None
+			if entry.get('key') != key:
+				return None
+			self._remember(key, entry)
+		if entry is not None:
+			self.entries.move_to_end(key)
+		return entry
+
+	def _remember(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	def conditional_headers(self, entry):
+		headers = {}
+		if entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+		if entry.get('last_modified'):
+			headers['If-Modified-Since'] = entry['last_modified']
+		return headers
+
+	def _expires(self, headers):
+		"""
+		Work out when a response stops being fresh. Returns `None` if it shouldn't
+		be stored at all.
+		"""
+		directives = {}
+		for directive in headers.get('Cache-Control', '').split(','):
+			name, _, value = directive.strip().partition('=')
+			directives[name.lower()] = value.strip('"')
+		if 'no-store' in directives or 'private' in directives:
+			return None
+		vary = {header.strip().lower() for header in headers.get('Vary', '').split(',') if header.strip()}
+		if not vary <= RESPONSE_CACHE_VARY:
+			return None
+		if 'no-cache' in directives:
+			return 0
+		try:
+			return time.time() + int(directives['max-age'])
+		except (KeyError, ValueError):
+			return 0
+
+	def fresh(self, entry):
+		return entry['expires'] > time.time()
+
+	def store(self, key, headers, body, elapsed):
+		expires = self._expires(headers)
+		if expires is None or (expires <= time.time() and 'ETag' not in headers and 'Last-Modified' not in headers):
+			# Nothing to gain from keeping it.
+			self.discard(key)
+			return
+		entry = {
+			'key': key,
+			'body': body,
+			'etag': headers.get('ETag'),
+			'last_modified': headers.get('Last-Modified'),
+			'expires': expires,
+			'elapsed': elapsed,
+		}
+		self._remember(key, entry)
+		self._save(key, entry)
+
+	def refresh(self, key, entry, headers, elapsed):
+		"""
+		Update an entry after a `304 Not Modified` response.
+		"""
+		self.revalidated += 1
+		self.bytes_saved += len(entry['body'].encode('utf-8'))
+		self.time_saved += max(0.0, entry['elapsed'] - elapsed)
+		expires = self._expires(headers)
+		if expires is None:
+			self.discard(key)
+			return
+		entry['expires'] = expires
+		entry['etag'] = headers.get('ETag', entry['etag'])
+		entry['last_modified'] = headers.get('Last-Modified', entry['last_modified'])
+		self._save(key, entry)
+
+	def hit(self, entry):
+		self.hits += 1
+		self.bytes_saved += len(entry['body'].encode('utf-8'))
+		self.time_saved += entry['elapsed']
+
+	def _save(self, key, entry):
+		if self.directory is None:
+			return
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			filename = self._filename(key)
+			with open(filename + '.tmp', 'w') as fp:
+				json.dump(entry, fp)
+			os.replace(filename + '.tmp', filename)
+		except OSError:
+			log.exception("Failed to save cached response for %s", key)
+
+	def discard(self, key):
+		self.entries.pop(key, None)
+		if self.directory is not None:
+			try:
+				os.unlink(self._filename(key))
+			except FileNotFoundError:
+				pass
+
+	def stats(self):
+		return {
+			'entries': len(self.entries),
+			'hits': self.hits,
+			'revalidated': self.revalidated,
+			'misses': self.misses,
+			'bytes_saved': self.bytes_saved,
+			'time_saved': self.time_saved,
+		}
+
+# Shared cache for requests that opt in to caching
+response_cache = ResponseCache(config['http_cache_dir'])
+
+async def request(url, data=None, method='GET', maxtries=3, headers=None, timeout=30, allow_redirects=True, asjson=False, ratelimit=None, priority=PRIORITY_NORMAL, cache=None):
+	"""
+	Make an HTTP request, retrying on failure.
+
+	If `ratelimit` is a `RateLimiter`, wait for it before every attempt, with the
+	given `priority`. Rate-limited responses are then retried once the limit
+	allows, rather than failing straight away.
+
+	If `cache` is a `ResponseCache` (usually `response_cache`), GET requests are
+	served from it when possible, see `ResponseCache`.
+	"""
 	if headers is None:
 		headers = {}
 	headers["User-Agent"] = USER_AGENT
@@ -65,23 +494,50 @@ async def request(url, data=None, method='GET', maxtries=3, headers=None, timeou
 			headers['Content-Type'] = "application/json"
 			data = json.dumps(data)
 
+	entry = None
+	if cache is not None and method == 'GET':
+		cache_key = cache.key(url, params, headers)
+		entry = cache.get(cache_key)
+		if entry is not None and cache.fresh(entry):
+			cache.hit(entry)
+			return entry['body']
+		if entry is None:
+			cache.misses += 1
+		else:
+			headers = dict(headers, **cache.conditional_headers(entry))
+
 	firstex = None
 	while True:
 		try:
-			async with asyncio.timeout(timeout):
-				log.debug("%s %r%s...", method, url, repr(params) if params else '')
-				session = await get_http_request_session()
-				async with session.request(method, url, params=params, data=data, headers=headers, allow_redirects=allow_redirects) as res:
-					if method == "HEAD":
-						return res
-					status_class = res.status // 100
-					if status_class != 2:
-						log.debug('%s %s failed, response body: %s', method, url, await res.read())
-						if status_class == 4:
-							maxtries = 1
-						raise urllib.error.HTTPError(res.url, res.status, res.reason, res.headers, None)
-					text = await res.text()
-					return text
+			if ratelimit is not None:
+				# Waiting for the rate limit doesn't count towards the timeout
+				await ratelimit.acquire(priority)
+			try:
+				async with asyncio.timeout(timeout):
+					log.debug("%s %r%s...", method, url, repr(params) if params else '')
+					session = await get_http_request_session(url)
+					start = time.monotonic()
+					async with session.request(method, url, params=params, data=data, headers=headers, allow_redirects=allow_redirects) as res:
+						if ratelimit is not None:
+							ratelimit.update(res.status, res.headers)
+						if method == "HEAD":
+							return res
+						if res.status == 304 and entry is not None:
+							cache.refresh(cache_key, entry, res.headers, time.monotonic() - start)
+							return entry['body']
+						status_class = res.status // 100
+						if status_class != 2:
+							log.debug('%s %s failed, response body: %s', method, url, await res.read())
+							if status_class == 4 and not (res.status == 429 and ratelimit is not None):
+								maxtries = 1
+							raise urllib.error.HTTPError(res.url, res.status, res.reason, res.headers, None)
+						text = await res.text()
+						if cache is not None and method == 'GET':
+							cache.store(cache_key, res.headers, text, time.monotonic() - start)
+						return text
+			finally:
+				if ratelimit is not None:
+					ratelimit.release()
 		except utils.PASSTHROUGH_EXCEPTIONS:
 			raise
 		except Exception as e:
@@ -51,7 +51,7 @@ async def get_token(engine, metadata, patreon_id):
 async def get_campaigns(token, include=["creator", "goals", "rewards"]):
 	data = {"include": ",".join(include)}
 	headers = {"Authorization": "Bearer %s" % token}
-	data = await http.request("https://api.patreon.com/oauth2/api/current_user/campaigns", data=data, headers=headers)
+	data = await http.request("https://api.patreon.com/oauth2/api/current_user/campaigns", data=data, headers=headers, cache=http.response_cache)
 	return json.loads(data)
 
 async def current_user(token):
@@ -1,10 +1,29 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
 import warnings
+import weakref
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.exc
 
 from common.config import config
 
+log = logging.getLogger("common.postgres")
+
+# Queries that block an event loop for longer than this many seconds get logged
+SLOW_BLOCKING_QUERY = 0.1
+
+# Statistics about queries that ran directly on an event loop, rather than via `run`
+blocking_stats = {
+	"count": 0,
+	"total_time": 0.0,
+	"max_time": 0.0,
+}
+
 def new_engine_and_metadata():
 	"""
 	Create new SQLAlchemy engine and metadata.
@@ -12,6 +31,9 @@ def new_engine_and_metadata():
 	NOTE: Every process should have AT MOST one engine.
 	"""
 	engine = sqlalchemy.create_engine(config["postgres"], echo=config["debugsql"], execution_options={"autocommit": False}, pool_pre_ping=True)
+	sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+	sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+	sqlalchemy.event.listen(engine, "handle_error", _handle_error)
 	metadata = sqlalchemy.MetaData()
 	with warnings.catch_warnings():
 		# Yes, I know you can't understand FTS indexes.
@@ -40,3 +62,151 @@ def set_engine_and_metadata(engine, metadata):
 
 def escape_like(s):
 	return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	if context is not None:
+		context._query_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	_record_blocking(context, statement)
+
+def _handle_error(exception_context):
+	# Failed queries don't get an after_cursor_execute, but may still have blocked.
+	_record_blocking(exception_context.execution_context, exception_context.statement)
+
+def _record_blocking(context, statement):
+	start = getattr(context, "_query_start", None)
+	if start is None:
+		return
+	del context._query_start
+	duration = time.perf_counter() - start
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		# Not on an event loop thread, so not blocking anything.
+		return
+	blocking_stats["count"] += 1
+	blocking_stats["total_time"] += duration
+	blocking_stats["max_time"] = max(blocking_stats["max_time"], duration)
+	if duration >= SLOW_BLOCKING_QUERY:
+		log.warning("Query blocked the event loop for %.0fms: %s", duration * 1000, statement)
+
+_executor = None
+def get_executor():
+	"""
+	Return the thread pool that database work is run in, creating it if needed.
+
+	Keep `postgres_threads` below the engine's pool size, so work that's been
+	handed off doesn't sit on a thread waiting for a connection.
+	"""
+	global _executor
+	if _executor is None:
+		_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config["postgres_threads"], thread_name_prefix="postgres")
+	return _executor
+
+async def run(func, *args, **kwargs):
+	"""
+	Call `func(*args, **kwargs)`, which does blocking database work, in the
+	database thread pool, so that slow queries don't hold up the event loop.
+
+	Usage:
+	def get_thing(engine, metadata, thing_id):
+		with engine.connect() as conn:
+			return conn.execute(...).first()
+	row = await postgres.run(get_thing, engine, metadata, thing_id)
+
+	`func` must not touch anything that isn't thread-safe, in particular it
+	shouldn't call into the event loop or mutate state shared with coroutines.
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+def after_fork():
+	"""
+	Stop using the database connections and threads inherited from the parent
+	process, in a process that's been forked from one that was already using the
+	database. The parent is still using them, so they're left open.
+	"""
+	global _executor
+	if _engine_and_metadata is not None:
+		_engine_and_metadata[0].dispose(close=False)
+	# The pool's threads didn't survive the fork
+	_executor = None
+	for listener in list(_listeners):
+		listener.forget()
+
+# Seconds to wait before trying to listen again after a failure
+LISTEN_RETRY_INTERVAL = 60
+
+_listeners = weakref.WeakSet()
+
+class Listener:
+	"""
+	Dedicated connection that LISTENs on a notification channel, for keeping
+	in-process caches in sync with other processes.
+
+	`poll` never blocks, so it's cheap enough to call before every cache read.
+	"""
+	def __init__(self, channel):
+		self.channel = channel
+		self.conn = None
+		self.retry_at = 0
+		_listeners.add(self)
+
+	def _listen(self, engine):
+		conn = engine.raw_connection()
+		# Take the connection out of the pool, it's going to be busy listening forever.
+		conn.detach()
+		conn = conn.driver_connection
+		conn.autocommit = True
+		with conn.cursor() as cur:
+			cur.execute("LISTEN %s" % self.channel)
+		return conn
+
+	def forget(self):
+		"""
+		Stop using the connection without closing it, see `after_fork`.
+		"""
+		self.conn = None
+		self.retry_at = 0
+
+	def _drop(self):
+		try:
+			self.conn.close()
+		except Exception:
+			pass
+		self.conn = None
+
+	def poll(self, engine):
+		"""
+		Get the payloads of any notifications that have arrived since the last call.
+
+		Returns `None` if the connection isn't listening, in which case
+		notifications may have been missed, so anything cached should be dropped.
+		"""
+		if self.conn is None:
+			if time.time() < self.retry_at:
+				return None
+			try:
+				self.conn = self._listen(engine)
+			except Exception:
+				log.exception("Failed to listen on %s", self.channel)
+				self.retry_at = time.time() + LISTEN_RETRY_INTERVAL
+				return None
+			# Notifications sent before now were missed
+			return None
+		try:
+			self.conn.poll()
+		except Exception:
+			log.exception("Lost connection listening on %s", self.channel)
+			self._drop()
+			return None
+		payloads = [notify.payload for notify in self.conn.notifies]
+		self.conn.notifies.clear()
+		return payloads
+
+	def notify(self, conn, payload):
+		"""
+		Send a notification on the channel when `conn` commits.
+		"""
+		conn.execute(sqlalchemy.select(sqlalchemy.func.pg_notify(self.channel, payload)))
@@ -1,5 +1,12 @@
 import confusables
 import re
+try:
+	from re import _constants as sre_constants
+	from re import _parser as sre_parse
+except ImportError:
+	# These are private, so may not be there in every version of Python. Without
+	# them, every rule is checked individually.
+	sre_constants = sre_parse = None
 
 def compile_rule(rule):
 	pattern_type = rule.get('pattern_type', 'regex')
@@ -11,3 +18,128 @@ def compile_rule(rule):
 		return re.compile(rule['re'])
 	else:
 		raise NotImplementedError(f"pattern of type {pattern_type}")
+
+# Shortest literal worth using to prefilter messages
+MIN_LITERAL_LENGTH = 3
+
+def _literal_runs(parsed):
+	run = []
+	for op, av in parsed:
+		if op is sre_constants.LITERAL:
+			run.append(chr(av))
+			continue
+		if run:
+			yield ''.join(run)
+			run = []
+		if op is sre_constants.SUBPATTERN:
+			group, add_flags, del_flags, subpattern = av
+			if not add_flags & re.IGNORECASE:
+				yield from _literal_runs(subpattern)
+	if run:
+		yield ''.join(run)
+
+def required_literal(pattern):
+	"""
+	Find a string that has to appear in any text the compiled pattern matches.
+	Returns `None` if there isn't a useful one.
+	"""
+	if sre_parse is None or pattern.flags & re.IGNORECASE:
+		return None
+	try:
+		parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+		literal = max(_literal_runs(parsed), key=len, default='')
+	except Exception:
+		# The parser's internals have changed from what we expect
+		return None
+	if len(literal) < MIN_LITERAL_LENGTH:
+		return None
+	return literal
+
+def _trie_regex(literals):
+	"""
+	Build a regex that finds every position where any of the literals appears,
+	capturing the shortest one that starts there. It's structured as a trie, so
+	the work at each position doesn't depend on how many literals there are.
+	"""
+	trie = {}
+	for literal in literals:
+		node = trie
+		for char in literal:
+			node = node.setdefault(char, {})
+		node[''] = None
+
+	def build(node):
+		if '' in node:
+			# Any longer literals with this one as a prefix are redundant.
+			return ''
+		alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+		if len(alternatives) == 1:
+			return alternatives[0]
+		else:
+			return '(?:%s)' % '|'.join(alternatives)
+	# In a lookahead, so overlapping literals are all found
+	return re.compile('(?=(%s))' % build(trie))
+
+class RuleSet:
+	"""
+	A list of spam rules, compiled so that most messages can be cleared against
+	all of them in one pass.
+
+	Most rules have some literal text that every match has to contain. Those
+	literals are combined into one trie-shaped regex, which is used as a
+	prefilter: the vast majority of messages don't contain any of them, and
+	that's the end of it. Otherwise only the rules whose literal the prefilter
+	found are checked individually. Rules without a usable
+	literal (eg confusables, or case-insensitive rules) are always checked
+	individually. Either way the rules are checked in order, so the first rule in
+	the list that matches still wins.
+
+	`rules` is a list of dicts in the usual format, ie with `re`, `message`,
+	and optionally `type` and `pattern_type` keys.
+	"""
+	def __init__(self, rules):
+		self.rules = [dict(rule, pattern=compile_rule(rule)) for rule in rules]
+		self.literals = []
+		self.standalone = []
+		for i, rule in enumerate(self.rules):
+			literal = required_literal(rule['pattern'])
+			if literal is None:
+				self.standalone.append(i)
+			else:
+				self.literals.append((literal, i))
+		if self.literals:
+			self.prefilter = _trie_regex(literal for literal, i in self.literals)
+			# The prefilter only reports the shortest literal at each position, so
+			# group the rules by the shortest literal that's a prefix of theirs.
+			self.by_prefix = {}
+			prefixes = sorted({literal for literal, i in self.literals}, key=len)
+			for literal, i in self.literals:
+				prefix = next(prefix for prefix in prefixes if literal.startswith(prefix))
+				self.by_prefix.setdefault(prefix, []).append((literal, i))
+		else:
+			self.prefilter = None
+
+	def __len__(self):
+		return len(self.rules)
+
+	def search(self, message):
+		"""
+		Find the first rule that matches the message. Returns a tuple of the rule
+		and the match object, or `None` if no rules match.
+		"""
+		candidates = self.standalone
+		if self.prefilter is not None:
+			found = {match.group(1) for match in self.prefilter.finditer(message)}
+			if found:
+				candidates = sorted(candidates + [
+					i
+					for prefix in found
+					for literal, i in self.by_prefix[prefix]
+					if literal in message
+				])
+		for i in candidates:
+			rule = self.rules[i]
+			match = rule['pattern'].search(message)
+			if match is not None:
+				return rule, match
+		return None
@@ -1,17 +1,79 @@
+import copy
+import json
+import os
+
 import sqlalchemy
 from sqlalchemy.dialects.postgresql import insert
 
 from common import postgres
 
+# Postgres notification channel that gets the key of every changed value
+NOTIFY_CHANNEL = "lrrbot_state"
+
+_MISSING = object()
+
+class _Cache:
+	"""
+	Write-through cache of the `state` table.
+
+	Every write sends a notification on `NOTIFY_CHANNEL` with the key that
+	changed, and every read first drains any notifications that have arrived on
+	a dedicated LISTEN connection, so a value that hasn't changed costs a
+	dictionary lookup and a non-blocking socket read rather than a query.
+
+	If the LISTEN connection can't be set up or drops out, everything is
+	uncached until it's reestablished, as notifications may have been missed.
+	"""
+	def __init__(self):
+		self.values = {}
+		self.listener = postgres.Listener(NOTIFY_CHANNEL)
+
+	def poll(self, engine):
+		"""
+		Process any pending invalidations. Returns whether the cache can be used.
+		"""
+		payloads = self.listener.poll(engine)
+		if payloads is None:
+			self.values.clear()
+			return False
+		for payload in payloads:
+			try:
+				payload = json.loads(payload)
+			except ValueError:
+				self.values.clear()
+				continue
+			if payload['pid'] != os.getpid():
+				self.values.pop(payload['key'], None)
+		return True
+
+	def notify(self, conn, key):
+		"""
+		Tell other processes that `key` has changed, when `conn` commits.
+		"""
+		self.listener.notify(conn, json.dumps({
+			'pid': os.getpid(),
+			'key': key,
+		}))
+
+_cache = _Cache()
+
 def get(engine, metadata, key, default=None):
-	state = metadata.tables['state']
-	with engine.connect() as conn:
-		row = conn.execute(sqlalchemy.select(state.c.value)
-			.where(state.c.key == key)) \
-			.first()
-	if row is not None:
-		return row[0]
-	return default
+	cached = _cache.poll(engine)
+	if cached and key in _cache.values:
+		value = _cache.values[key]
+	else:
+		state = metadata.tables['state']
+		with engine.connect() as conn:
+			row = conn.execute(sqlalchemy.select(state.c.value)
+				.where(state.c.key == key)) \
+				.first()
+		value = row[0] if row is not None else _MISSING
+		if cached:
+			_cache.values[key] = value
+	if value is _MISSING:
+		return default
+	# Don't let callers modify the cached copy
+	return copy.deepcopy(value)
 
 def set(engine, metadata, key, value):
 	state = metadata.tables['state']
@@ -27,17 +89,25 @@ def set(engine, metadata, key, value):
 			'key': key,
 			'value': value,
 		})
+		_cache.notify(conn, key)
 		conn.commit()
+	_cache.values[key] = copy.deepcopy(value)
 
 def delete(engine, metadata, key):
 	state = metadata.tables['state']
 	with engine.connect() as conn:
 		conn.execute(state.delete().where(state.c.key == key))
+		_cache.notify(conn, key)
+		conn.commit()
+	_cache.values[key] = _MISSING
 
 class Property:
 	"""
 	Higher level interface over `state.get` and `state.set` using the descriptor protocol.
 
+	Reads are served from the process-wide state cache, so they're cheap enough
+	to use on every chat message.
+
 	## Example:
 	```python
 	class LRRbot:
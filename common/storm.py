@@ -1,8 +1,12 @@
 import datetime
+import logging
 import sqlalchemy
 from sqlalchemy.dialects.postgresql import insert
 
 from common.config import config
+from common import utils
+
+log = logging.getLogger('common.storm')
 
 # All storm counters
 COUNTERS = [
@@ -66,3 +70,102 @@ def get_combined(engine, metadata):
 			if row is not None:
 				combined_count += row[0]
 	return combined_count
+
+FLUSH_INTERVAL = 5
+
+def today():
+	return datetime.datetime.now(config['timezone']).date()
+
+class StormCounter:
+	"""
+	Today's storm counts, kept in memory.
+
+	Increments are applied to the in-memory counts straight away, and written to
+	the database in one batch every `FLUSH_INTERVAL` seconds, and when the day
+	rolls over. The writes add to whatever is in the database, rather than
+	overwriting it, so increments from other processes (eg Patreon pledges from
+	the website) aren't lost, and each flush reloads the counts so they're picked
+	up here too.
+	"""
+	def __init__(self, engine, metadata):
+		self.engine = engine
+		self.metadata = metadata
+		self.date = None
+		self.counts = {}
+		# date -> {counter: increment}
+		self.pending = {}
+
+	def _flush(self):
+		storm = self.metadata.tables['storm']
+		date = today()
+		pending, self.pending = self.pending, {}
+		try:
+			row = None
+			with self.engine.connect() as conn:
+				for pending_date, increments in pending.items():
+					query = insert(storm).returning(*(storm.c[counter] for counter in COUNTERS))
+					query = query.on_conflict_do_update(
+						index_elements=[storm.c.date],
+						set_={
+							counter: storm.c[counter] + query.excluded[counter]
+							for counter in increments
+						}
+					)
+					result = conn.execute(query, dict(increments, date=pending_date)).first()
+					if pending_date == date:
+						row = result
+				if row is None:
+					row = conn.execute(sqlalchemy.select(*(storm.c[counter] for counter in COUNTERS))
+						.where(storm.c.date == date)).first()
+				conn.commit()
+		except Exception:
+			# Put the increments back, merging in any that came in in the meantime.
+			for pending_date, increments in pending.items():
+				for counter, by in increments.items():
+					self.pending.setdefault(pending_date, {}).setdefault(counter, 0)
+					self.pending[pending_date][counter] += by
+			raise
+		self.date = date
+		if row is not None:
+			self.counts = dict(zip(COUNTERS, row))
+		else:
+			self.counts = {counter: 0 for counter in COUNTERS}
+
+	@utils.swallow_errors
+	def flush(self):
+		"""
+		Write any pending increments to the database, and reload the counts.
+		"""
+		self._flush()
+
+	def _check_date(self):
+		date = today()
+		if self.date != date:
+			try:
+				self._flush()
+			except Exception:
+				log.exception("Failed to reload storm counts")
+				# Carry on from the in-memory counts, starting the new day at zero, so
+				# increments still get counted and kept in `pending`. The next
+				# successful flush will write them and reload the real counts.
+				self.date = date
+				self.counts = {counter: 0 for counter in COUNTERS}
+
+	def increment(self, counter, by=1):
+		self._check_date()
+		self.counts[counter] += by
+		increments = self.pending.setdefault(self.date, {})
+		increments[counter] = increments.get(counter, 0) + by
+		return self.counts[counter]
+
+	def get(self, counter):
+		self._check_date()
+		return self.counts[counter]
+
+	def get_all(self):
+		self._check_date()
+		return dict(self.counts)
+
+	def get_combined(self):
+		self._check_date()
+		return sum(self.counts[counter] for counter in COMBINED_COUNTERS)
@@ -1,7 +1,10 @@
+import asyncio
 import json
 import sqlalchemy
 from sqlalchemy.dialects.postgresql import insert
 import collections
+import time
+import weakref
 
 import common.http
 from common import utils
@@ -11,7 +14,250 @@ from common.account_providers import ACCOUNT_PROVIDER_TWITCH
 
 GAME_CHECK_INTERVAL = 5*60
 
+# Size of the Helix rate limit bucket, until Twitch says otherwise
+HELIX_RATE_LIMIT = 800
+
+# event loop -> {Authorization header: RateLimiter}
+_helix_limiters = weakref.WeakKeyDictionary()
+
+def helix_ratelimit(headers):
+	"""
+	Get the rate limiter for Helix requests made with these headers. Twitch has a
+	separate bucket for each token.
+	"""
+	limiters = _helix_limiters.setdefault(asyncio.get_running_loop(), {})
+	key = headers.get('Authorization') if headers else None
+	if key not in limiters:
+		limiters[key] = common.http.RateLimiter(HELIX_RATE_LIMIT)
+	return limiters[key]
+
+async def helix_request(url, data=None, method='GET', headers=None, priority=common.http.PRIORITY_NORMAL, **kwargs):
+	"""
+	Make a request to the Helix API, waiting for the rate limit as necessary.
+
+	Moderation actions should use `PRIORITY_HIGH`, and bulk lookups that can
+	wait should use `PRIORITY_LOW`.
+	"""
+	return await common.http.request(url, data=data, method=method, headers=headers,
+		ratelimit=helix_ratelimit(headers), priority=priority, **kwargs)
+
+def helix_stats():
+	"""
+	Get the statistics for the Helix rate limiters on the current event loop,
+	including how long requests have been queued for.
+	"""
+	limiters = _helix_limiters.get(asyncio.get_running_loop(), {})
+	return [limiter.stats() for limiter in limiters.values()]
+
 User = collections.namedtuple('User', ['id', 'name', 'display_name', 'token'])
+
+# Postgres notification channel that gets the ID of every Twitch account whose
+# name or token has changed
+USERS_NOTIFY_CHANNEL = "lrrbot_twitch_users"
+# Read cached users from the database again after this many seconds, in case a
+# change was made without a notification
+USER_CACHE_EXPIRY = 10*60
+
+class _UserCache:
+	"""
+	Cache of the Twitch accounts looked up by `get_user`, keyed by both ID and
+	login name.
+
+	Anything that changes an account's name or token should call
+	`invalidate_user`, which tells every process to drop its copy. If the LISTEN
+	connection isn't available, nothing is cached.
+	"""
+	def __init__(self):
+		self.by_id = {}
+		self.by_name = {}
+		self.listener = postgres.Listener(USERS_NOTIFY_CHANNEL)
+
+		self.lookups = 0
+		self.lookups_saved = 0
+		self.invalidations = 0
+
+	def poll(self, engine):
+		"""
+		Process any pending invalidations. Returns whether the cache can be used.
+		"""
+		payloads = self.listener.poll(engine)
+		if payloads is None:
+			self.clear()
+			return False
+		for payload in payloads:
+			if payload:
+				self.discard(payload)
+			else:
+				self.clear()
+		return True
+
+	def get(self, engine, id=None, name=None):
+		self.lookups += 1
+		if not self.poll(engine):
+			return None
+		if id is not None:
+			entry = self.by_id.get(str(id))
+		else:
+			entry = self.by_name.get(name)
+		if entry is None:
+			return None
+		expires, user = entry
+		if expires < time.monotonic():
+			self.discard(user.id)
+			return None
+		self.lookups_saved += 1
+		return user
+
+	def store(self, user):
+		self.discard(user.id)
+		entry = (time.monotonic() + USER_CACHE_EXPIRY, user)
+		self.by_id[str(user.id)] = entry
+		self.by_name[user.name] = entry
+
+	def discard(self, id):
+		entry = self.by_id.pop(str(id), None)
+		if entry is not None:
+			self.invalidations += 1
+			if self.by_name.get(entry[1].name) is entry:
+				del self.by_name[entry[1].name]
+
+	def clear(self):
+		self.by_id.clear()
+		self.by_name.clear()
+
+	def stats(self):
+		return {
+			'entries': len(self.by_id),
+			'lookups': self.lookups,
+			'lookups_saved': self.lookups_saved,
+			'invalidations': self.invalidations,
+		}
+
+_user_cache = _UserCache()
+
+def invalidate_user(conn, id):
+	"""
+	Drop the cached details for a Twitch account in every process, when `conn`
+	commits. Call this whenever an account's name or token is changed.
+	"""
+	_user_cache.discard(id)
+	_user_cache.listener.notify(conn, str(id))
+
+def user_cache_stats():
+	"""
+	Get the statistics for the `get_user` cache, including how many database
+	lookups it saved, and how many Helix requests were made for the users that
+	weren't in the database.
+	"""
+	return dict(_user_cache.stats(), helix=_user_batcher.stats())
+
+# Wait this many seconds for more lookups to send in the same Helix request
+USER_BATCH_DELAY = 0.005
+# Most users that can be looked up in one Helix request
+USER_BATCH_SIZE = 100
+
+class _UserBatcher:
+	"""
+	Coalesce lookups of users that aren't in the database into as few Helix
+	requests as possible.
+
+	Lookups are collected for `delay` seconds (or until there are `size` of
+	them) and then sent as a single request to `/helix/users`, and the users
+	that came back are written to the database in one go.
+	"""
+	def __init__(self, delay=USER_BATCH_DELAY, size=USER_BATCH_SIZE):
+		self.delay = delay
+		self.size = size
+		# event loop -> {('id' or 'login', value): future}
+		self.pending = weakref.WeakKeyDictionary()
+
+		self.lookups = 0
+		self.coalesced = 0
+		self.requests = 0
+
+	async def fetch(self, id=None, name=None):
+		"""
+		Look up a user on Twitch by either id or name. Returns the user object from
+		Helix, or `None` if there's no such user.
+		"""
+		loop = asyncio.get_running_loop()
+		key = ('id', str(id)) if id is not None else ('login', name.lower())
+		self.lookups += 1
+		pending = self.pending.setdefault(loop, {})
+		future = pending.get(key)
+		if future is None:
+			future = pending[key] = loop.create_future()
+			if len(pending) >= self.size:
+				self.send(loop)
+			elif len(pending) == 1:
+				loop.call_later(self.delay, self.send, loop)
+		else:
+			self.coalesced += 1
+		# Shield the lookup, so that one waiter giving up doesn't cancel it for everyone.
+		return await asyncio.shield(future)
+
+	def send(self, loop):
+		pending = self.pending.pop(loop, None)
+		if pending:
+			asyncio.ensure_future(self._request(pending)).add_done_callback(utils.check_exception)
+
+	async def _request(self, pending):
+		self.requests += 1
+		try:
+			headers = {
+				'Client-ID': config['twitch_clientid'],
+				'Authorization': f"Bearer {await get_token()}",
+			}
+			res = await helix_request("https://api.twitch.tv/helix/users", data=list(pending), headers=headers)
+			users = json.loads(res)['data']
+
+			if users:
+				engine, metadata = postgres.get_engine_and_metadata()
+				accounts = metadata.tables["accounts"]
+				with engine.connect() as conn:
+					insert_query = insert(accounts)
+					insert_query = insert_query.on_conflict_do_update(
+						index_elements=[accounts.c.provider, accounts.c.provider_user_id],
+						set_={
+							'name': insert_query.excluded.name,
+							'display_name': insert_query.excluded.display_name,
+						},
+					)
+					conn.execute(insert_query, [{
+						"provider": ACCOUNT_PROVIDER_TWITCH,
+						"provider_user_id": user["id"],
+						"name": user["login"],
+						"display_name": user["display_name"],
+					} for user in users])
+					# The accounts might already have existed under different names.
+					for user in users:
+						invalidate_user(conn, user["id"])
+					conn.commit()
+		except utils.PASSTHROUGH_EXCEPTIONS:
+			raise
+		except Exception as e:
+			for future in pending.values():
+				if not future.done():
+					future.set_exception(e)
+			return
+
+		found = {}
+		for user in users:
+			found[('id', user['id'])] = user
+			found[('login', user['login'])] = user
+		for key, future in pending.items():
+			if not future.done():
+				future.set_result(found.get(key))
+
+	def stats(self):
+		return {
+			'lookups': self.lookups,
+			'coalesced': self.coalesced,
+			'requests': self.requests,
+		}
+
+_user_batcher = _UserBatcher()
+
 async def get_user(id=None, name=None, get_missing=True):
 	"""
 	Get the details for a given user, specified by either name or id.
@@ -19,52 +265,39 @@ async def get_user(id=None, name=None, get_missing=True):
 	Returns a named tuple of (id, name, display_name, token)
 
 	If get_missing is true, get the details for this user from Twitch if the user
-	is not already in the database. Otherwise, if the user isn't in the database,
-	this returns None.
+	is not already in the database. Concurrent lookups are sent to Twitch
+	together, see `_UserBatcher`. If the user isn't in the database (or on
+	Twitch), this returns None.
+
+	Users that are found are cached, see `invalidate_user`.
 
 	https://dev.twitch.tv/docs/api/reference#get-users
 	"""
+	if id is None and name is None:
+		raise ValueError("Pass at least one of name or id")
 	engine, metadata = postgres.get_engine_and_metadata()
+	user = _user_cache.get(engine, id=id, name=name)
+	if user is not None:
+		return user
+
 	accounts = metadata.tables["accounts"]
 	with engine.connect() as conn:
 		query = sqlalchemy.select(accounts.c.provider_user_id, accounts.c.name, accounts.c.display_name, accounts.c.access_token) \
 			.where(accounts.c.provider == ACCOUNT_PROVIDER_TWITCH)
 		if id is not None:
 			query = query.where(accounts.c.provider_user_id == id)
-			data = {'id': id}
-		elif name is not None:
-			query = query.where(accounts.c.name == name)
-			data = {'login': name}
 		else:
-			raise ValueError("Pass at least one of name or id")
+			query = query.where(accounts.c.name == name)
 
 		row = conn.execute(query).first()
 		if row:
-			return User(*row)
-
-		if get_missing:
-			headers = {
-				'Client-ID': config['twitch_clientid'],
-				'Authorization': f"Bearer {await get_token()}",
-			}
-			res = await common.http.request("https://api.twitch.tv/helix/users", data=data, headers=headers)
-			user = json.loads(res)['data'][0]
-			insert_query = insert(accounts)
-			insert_query = insert_query.on_conflict_do_update(
-				index_elements=[accounts.c.provider, accounts.c.provider_user_id],
-				set_={
-					'name': insert_query.excluded.name,
-					'display_name': insert_query.excluded.display_name,
-				},
-			)
-			conn.execute(insert_query, {
-				"provider": ACCOUNT_PROVIDER_TWITCH,
-				"provider_user_id": user["id"],
-				"name": user["login"],
-				"display_name": user["display_name"],
-			})
-			conn.commit()
+			user = User(*row)
+			_user_cache.store(user)
+			return user
 
+	if get_missing:
+		user = await _user_batcher.fetch(id=id, name=name)
+		if user is not None:
 			return User(user["id"], user["login"], user['display_name'], None)
 
 async def get_token(id=None, name=None):
@@ -90,8 +323,10 @@ class get_paginated:
 	Optionally can provide a limit to stop the process before the end of the list.
 	The returned list may be longer than limit, but once the limit is reached, no
 	further pages will be requested.
+
+	Pages are requested with a low priority, see `helix_request`.
 	"""
-	def __init__(self, url, attr="data", data=None, headers=None, limit=None, per_page=None):
+	def __init__(self, url, attr="data", data=None, headers=None, limit=None, per_page=None, priority=common.http.PRIORITY_LOW):
 		self.url = url
 		self.attr = attr
 		if data:
@@ -102,6 +337,7 @@ class get_paginated:
 			self.data['first'] = per_page
 		self.headers = headers
 		self.limit = limit
+		self.priority = priority
 
 		self.count = 0
 		self.cursor = True
@@ -121,7 +357,7 @@ class get_paginated:
 			if self.limit is not None and self.count > self.limit:
 				raise StopAsyncIteration
 
-			res = await common.http.request(self.url, data=self.data, headers=self.headers)
+			res = await helix_request(self.url, data=self.data, headers=self.headers, priority=self.priority)
 			res = json.loads(res)
 			self.buffer = res[self.attr]
 			self.cursor = self.data['after'] = res.get('pagination', {}).get('cursor')
@@ -147,12 +383,12 @@ async def get_info_uncached(username=None, use_fallback=True):
 		'Client-ID': config['twitch_clientid'],
 		'Authorization': f"Bearer {await get_token()}",
 	}
-	res = await common.http.request("https://api.twitch.tv/helix/users", {"id": userid}, headers=headers)
+	res = await helix_request("https://api.twitch.tv/helix/users", {"id": userid}, headers=headers)
 	user_data = json.loads(res)['data'][0]
 
 	# Attempt to get the channel data from /streams
 	# If this succeeds, it means the channel is currently live
-	res = await common.http.request("https://api.twitch.tv/helix/streams", {"user_id": userid}, headers=headers)
+	res = await helix_request("https://api.twitch.tv/helix/streams", {"user_id": userid}, headers=headers)
 	data = json.loads(res)['data']
 	channel_data = data and data[0]
 	if channel_data:
@@ -165,7 +401,7 @@ async def get_info_uncached(username=None, use_fallback=True):
 
 	# If that failed, it means the channel is offline
 	# Ge the channel data from here instead
-	res = await common.http.request("https://api.twitch.tv/helix/channels", {"broadcaster_id": userid}, headers=headers)
+	res = await helix_request("https://api.twitch.tv/helix/channels", {"broadcaster_id": userid}, headers=headers)
 	channel_data = json.loads(res)['data'][0]
 	user_data.update(channel_data)
 	user_data['live'] = False
@@ -205,7 +441,7 @@ async def get_game(id=None, name=None, get_missing=True):
 				'Client-ID': config['twitch_clientid'],
 				'Authorization': f"Bearer {await get_token()}",
 			}
-			res = await common.http.request("https://api.twitch.tv/helix/games", data=data, headers=headers)
+			res = await helix_request("https://api.twitch.tv/helix/games", data=data, headers=headers)
 			game = json.loads(res)['data'][0]
 			insert_query = insert(games)
 			insert_query = insert_query.on_conflict_do_update(
@@ -267,7 +503,7 @@ async def get_video(videoid):
 		'Client-ID': config['twitch_clientid'],
 		'Authorization': f"Bearer {await get_token()}",
 	}
-	data = await common.http.request("https://api.twitch.tv/helix/videos", {"id": videoid.lstrip('v')}, headers=headers)
+	data = await helix_request("https://api.twitch.tv/helix/videos", {"id": videoid.lstrip('v')}, headers=headers)
 	return json.loads(data)["data"][0]
 
 async def get_videos(channel=None, limit=10, broadcasts=False):
@@ -282,7 +518,7 @@ async def get_videos(channel=None, limit=10, broadcasts=False):
 		'Client-ID': config['twitch_clientid'],
 		'Authorization': f"Bearer {await get_token()}",
 	}
-	data = await common.http.request("https://api.twitch.tv/helix/videos", headers=headers, data={
+	data = await helix_request("https://api.twitch.tv/helix/videos", headers=headers, data={
 		"user_id": channelid,
 		"first": str(limit),
 		"sort": "time",
@@ -333,7 +569,7 @@ async def ban_user(channel_id, user_id, reason=None, duration=None):
 	if duration is not None:
 		data["duration"] = duration
 
-	data = await common.http.request(url, method="POST", headers=headers, data={"data": data}, asjson=True)
+	data = await helix_request(url, method="POST", headers=headers, data={"data": data}, asjson=True, priority=common.http.PRIORITY_HIGH)
 
 	return json.loads(data)['data']
 
@@ -358,7 +594,7 @@ async def send_whisper(target, message):
 		'Authorization': f"Bearer {from_user.token}",
 	}
 
-	await common.http.request(url, method="POST", headers=headers, data={"message": message}, asjson=True)
+	await helix_request(url, method="POST", headers=headers, data={"message": message}, asjson=True)
 
 async def get_number_of_chatters(channel=None, user=None):
 	"""
@@ -381,7 +617,7 @@ async def get_number_of_chatters(channel=None, user=None):
 		'Authorization': f"Bearer {moderator.token}",
 	}
 
-	data = await common.http.request(url, data=data, headers=headers)
+	data = await helix_request(url, data=data, headers=headers)
 
 	return json.loads(data)["total"]
 
@@ -398,7 +634,7 @@ async def create_eventsub_subscription(topic, version, condition, transport, tok
 		'Client-ID': config['twitch_clientid'],
 		'Authorization': f"Bearer {token}",
 	}
-	data = await common.http.request(url, method="POST", headers=headers, asjson=True, data={
+	data = await helix_request(url, method="POST", headers=headers, asjson=True, data={
 		"type": topic,
 		"version": version,
 		"condition": condition,
@@ -1,20 +1,48 @@
+import asyncio
+import collections
+import contextlib
 import logging
 import re
+import time
+import urllib.parse
 
-from common.http import request
+from common.http import request, response_cache
 from common import utils
 
 log = logging.getLogger("common.url")
 
-@utils.cache(60 * 60, params=[0])
-async def canonical_url(url, depth=10):
+REDIRECT_DEPTH = 10
+# Bounds for RedirectResolver
+REDIRECT_CACHE_SIZE = 10000
+REDIRECT_CACHE_EXPIRY = 60 * 60
+REDIRECT_NEGATIVE_EXPIRY = 5 * 60
+REDIRECT_HOST_CONCURRENCY = 4
+REDIRECT_MESSAGE_TIMEOUT = 15
+
+def normalise_url(url):
+	if not url.startswith("http://") and not url.startswith("https://"):
+		url = "http://" + url
+	return url
+
+async def follow_redirects(url, depth=REDIRECT_DEPTH, host_slot=None):
+	"""
+	Follow the redirect chain starting at `url`. Returns a tuple of the list of
+	URLs in the chain, and whether the chain was followed to the end without
+	errors.
+
+	If given, `host_slot(host)` should return an async context manager to hold
+	while making a request to that host.
+	"""
 	urls = []
 	while depth > 0:
-		if not url.startswith("http://") and not url.startswith("https://"):
-			url = "http://" + url
+		url = normalise_url(url)
 		urls.append(url)
 		try:
-			res = await request(url, method="HEAD", allow_redirects=False)
+			if host_slot is not None:
+				async with host_slot(urllib.parse.urlsplit(url).hostname):
+					res = await request(url, method="HEAD", allow_redirects=False)
+			else:
+				res = await request(url, method="HEAD", allow_redirects=False)
 			if res.status in range(300, 400) and "Location" in res.headers:
 				url = res.headers["Location"]
 				depth -= 1
@@ -24,13 +52,153 @@ async def canonical_url(url, depth=10):
 			raise
 		except Exception:
 			log.error("Error fetching %r", url)
-			break
+			return urls, False
+	return urls, True
+
+@utils.cache(60 * 60, params=[0])
+async def canonical_url(url, depth=REDIRECT_DEPTH):
+	urls, success = await follow_redirects(url, depth)
 	return urls
 
+class RedirectResolver:
+	"""
+	Resolve URLs to their redirect chains, for checking links in chat.
+
+	When the same link is posted many times at once, only one lookup is made,
+	and everyone waiting for it gets the same result. Results are kept in a
+	bounded LRU cache, including failed lookups, which expire sooner. Only a few
+	requests are made to any one host at a time.
+	"""
+	def __init__(self, size=REDIRECT_CACHE_SIZE, expiry=REDIRECT_CACHE_EXPIRY, negative_expiry=REDIRECT_NEGATIVE_EXPIRY, host_concurrency=REDIRECT_HOST_CONCURRENCY):
+		self.size = size
+		self.expiry = expiry
+		self.negative_expiry = negative_expiry
+		self.host_concurrency = host_concurrency
+
+		self.entries = collections.OrderedDict()
+		self.inflight = {}
+		self.hosts = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.resolved = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+
+	@contextlib.asynccontextmanager
+	async def host_slot(self, host):
+		semaphore, users = self.hosts.get(host, (None, 0))
+		if semaphore is None:
+			semaphore = asyncio.Semaphore(self.host_concurrency)
+		self.hosts[host] = (semaphore, users + 1)
+		try:
+			async with semaphore:
+				yield
+		finally:
+			semaphore, users = self.hosts[host]
+			if users > 1:
+				self.hosts[host] = (semaphore, users - 1)
+			else:
+				del self.hosts[host]
+
+	def _get(self, url):
+		entry = self.entries.get(url)
+		if entry is None:
+			return None
+		expires, urls = entry
+		if expires < time.monotonic():
+			del self.entries[url]
+			return None
+		self.entries.move_to_end(url)
+		return urls
+
+	def _store(self, url, urls, success):
+		expiry = self.expiry if success else self.negative_expiry
+		self.entries[url] = (time.monotonic() + expiry, urls)
+		self.entries.move_to_end(url)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	async def _resolve(self, url, depth):
+		start = time.monotonic()
+		try:
+			urls, success = await follow_redirects(url, depth, host_slot=self.host_slot)
+		finally:
+			del self.inflight[url]
+		latency = time.monotonic() - start
+		self.resolved += 1
+		self.total_latency += latency
+		self.max_latency = max(self.max_latency, latency)
+		if not success:
+			self.failures += 1
+		self._store(url, urls, success)
+		return urls
+
+	async def resolve(self, url, depth=REDIRECT_DEPTH):
+		"""
+		Get the redirect chain for `url`, as a list of URLs.
+		"""
+		url = normalise_url(url)
+		urls = self._get(url)
+		if urls is not None:
+			self.hits += 1
+			return urls
+		task = self.inflight.get(url)
+		if task is None:
+			self.misses += 1
+			task = self.inflight[url] = asyncio.ensure_future(self._resolve(url, depth))
+		else:
+			self.coalesced += 1
+		# Shield the lookup, so that one waiter giving up doesn't cancel it for everyone.
+		return await asyncio.shield(task)
+
+	async def resolve_all(self, urls, timeout=REDIRECT_MESSAGE_TIMEOUT):
+		"""
+		Get the redirect chains for all the URLs in a message, spending no more than
+		`timeout` seconds on it overall. Chains for URLs that couldn't be resolved
+		in time contain only the URL itself.
+
+		Lookups that run out of time carry on in the background, so the result is
+		cached for next time.
+		"""
+		if not urls:
+			return []
+		tasks = [asyncio.ensure_future(self.resolve(url)) for url in urls]
+		done, pending = await asyncio.wait(tasks, timeout=timeout)
+		for task in pending:
+			task.cancel()
+		chains = []
+		for url, task in zip(urls, tasks):
+			if task in done and task.exception() is None:
+				chains.append(task.result())
+			else:
+				if task not in done:
+					self.timeouts += 1
+				chains.append([normalise_url(url)])
+		return chains
+
+	def stats(self):
+		lookups = self.hits + self.misses + self.coalesced
+		return {
+			'entries': len(self.entries),
+			'inflight': len(self.inflight),
+			'hits': self.hits,
+			'misses': self.misses,
+			'coalesced': self.coalesced,
+			'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+			'failures': self.failures,
+			'timeouts': self.timeouts,
+			'mean_latency': self.total_latency / self.resolved if self.resolved else 0.0,
+			'max_latency': self.max_latency,
+		}
+
 @utils.cache(24 * 60 * 60)
 async def get_tlds():
 	tlds = set()
-	data = await request("https://data.iana.org/TLD/tlds-alpha-by-domain.txt")
+	data = await request("https://data.iana.org/TLD/tlds-alpha-by-domain.txt", cache=response_cache)
 	for line in data.splitlines():
 		if not line.startswith("#"):
 			line = line.strip().lower()
@@ -39,18 +207,56 @@ async def get_tlds():
 			tlds.add(line)
 	return tlds
 
+def _tld_regex(tlds):
+	"""
+	Build a regex that matches the longest TLD at the current position.
+
+	The TLDs are arranged in a trie, so at each character there's only a handful
+	of branches to try, rather than every TLD in turn.
+	"""
+	trie = {}
+	for tld in tlds:
+		node = trie
+		for char in tld:
+			node = node.setdefault(char, {})
+		node[''] = None
+
+	def build(node):
+		alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+		if len(alternatives) == 0:
+			return ''
+		elif len(alternatives) == 1:
+			pattern = alternatives[0]
+		else:
+			pattern = "(?:%s)" % "|".join(alternatives)
+		if '' in node:
+			# Greedy, so longer TLDs are preferred. For example: 'example.com/path'
+			# should not be matched as 'example.co'.
+			pattern = "(?:%s)?" % pattern
+		return pattern
+	return build(trie)
+
+class URLExtractor:
+	"""
+	Find all the URLs in a message. A URL is a hostname that ends in a known TLD,
+	or an IP address, optionally with a scheme, port and path.
+	"""
+	def __init__(self, tlds):
+		re_hostname = r"(?:(?:(?:[\w-]+\.)+%s\.?)|(?:\d{,3}(?:\.\d{,3}){3})|(?:\[[0-9a-fA-F:.]+\]))" % _tld_regex(tlds)
+		self.re_url = re.compile(r"(?:https?://)?%s(?::\d+)?(?:/[\x5E\s\u200b]*)?" % re_hostname, re.IGNORECASE)
+
+	def findall(self, text):
+		"""
+		Returns a list of the URLs in `text`, in order.
+		"""
+		# Every URL has either a dot or an IPv6 address in it.
+		if '.' not in text and '[' not in text:
+			return []
+		return self.re_url.findall(text)
+
 @utils.cache(24 * 60 * 60)
-async def url_regex():
-	parens = ["()", "[]", "{}", "<>", '""', "''"]
-
-	# Sort TLDs in decreasing order by length to avoid incorrect matches.
-	# For example: if 'co' is before 'com', 'example.com/path' is matched as 'example.co'.
-	tlds = sorted((await get_tlds()), key=lambda e: len(e), reverse=True)
-	re_tld = "(?:" + "|".join(map(re.escape, tlds)) + ")"
-	re_hostname = r"(?:(?:(?:[\w-]+\.)+%s\.?)|(?:\d{,3}(?:\.\d{,3}){3})|(?:\[[0-9a-fA-F:.]+\]))" % re_tld
-	re_url = r"((?:https?://)?%s(?::\d+)?(?:/[\x5E\s\u200b]*)?)" % re_hostname
-	re_url = re_url + "|" + "|".join(map(lambda parens: re.escape(parens[0]) + re_url + re.escape(parens[1]), parens))
-	return re.compile(re_url, re.IGNORECASE)
+async def url_extractor():
+	return URLExtractor(await get_tlds())
 
 RE_PROTO = re.compile("^https?://")
 def https(uri):
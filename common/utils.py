@@ -1,5 +1,7 @@
 import asyncio
+import collections
 import functools
+import heapq
 import inspect
 import itertools
 import logging
@@ -68,7 +70,7 @@ def coro_decorator(decorator):
 	"""
 	# any extra properties that we want to assign to wrappers, in any of the decorators
 	# we use this on
-	EXTRA_PARAMS = ('reset_throttle',)
+	EXTRA_PARAMS = ('reset_throttle', 'cache_stats')
 	@functools.wraps(decorator)
 	def wrapper(func):
 		is_coro = inspect.iscoroutinefunction(func)
@@ -91,17 +93,46 @@ def coro_decorator(decorator):
 	return wrapper
 
 DEFAULT_THROTTLE = 15
+# Maximum number of distinct parameter values each throttle/cache remembers
+DEFAULT_CACHE_SIZE = 10000
+# How many times larger than the cache the expiry heap can grow, from refreshed and
+# evicted entries leaving stale items behind, before it's rebuilt
+EXPIRY_HEAP_SLACK = 2
 class throttle_base(object):
-	"""Prevent a function from being called more often than once per period"""
-	def __init__(self, period=DEFAULT_THROTTLE, params=[], log=True, count=1):
+	"""Prevent a function from being called more often than once per period
+
+	Calls are serialised per set of watched parameters, so a slow call only holds
+	up other calls with the same parameters, which then get its result. At most
+	`size` sets of parameters are remembered, least recently used first out, and
+	entries are dropped as soon as they expire.
+
+	If `stale` is set, for that many seconds after the period is up the old
+	result is still returned straight away, while the function is called again
+	in the background to refresh it.
+	"""
+	def __init__(self, period=DEFAULT_THROTTLE, params=[], log=True, count=1, size=DEFAULT_CACHE_SIZE, stale=0):
 		self.period = period
 		self.watchparams = params
-		self.lastrun = {}
-		self.lastreturn = {}
-		self.lastcleanup = time.time()
 		self.log = log
 		self.count = count
-		self.lock = asyncio.Lock()
+		self.size = size
+		self.stale = stale
+
+		# params -> {"runs": [timestamps], "value": ..., "expires": ...}, in LRU order
+		self.entries = collections.OrderedDict()
+		# heap of (expiry time, sequence, params) - may include stale items for entries
+		# that have since been refreshed or evicted, which are skipped
+		self.expiry = []
+		self.sequence = itertools.count()
+		# params -> [lock, number of users]
+		self.locks = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+		self.stale_hits = 0
+		self.evictions = 0
+		self.expirations = 0
 
 		# need to decorate this here, rather than putting a decorator on the actual
 		# function, as it needs to wrap the *bound* method, so there's no "self"
@@ -135,6 +166,79 @@ class throttle_base(object):
 		if self.log:
 			log.info("Skipping %s due to throttling" % func.__name__)
 
+	def due(self, entry):
+		"""Whether the function should be called again, rather than using this entry."""
+		runs = entry["runs"]
+		return len(runs) < self.count or (self.period and time.time() - runs[0] >= self.period)
+
+	def can_serve_stale(self, entry):
+		return bool(self.stale) and len(entry["runs"]) >= self.count and bool(self.period)
+
+	def store(self, params, value):
+		entry = self.entries.get(params)
+		if entry is None:
+			entry = {"runs": []}
+		entry["runs"].append(time.time())
+		if len(entry["runs"]) > self.count:
+			entry["runs"] = entry["runs"][-self.count:]
+		entry["value"] = value
+		if self.period is not None:
+			entry["expires"] = entry["runs"][-1] + self.period + self.stale
+			entry["sequence"] = next(self.sequence)
+			heapq.heappush(self.expiry, (entry["expires"], entry["sequence"], params))
+		self.entries[params] = entry
+		self.entries.move_to_end(params)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+		if len(self.expiry) > EXPIRY_HEAP_SLACK * max(len(self.entries), self.size):
+			self.rebuild_expiry()
+
+	def rebuild_expiry(self):
+		"""Drop the stale items from the expiry heap"""
+		self.expiry = [
+			(entry["expires"], entry["sequence"], params)
+			for params, entry in self.entries.items()
+			if "sequence" in entry
+		]
+		heapq.heapify(self.expiry)
+
+	def expire(self):
+		"""Remove expired cache entries"""
+		now = time.time()
+		while self.expiry and self.expiry[0][0] <= now:
+			expires, sequence, params = heapq.heappop(self.expiry)
+			entry = self.entries.get(params)
+			# The entry may have been refreshed or evicted since this was pushed
+			if entry is not None and entry.get("sequence") == sequence:
+				del self.entries[params]
+				self.expirations += 1
+
+	async def call(self, func, params, args, kwargs):
+		"""Call the function, unless a call for the same params beat us to it."""
+		lock, users = self.locks.get(params, (None, 0))
+		if lock is None:
+			lock = asyncio.Lock()
+		elif lock.locked():
+			self.coalesced += 1
+		self.locks[params] = [lock, users + 1]
+		try:
+			async with lock:
+				entry = self.entries.get(params)
+				if entry is None or self.due(entry):
+					self.misses += 1
+					value = await func(*args, **kwargs)
+					self.store(params, value)
+					return value
+				self.hits += 1
+				self.entries.move_to_end(params)
+				self.cache_hit(func, args, kwargs)
+				return entry["value"]
+		finally:
+			self.locks[params][1] -= 1
+			if self.locks[params][1] == 0:
+				del self.locks[params]
+
 	def decorate(self, func):
 		if self.watchparams:
 			self.signature = inspect.signature(func)
@@ -144,43 +248,38 @@ class throttle_base(object):
 
 		@functools.wraps(func)
 		async def wrapper(*args, **kwargs):
-			# periodically remove stale entries from cache
-			if self.period is not None and time.time() - self.lastcleanup > self.period * 2:
-				self.cleanup()
-
-			async with self.lock:
-				if self.bypass(func, args, kwargs):
-					return (await func(*args, **kwargs))
-
-				params = self.watchedparams(args, kwargs)
-				if params not in self.lastrun or len(self.lastrun[params]) < self.count or (self.period and time.time() - self.lastrun[params][0] >= self.period):
-					self.lastreturn[params] = await func(*args, **kwargs)
-					self.lastrun.setdefault(params, []).append(time.time())
-					if len(self.lastrun[params]) > self.count:
-						self.lastrun[params] = self.lastrun[params][-self.count:]
-				else:
-					self.cache_hit(func, args, kwargs)
-				return self.lastreturn[params]
-		# Copy this method across so it can be accessed on the wrapped function
+			self.expire()
+
+			if self.bypass(func, args, kwargs):
+				return (await func(*args, **kwargs))
+
+			params = self.watchedparams(args, kwargs)
+			entry = self.entries.get(params)
+			if entry is not None and params not in self.locks and self.due(entry) and self.can_serve_stale(entry):
+				self.stale_hits += 1
+				self.entries.move_to_end(params)
+				asyncio.ensure_future(self.call(func, params, args, kwargs)).add_done_callback(check_exception)
+				return entry["value"]
+			return (await self.call(func, params, args, kwargs))
+		# Copy these methods across so they can be accessed on the wrapped function
 		wrapper.reset_throttle = self.reset_throttle
+		wrapper.cache_stats = self.stats
 		return wrapper
 
 	def reset_throttle(self):
-		self.lastrun = {}
-		self.lastreturn = {}
-		self.lastcleanup = time.time()
+		self.entries.clear()
+		self.expiry = []
 
-	def cleanup(self):
-		"""Remove expired cache entries"""
-		cutoff = time.time() - self.period
-		toremove = set()
-		for key, runtimes in self.lastrun.items():
-			if runtimes[-1] < cutoff:
-				toremove.add(key)
-		for key in toremove:
-			del self.lastrun[key]
-			del self.lastreturn[key]
-		self.lastcleanup = time.time()
+	def stats(self):
+		return {
+			"entries": len(self.entries),
+			"hits": self.hits,
+			"misses": self.misses,
+			"coalesced": self.coalesced,
+			"stale_hits": self.stale_hits,
+			"evictions": self.evictions,
+			"expirations": self.expirations,
+		}
 
 
 class cache(throttle_base):
@@ -199,9 +298,15 @@ class cache(throttle_base):
 	watched parameters are the same are throttled together, but calls where they
 	are different are throttled separately. Should be a list of ints (for positional
 	parameters) and strings (for keyword parameters).
+
+	size is the maximum number of distinct sets of parameters to keep results for.
+
+	stale is a number of seconds after the period is up during which the old
+	result is still returned immediately, while it's refreshed in the background.
+	This needs a running event loop.
 	"""
-	def __init__(self, period=DEFAULT_THROTTLE, params=[], log=False, count=1):
-		super().__init__(period=period, params=params, log=log, count=count)
+	def __init__(self, period=DEFAULT_THROTTLE, params=[], log=False, count=1, size=DEFAULT_CACHE_SIZE, stale=0):
+		super().__init__(period=period, params=params, log=log, count=count, size=size, stale=stale)
 
 @coro_decorator
 def swallow_errors(func):
@@ -4,28 +4,315 @@ import aiohttp
 import aiohttp.web
 import aiomas
 import asyncio
+import collections
 import mimeparse
+import multiprocessing
 import sqlalchemy
 import sys
 import json
 import datetime
+import logging
 import pytz
 import os
+import time
 
 import common.rpc
 import common.postgres
+from sqlalchemy.dialects.postgresql import insert
+
 from common.config import config
 
+log = logging.getLogger('eventserver')
+
+# Events to hold for a client that isn't keeping up, before disconnecting it
+QUEUE_SIZE = 1000
+# Seconds between keep-alive comments when there are no events
+KEEPALIVE_INTERVAL = 15
+# Number of recent events to keep in memory for clients that reconnect
+REPLAY_SIZE = 1000
+# Seconds to keep events in memory for clients that reconnect
+REPLAY_AGE = 60 * 60
+# Number of older events to fetch from the database at a time
+REPLAY_PAGE_SIZE = 500
+# Maximum number of events to return from one history request
+HISTORY_LIMIT = 10000
+# Postgres notification channel that gets the ID of every new event, when
+# there's more than one worker
+NOTIFY_CHANNEL = "lrrbot_events"
+# Seconds between checks that the LISTEN connection is still alive
+LISTEN_CHECK_INTERVAL = 5
+# Number of event IDs to reserve from the database at a time
+ID_BLOCK_SIZE = 100
+# Maximum number of events to write to the database in one transaction
+WRITE_BATCH_SIZE = 100
+# Seconds to wait before trying again when writing events fails
+WRITE_RETRY_INTERVAL = 5
+
 class Poison:
 	pass
 
+def sse_frame(id, event, data):
+	"""
+	Encode an event as a server-sent events message.
+	"""
+	return b"id:%d\nevent:%s\ndata:%s\n\n" % (id, event.encode('utf-8'), json.dumps(data).encode('utf-8'))
+
+def _is_bad_data(e):
+	"""
+	Whether writing events failed because of the events themselves, so trying
+	again won't help, rather than because the database is unavailable.
+	"""
+	if isinstance(e, (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.DataError)):
+		return True
+	# Data that couldn't even be encoded for the query
+	return isinstance(e, sqlalchemy.exc.StatementError) and not isinstance(e, sqlalchemy.exc.DBAPIError)
+
+Event = collections.namedtuple('Event', ['id', 'event', 'data', 'time', 'frame'])
+def make_event(id, event, data, time):
+	data = dict(data, time=time.isoformat())
+	return Event(id, event, data, time, sse_frame(id, event, data))
+
+class ReplayBuffer:
+	"""
+	The most recent events, newest last, for replaying to clients that reconnect
+	with `Last-Event-Id`, without going to the database.
+
+	At most `size` events are kept, and none older than `age` seconds. Every
+	event with an ID of at least `complete_from` is in the buffer.
+	"""
+	def __init__(self, size=REPLAY_SIZE, age=REPLAY_AGE):
+		self.size = size
+		self.age = datetime.timedelta(seconds=age)
+		self.events = collections.deque()
+		self.complete_from = None
+
+		self.hits = 0
+		self.misses = 0
+
+	def load(self, engine, metadata):
+		"""
+		Fill the buffer with the most recent events from the database.
+		"""
+		events = metadata.tables['events']
+		with engine.connect() as conn:
+			rows = conn.execute(
+				sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time)
+					.where(events.c.time > sqlalchemy.func.current_timestamp() - self.age)
+					.order_by(events.c.id.desc())
+					.limit(self.size)
+			).all()
+			if rows:
+				self.complete_from = rows[-1].id
+			else:
+				self.complete_from = (conn.execute(sqlalchemy.select(sqlalchemy.func.max(events.c.id))).scalar() or 0) + 1
+		self.events.extend(make_event(*row) for row in reversed(rows))
+
+	def expire(self):
+		cutoff = datetime.datetime.now(tz=pytz.utc) - self.age
+		while self.events and (len(self.events) > self.size or self.events[0].time < cutoff):
+			self.complete_from = self.events.popleft().id + 1
+
+	def append(self, event):
+		self.events.append(event)
+		self.expire()
+
+	def since(self, last_event_id, partial=False):
+		"""
+		Get all the events after `last_event_id`. Returns `None` if some of them
+		aren't in the buffer, unless `partial` is set, in which case it returns
+		whichever of them are.
+		"""
+		self.expire()
+		if not partial and (self.complete_from is None or last_event_id + 1 < self.complete_from):
+			self.misses += 1
+			return None
+		self.hits += 1
+		events = []
+		for event in reversed(self.events):
+			if event.id <= last_event_id:
+				break
+			events.append(event)
+		events.reverse()
+		return events
+
+class EventWriter:
+	"""
+	Write events to the database in the background, after they've been
+	delivered.
+
+	IDs come from blocks reserved from the `events` table's sequence ahead of
+	time, so an event can be given its ID, and delivered, without waiting for
+	the database. Events are written strictly in ID order, in batches of
+	whatever has built up since the last write finished. If the database is
+	unavailable, the write is retried until it gets through, so events are only
+	lost if the process dies before they're written. If the database rejects a
+	batch, its events are written one at a time, and only the rejected ones are
+	dropped.
+
+	If `notify` is set, the ID of every event is sent on `NOTIFY_CHANNEL` when
+	it's written.
+	"""
+	def __init__(self, engine, metadata, notify=False):
+		self.engine = engine
+		self.metadata = metadata
+		self.notify = notify
+
+		self.ids = collections.deque()
+		self.id_lock = asyncio.Lock()
+		self.pending = collections.deque()
+		self.wakeup = asyncio.Event()
+		self.task = None
+
+		self.written = 0
+		self.batches = 0
+		self.failures = 0
+		self.dropped = 0
+		self.max_lag = 0.0
+
+	def _reserve_ids(self, count):
+		with self.engine.connect() as conn:
+			return conn.execute(
+				sqlalchemy.select(sqlalchemy.func.nextval('events_id_seq'))
+					.select_from(sqlalchemy.func.generate_series(1, count))
+			).scalars().all()
+
+	async def next_id(self):
+		"""
+		Get the ID for a new event. IDs are handed out in increasing order.
+		"""
+		async with self.id_lock:
+			if not self.ids:
+				self.ids.extend(sorted(await common.postgres.run(self._reserve_ids, ID_BLOCK_SIZE)))
+			return self.ids.popleft()
+
+	def add(self, event, data):
+		"""
+		Queue an event to be written. `data` is the event's data as it was given,
+		without the time that's added for clients.
+		"""
+		self.pending.append((event, data, time.monotonic()))
+		self.wakeup.set()
+
+	def _write(self, batch):
+		events = self.metadata.tables['events']
+		with self.engine.connect() as conn:
+			# If an earlier attempt did get through, don't write the events again.
+			conn.execute(insert(events).on_conflict_do_nothing(index_elements=[events.c.id]), [
+				{'id': event.id, 'event': event.event, 'data': data, 'time': event.time}
+				for event, data, queued in batch
+			])
+			if self.notify:
+				for event, data, queued in batch:
+					conn.execute(sqlalchemy.select(sqlalchemy.func.pg_notify(NOTIFY_CHANNEL, str(event.id))))
+			conn.commit()
+
+	async def run(self):
+		while True:
+			await self.wakeup.wait()
+			self.wakeup.clear()
+			while self.pending:
+				batch = [self.pending[i] for i in range(min(len(self.pending), WRITE_BATCH_SIZE))]
+				try:
+					await common.postgres.run(self._write, batch)
+				except Exception as e:
+					if _is_bad_data(e):
+						log.exception("Failed to write %d events, writing them one at a time", len(batch))
+						written, done = await self._write_each(batch)
+					else:
+						self.failures += 1
+						log.exception("Failed to write %d events, retrying", len(batch))
+						written, done = 0, 0
+				else:
+					written, done = len(batch), len(batch)
+				now = time.monotonic()
+				for event, data, queued in batch[:done]:
+					self.pending.popleft()
+					self.max_lag = max(self.max_lag, now - queued)
+				self.written += written
+				if done:
+					self.batches += 1
+				if done < len(batch):
+					await asyncio.sleep(WRITE_RETRY_INTERVAL)
+
+	async def _write_each(self, batch):
+		"""
+		Write the events one at a time, so that one bad event can't hold up all the
+		others. Events that the database rejects are logged and dropped.
+
+		Stops early if the database becomes unavailable. Returns how many events
+		were written, and how many were dealt with (written or dropped).
+		"""
+		written = 0
+		for done, (event, data, queued) in enumerate(batch):
+			try:
+				await common.postgres.run(self._write, [(event, data, queued)])
+			except Exception as e:
+				if not _is_bad_data(e):
+					self.failures += 1
+					log.exception("Failed to write event %d, retrying", event.id)
+					return written, done
+				self.dropped += 1
+				log.exception("Dropping event %d that was rejected by the database: %s %r", event.id, event.event, data)
+			else:
+				written += 1
+		return written, len(batch)
+
+	def start(self):
+		self.task = asyncio.ensure_future(self.run())
+
+	async def close(self):
+		"""
+		Stop the background writer, and write anything that's still pending.
+		"""
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+		while self.pending:
+			batch = [self.pending.popleft() for i in range(min(len(self.pending), WRITE_BATCH_SIZE))]
+			self._write(batch)
+
+	def stats(self):
+		return {
+			'pending': len(self.pending),
+			'written': self.written,
+			'batches': self.batches,
+			'failures': self.failures,
+			'dropped': self.dropped,
+			'max_lag': self.max_lag,
+		}
+
 class Server(common.rpc.Server):
+	"""
+	Serve events to clients as they happen.
+
+	If `distributed` is set, every worker process LISTENs for new events on
+	`NOTIFY_CHANNEL` and publishes them to its own clients, see `distribute`.
+	"""
 	router = aiomas.rpc.Service()
 
-	def __init__(self):
+	def __init__(self, distributed=False):
 		super().__init__()
 		self.engine, self.metadata = common.postgres.get_engine_and_metadata()
-		self.queues = []
+		self.queues = set()
+		self.replay_buffer = ReplayBuffer()
+		self.replay_buffer.load(self.engine, self.metadata)
+
+		self.listener = common.postgres.Listener(NOTIFY_CHANNEL) if distributed else None
+		self.writer = EventWriter(self.engine, self.metadata, notify=distributed)
+		# ID of the newest event that's been published. Events are published in ID
+		# order, so anything older has already been published.
+		self.last_id = self.replay_buffer.events[-1].id if self.replay_buffer.events else self.replay_buffer.complete_from - 1
+
+		self.events = 0
+		self.dropped = 0
+		self.total_fanout = 0.0
+		self.max_fanout = 0.0
+		self.delivered = 0
+		self.total_delivery = 0.0
+		self.max_delivery = 0.0
 
 	async def negotiate(self, request):
 		request.headers.getall('Accept', "*/*")
@@ -38,7 +325,11 @@ class Server(common.rpc.Server):
 		else:
 			raise NotImplementedError(mime_type)
 
-	def get_last_events(self, request):
+	def get_replay_params(self, request):
+		"""
+		Get the ID of the last event the client has seen, and the interval of past
+		events it's interested in.
+		"""
 		try:
 			last_event_id = int(request.headers.get('Last-Event-Id', request.query.get('last-event-id')))
 		except (ValueError, TypeError):
@@ -46,60 +337,238 @@ class Server(common.rpc.Server):
 		interval = request.query.get('interval')
 		if interval is not None and last_event_id is None:
 			last_event_id = 0
-		if last_event_id is not None:
-			events = self.metadata.tables['events']
-			query = sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time)
-			query = query.where(events.c.id > last_event_id)
-			if interval is not None:
-				query = query.where(events.c.time > sqlalchemy.func.current_timestamp() - sqlalchemy.cast(interval, sqlalchemy.Interval))
-			query = query.order_by(events.c.id)
-			try:
-				with self.engine.connect() as conn:
-					return [
-						{'id': id, 'event': event, 'data': dict(data, time=time.isoformat())}
-						for id, event, data, time in conn.execute(query)
-					]
-			except sqlalchemy.exc.DataError as e:
-				raise aiohttp.web.HTTPBadRequest from e
-		return []
+		return last_event_id, interval
 
-	async def event_stream(self, request):
-		queue = asyncio.Queue()
-		for event in self.get_last_events(request):
-			await queue.put(event)
-		self.queues.append(queue)
+	def get_interval_start(self, interval):
+		try:
+			with self.engine.connect() as conn:
+				return conn.execute(sqlalchemy.select(
+					sqlalchemy.func.current_timestamp() - sqlalchemy.cast(interval, sqlalchemy.Interval)
+				)).scalar_one()
+		except sqlalchemy.exc.DataError as e:
+			raise aiohttp.web.HTTPBadRequest from e
 
-		response = aiohttp.web.StreamResponse()
-		response.enable_chunked_encoding()
-		response.headers['Access-Control-Allow-Origin'] = '*'
-		response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
-		response.headers['Vary'] = "Accept"
-		await response.prepare(request)
+	def get_events_page(self, last_event_id, start):
+		events = self.metadata.tables['events']
+		query = sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time)
+		query = query.where(events.c.id > last_event_id)
+		if start is not None:
+			query = query.where(events.c.time > start)
+		query = query.order_by(events.c.id).limit(REPLAY_PAGE_SIZE)
+		with self.engine.connect() as conn:
+			return conn.execute(query).all()
 
+	async def get_last_events(self, last_event_id, interval):
+		"""
+		Get the events a client has missed, as lists of `Event`s.
+
+		Recent events come from the replay buffer. Older ones, and any request with
+		an interval, are read from the database a page at a time, until the rest
+		are in the buffer. The newest events may not have been written to the
+		database yet, so those always come from the buffer.
+		"""
+		if last_event_id is None:
+			return
+		start = None
+		if interval is not None:
+			start = await common.postgres.run(self.get_interval_start, interval)
 		while True:
-			try:
-				try:
-					event = await asyncio.wait_for(queue.get(), 15)
-					if event['event'] is Poison:
-						break
-					await response.write(b"id:%d\n" % event['id'])
-					await response.write(b"event:%s\n" % event['event'].encode('utf-8'))
-					await response.write(b"data:%s\n" % json.dumps(event['data']).encode('utf-8'))
-					await response.write(b"\n")
-					queue.task_done()
-				except asyncio.TimeoutError:
-					await response.write(b":keep-alive\n\n")
-			except IOError:
+			if start is None:
+				events = self.replay_buffer.since(last_event_id)
+				if events is not None:
+					if events:
+						yield events
+					return
+			rows = await common.postgres.run(self.get_events_page, last_event_id, start)
+			if rows:
+				yield [make_event(*row) for row in rows]
+				last_event_id = rows[-1].id
+			if len(rows) < REPLAY_PAGE_SIZE:
 				break
+		# Events that have been delivered but are still waiting for the writer
+		events = [
+			event
+			for event in self.replay_buffer.since(last_event_id, partial=True)
+			if start is None or event.time > start
+		]
+		if events:
+			yield events
+
+	async def event_stream(self, request):
+		"""
+		Stream events to the client as they happen.
+
+		Each event is encoded once, in `event`, and the same frame is queued for
+		every client. A client that falls more than `QUEUE_SIZE` events behind is
+		disconnected, and can catch up when it reconnects with `Last-Event-Id`.
+		"""
+		last_event_id, interval = self.get_replay_params(request)
+		queue = asyncio.Queue(QUEUE_SIZE)
+		self.queues.add(queue)
+
+		try:
+			# Fetch the first page before starting the response, so a bad interval gets a 400.
+			pages = self.get_last_events(last_event_id, interval)
+			page = await anext(pages, None)
+
+			response = aiohttp.web.StreamResponse()
+			response.enable_chunked_encoding()
+			response.headers['Access-Control-Allow-Origin'] = '*'
+			response.headers['Content-Type'] = 'text/event-stream; charset=utf-8'
+			response.headers['Vary'] = "Accept"
+			await response.prepare(request)
+
+			while page is not None:
+				await response.write(b"".join(event.frame for event in page))
+				last_event_id = page[-1].id
+				page = await anext(pages, None)
+
+			while True:
+				try:
+					try:
+						id, frame, queued = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+						if frame is Poison:
+							break
+						if last_event_id is not None and id <= last_event_id:
+							# Already sent while catching up
+							continue
+						await response.write(frame)
+						self.record_delivery(time.monotonic() - queued)
+					except asyncio.TimeoutError:
+						await response.write(b":keep-alive\n\n")
+				except IOError:
+					break
+		finally:
+			self.queues.discard(queue)
 
-		self.queues.remove(queue)
+		return response
+
+	def disconnect(self, queue):
+		self.queues.discard(queue)
+		while not queue.empty():
+			queue.get_nowait()
+		queue.put_nowait((None, Poison, None))
+
+	def record_delivery(self, delay):
+		self.delivered += 1
+		self.total_delivery += delay
+		self.max_delivery = max(self.max_delivery, delay)
+
+	def publish(self, event):
+		self.last_id = max(self.last_id, event.id)
+		self.replay_buffer.append(event)
+		start = time.monotonic()
+		for queue in list(self.queues):
+			try:
+				queue.put_nowait((event.id, event.frame, start))
+			except asyncio.QueueFull:
+				# This client isn't keeping up.
+				self.disconnect(queue)
+				self.dropped += 1
+		fanout = time.monotonic() - start
+		self.events += 1
+		self.total_fanout += fanout
+		self.max_fanout = max(self.max_fanout, fanout)
+
+	async def stream_json(self, request, pages, headers, trailer=lambda: {}):
+		"""
+		Write out an object with an `events` list, without holding the whole list in
+		memory: each page of events is written as it arrives. Any extra keys from
+		`trailer()` are added after the list.
+		"""
+		# Fetch the first page before starting the response, so bad parameters get a 400.
+		page = await anext(pages, None)
 
+		response = aiohttp.web.StreamResponse(headers=headers)
+		response.content_type = 'application/json'
+		response.enable_chunked_encoding()
+		await response.prepare(request)
+
+		separator = b""
+		await response.write(b'{"events":[')
+		while page is not None:
+			if page:
+				await response.write(separator + b",".join(
+					json.dumps({'id': event.id, 'event': event.event, 'data': event.data}).encode('utf-8')
+					for event in page
+				))
+				separator = b","
+			page = await anext(pages, None)
+		await response.write(b"]")
+		for key, value in trailer().items():
+			await response.write(b",%s:%s" % (json.dumps(key).encode('utf-8'), json.dumps(value).encode('utf-8')))
+		await response.write(b"}")
+		await response.write_eof()
 		return response
 
 	async def json(self, request):
-		return aiohttp.web.json_response({
-			'events': self.get_last_events(request),
-		}, headers={"Vary": "Accept", 'Access-Control-Allow-Origin': request.headers.get('Origin', '*')})
+		last_event_id, interval = self.get_replay_params(request)
+		return await self.stream_json(request, self.get_last_events(last_event_id, interval),
+			{"Vary": "Accept", 'Access-Control-Allow-Origin': request.headers.get('Origin', '*')})
+
+	def get_history_page(self, event_types, since, until, before, limit):
+		events = self.metadata.tables['events']
+		query = sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time)
+		if event_types:
+			query = query.where(events.c.event.in_(event_types))
+		if since is not None:
+			query = query.where(events.c.time > since)
+		if until is not None:
+			query = query.where(events.c.time <= until)
+		if before is not None:
+			before_time = sqlalchemy.select(events.c.time).where(events.c.id == before).scalar_subquery()
+			query = query.where(sqlalchemy.tuple_(events.c.time, events.c.id) < sqlalchemy.tuple_(before_time, before))
+		query = query.order_by(events.c.time.desc(), events.c.id.desc()).limit(limit)
+		with self.engine.connect() as conn:
+			return conn.execute(query).all()
+
+	async def history(self, request):
+		"""
+		Get past events, newest first.
+
+		Query parameters:
+		 * `event` - only get events of this type, can be given more than once
+		 * `since`, `until` - only get events in this time range, ISO 8601
+		 * `before` - only get events older than the event with this ID
+		 * `limit` - maximum number of events, up to `HISTORY_LIMIT`
+
+		The response is an object with the `events`, and `next`, the ID to pass as
+		`before` to get the next page of events, or `null` if there are no more.
+
+		Events are read a page at a time, using the index on `(event, time)`, and
+		streamed out as they're read.
+		"""
+		def parse_time(value):
+			if value is None:
+				return None
+			value = datetime.datetime.fromisoformat(value)
+			if value.tzinfo is None:
+				value = value.replace(tzinfo=pytz.utc)
+			return value
+		try:
+			event_types = request.query.getall('event', [])
+			since = parse_time(request.query.get('since'))
+			until = parse_time(request.query.get('until'))
+			before = int(request.query['before']) if 'before' in request.query else None
+			limit = max(1, min(int(request.query.get('limit', HISTORY_LIMIT)), HISTORY_LIMIT))
+		except ValueError as e:
+			raise aiohttp.web.HTTPBadRequest from e
+
+		state = {'count': 0, 'before': before, 'more': True}
+		async def pages():
+			while state['more'] and state['count'] < limit:
+				page_size = min(REPLAY_PAGE_SIZE, limit - state['count'])
+				rows = await common.postgres.run(self.get_history_page, event_types, since, until, state['before'], page_size)
+				state['count'] += len(rows)
+				state['more'] = len(rows) == page_size
+				if rows:
+					state['before'] = rows[-1].id
+				# No need to encode SSE frames for these.
+				yield [Event(row.id, row.event, dict(row.data, time=row.time.isoformat()), row.time, None) for row in rows]
+
+		return await self.stream_json(request, pages(),
+			{'Access-Control-Allow-Origin': request.headers.get('Origin', '*')},
+			lambda: {'next': state['before'] if state['more'] else None})
 
 	async def cors_preflight(self, request):
 		return aiohttp.web.Response(headers={
@@ -108,71 +577,180 @@ class Server(common.rpc.Server):
 
 	@aiomas.expose
 	async def event(self, event, data, time=None):
+		"""
+		Record a new event, and send it to all the clients.
+
+		The event is delivered straight away, and written to the database in the
+		background, see `EventWriter`.
+		"""
 		if time is None:
 			time = datetime.datetime.now(tz=pytz.utc)
+		id = await self.writer.next_id()
+		event = make_event(id, event, data, time)
+		self.publish(event)
+		self.writer.add(event, data)
+
+	def get_new_events(self, ids, after):
 		events = self.metadata.tables['events']
+		condition = events.c.id.in_(ids)
+		if after is not None:
+			condition |= events.c.id > after
 		with self.engine.connect() as conn:
-			id, = conn.execute(events.insert().returning(events.c.id), {
-				"event": event,
-				"data": data,
-				"time": time,
-			}).first()
-			conn.commit()
-		event = {
-			'id': id,
-			'event': event,
-			'data': dict(data, time=time.isoformat()),
+			return conn.execute(
+				sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time)
+					.where(condition)
+					.order_by(events.c.id)
+			).all()
+
+	async def distribute(self):
+		"""
+		Publish the events announced on `NOTIFY_CHANNEL`.
+
+		Whenever the LISTEN connection is (re)established, any events newer than
+		the last one published are fetched as well, in case some notifications
+		were missed in the meantime.
+		"""
+		loop = asyncio.get_running_loop()
+		wakeup = asyncio.Event()
+		reader = None
+		reader_fd = None
+		catch_up = True
+		while True:
+			wakeup.clear()
+			payloads = self.listener.poll(self.engine)
+			if self.listener.conn is not reader:
+				if reader is not None:
+					loop.remove_reader(reader_fd)
+				reader = self.listener.conn
+				if reader is not None:
+					reader_fd = reader.fileno()
+					loop.add_reader(reader_fd, wakeup.set)
+			if payloads is None:
+				catch_up = True
+			else:
+				ids = []
+				for payload in payloads:
+					try:
+						ids.append(int(payload))
+					except ValueError:
+						catch_up = True
+				if ids or catch_up:
+					try:
+						rows = await common.postgres.run(self.get_new_events, ids, self.last_id if catch_up else None)
+					except Exception:
+						log.exception("Failed to fetch new events")
+					else:
+						catch_up = False
+						for row in rows:
+							# The first worker has already published the events it wrote itself
+							if row.id > self.last_id:
+								self.publish(make_event(*row))
+			try:
+				await asyncio.wait_for(wakeup.wait(), LISTEN_CHECK_INTERVAL)
+			except asyncio.TimeoutError:
+				pass
+
+	@aiomas.expose
+	def stats(self):
+		depths = [queue.qsize() for queue in self.queues]
+		return {
+			'clients': len(depths),
+			'events': self.events,
+			'dropped': self.dropped,
+			'writer': self.writer.stats(),
+			'replay_buffer': {
+				'events': len(self.replay_buffer.events),
+				'hits': self.replay_buffer.hits,
+				'misses': self.replay_buffer.misses,
+			},
+			'queue_depth': {
+				'mean': sum(depths) / len(depths) if depths else 0.0,
+				'max': max(depths, default=0),
+			},
+			'fanout_latency': {
+				'mean': self.total_fanout / self.events if self.events else 0.0,
+				'max': self.max_fanout,
+			},
+			'delivery_latency': {
+				'mean': self.total_delivery / self.delivered if self.delivered else 0.0,
+				'max': self.max_delivery,
+			},
 		}
-		for queue in self.queues:
-			await queue.put(event)
 
 	async def on_shutdown(self, app):
-		for queue in self.queues:
-			await queue.put({'event': Poison})
+		for queue in list(self.queues):
+			self.disconnect(queue)
 
 server = None
 srv = None
 handler = None
 app = None
+distributor = None
 
-async def main(loop):
-	global server, srv, app, handler
+async def main(loop, worker):
+	global server, srv, app, handler, distributor
 
-	try:
-		os.unlink(config['eventsocket'])
-	except FileNotFoundError:
-		pass
-	server = Server()
-	await server.start(config['eventsocket'], config['event_port'])
+	distributed = config['eventserver_workers'] > 1
+	server = Server(distributed=distributed)
+	if worker == 0:
+		try:
+			os.unlink(config['eventsocket'])
+		except FileNotFoundError:
+			pass
+		await server.start(config['eventsocket'], config['event_port'])
+		server.writer.start()
+	if distributed:
+		distributor = asyncio.ensure_future(server.distribute())
 	app = aiohttp.web.Application()
 	app.router.add_route('GET', '/api/v2/events', server.negotiate)
 	app.router.add_route('OPTIONS', '/api/v2/events', server.cors_preflight)
+	app.router.add_route('GET', '/api/v2/events/history', server.history)
+	app.router.add_route('OPTIONS', '/api/v2/events/history', server.cors_preflight)
 	app.on_shutdown.append(server.on_shutdown)
 
 	handler = app.make_handler()
-	srv = await loop.create_server(handler, 'localhost', 8080)
+	# With more than one worker, they all listen on the same port, and the kernel
+	# spreads the connections between them.
+	srv = await loop.create_server(handler, 'localhost', 8080, reuse_port=distributed)
 	if sys.platform == "win32":
 		# On Windows Ctrl+C doesn't interrupt `select()`.
 		def windows_is_butts():
 			loop.call_later(5, windows_is_butts)
 		windows_is_butts()
 
-async def cleanup():
-	global server, srv, app, handler
+async def cleanup(worker):
+	global server, srv, app, handler, distributor
 
 	srv.close()
-	await server.close()
+	if distributor is not None:
+		distributor.cancel()
+	if worker == 0:
+		await server.close()
+		await server.writer.close()
 	await srv.wait_closed()
 	await app.shutdown()
 	await handler.finish_connections(60.0)
 	await app.cleanup()
 
-loop = asyncio.new_event_loop()
-loop.run_until_complete(main(loop))
-try:
-	loop.run_forever()
-except KeyboardInterrupt:
-	pass
-finally:
-	loop.run_until_complete(cleanup())
-loop.close()
+def run(worker):
+	"""
+	Run one worker process. Only the first worker handles RPC calls.
+	"""
+	loop = asyncio.new_event_loop()
+	loop.run_until_complete(main(loop, worker))
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		loop.run_until_complete(cleanup(worker))
+	loop.close()
+
+if __name__ == '__main__':
+	workers = [
+		multiprocessing.Process(target=run, args=(worker,), daemon=True)
+		for worker in range(1, config['eventserver_workers'])
+	]
+	for process in workers:
+		process.start()
+	run(0)
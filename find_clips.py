@@ -12,7 +12,7 @@ import pytz
 import common.http
 import common.postgres
 from common.config import config
-from common.twitch import get_user, get_token
+from common.twitch import get_user, get_token, helix_request
 import sqlalchemy
 from sqlalchemy.dialects import postgresql
 import urllib.error
@@ -42,7 +42,7 @@ async def get_clips_page(channel, period=1, limit=100, cursor=None):
 	}
 	if cursor is not None:
 		params['after'] = cursor
-	data = await common.http.request(CLIPS_URL, params, headers=headers)
+	data = await helix_request(CLIPS_URL, params, headers=headers, priority=common.http.PRIORITY_LOW)
 	return json.loads(data)
 
 async def get_all_clips(channel, period=1, per_page=100):
@@ -69,7 +69,7 @@ async def get_clip_info(slug, check_missing=False):
 		'id': slug,
 	}
 	try:
-		data = await common.http.request(CLIPS_URL, params, headers=headers)
+		data = await helix_request(CLIPS_URL, params, headers=headers, priority=common.http.PRIORITY_LOW)
 	except urllib.error.HTTPError as e:
 		if e.code == 404 and check_missing:
 			return None
@@ -101,7 +101,7 @@ async def get_video_info(vodid):
 			'id': vodid,
 		}
 		try:
-			data = await common.http.request(VIDEO_URL, params, headers=headers)
+			data = await helix_request(VIDEO_URL, params, headers=headers, priority=common.http.PRIORITY_LOW)
 			get_video_info._cache[vodid] = json.loads(data)['data'][0]
 		except urllib.error.HTTPError as e:
 			if e.code == 404:
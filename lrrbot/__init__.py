@@ -17,6 +17,7 @@ from common import game_data
 from common import postgres
 from common import slack
 from common import state
+from common import storm
 from common import twitch
 from common import utils
 from common import youtube
@@ -24,6 +25,7 @@ from common.config import config
 from common.eventsub import EventSub
 from common.account_providers import ACCOUNT_PROVIDER_TWITCH, ACCOUNT_PROVIDER_YOUTUBE
 
+from lrrbot import accounts
 from lrrbot import asyncreactor
 from lrrbot import cardviewer
 from lrrbot import chatlog
@@ -59,12 +61,12 @@ class LRRBot(irc.bot.SingleServerIRCBot):
 
 	def __init__(self, loop):
 		self.engine, self.metadata = postgres.get_engine_and_metadata()
-		accounts = self.metadata.tables["accounts"]
+		accounts_table = self.metadata.tables["accounts"]
 		if config['password'] == "oauth":
 			with self.engine.connect() as conn:
-				row = conn.execute(sqlalchemy.select(accounts.c.access_token)
-					.where(accounts.c.provider == ACCOUNT_PROVIDER_TWITCH)
-					.where(accounts.c.name == config['username'])).first()
+				row = conn.execute(sqlalchemy.select(accounts_table.c.access_token)
+					.where(accounts_table.c.provider == ACCOUNT_PROVIDER_TWITCH)
+					.where(accounts_table.c.name == config['username'])).first()
 				if row is not None:
 					password, = row
 				else:
@@ -137,6 +139,12 @@ class LRRBot(irc.bot.SingleServerIRCBot):
 
 		self.spammers = {}
 
+		self.accounts = accounts.AccountCache(self.engine, self.metadata)
+		self.reactor.scheduler.execute_every(accounts.FLUSH_INTERVAL, self.accounts.flush)
+
+		self.storm = storm.StormCounter(self.engine, self.metadata)
+		self.reactor.scheduler.execute_every(storm.FLUSH_INTERVAL, self.storm.flush)
+
 		self.rpc_server = rpc.Server(self, loop)
 
 		self.chatlog = chatlog.ChatLog(self.engine, self.metadata)
@@ -190,6 +198,8 @@ class LRRBot(irc.bot.SingleServerIRCBot):
 			log.info("Bot shutting down...")
 			self.loop.run_until_complete(self.eventsub.stop())
 			self.loop.run_until_complete(self.rpc_server.close())
+			self.accounts.flush()
+			self.storm.flush()
 			self.chatlog.stop_task()
 			tasks_waiting = [chatlogtask]
 			if self.whisperconn:
@@ -315,68 +325,34 @@ class LRRBot(irc.bot.SingleServerIRCBot):
 			tags["display-name"] = tags.get("display-name", nick)
 			return
 
-		accounts = self.metadata.tables["accounts"]
-		with self.engine.connect() as db_conn:
-			if isinstance(conn, irc.client.ServerConnection):
-				if event.type == "pubmsg":
-					query = insert(accounts).returning(accounts.c.user_id)
-					query = query.on_conflict_do_update(
-						index_elements=[accounts.c.provider, accounts.c.provider_user_id],
-						set_={
-							'name': query.excluded.name,
-							'display_name': query.excluded.display_name,
-							'is_sub': query.excluded.is_sub,
-							'is_mod': query.excluded.is_mod,
-						},
-					)
-					user_data = {
-						"provider": ACCOUNT_PROVIDER_TWITCH,
-						"provider_user_id": tags["user-id"],
-						"name": nick,
-						"display_name": tags.get("display-name"),
-						"is_sub": is_sub,
-						"is_mod": is_mod,
-					}
-					user_id = db_conn.execute(query, user_data).scalar_one()
-				else:
-					row = db_conn.execute(sqlalchemy.select(accounts.c.user_id, accounts.c.is_sub, accounts.c.is_mod)
-										 .where(accounts.c.provider == ACCOUNT_PROVIDER_TWITCH)
-										 .where(accounts.c.provider_user_id == event.tags['user-id'])).first()
-					if row is not None:
-						user_id, tags['subscriber'], tags['mod'] = row
-					else:
-						user_id = None
-						tags['subscriber'] = False
-						tags['mod'] = False
-			elif isinstance(conn, youtube_chat.YoutubeChatConnection):
-				query = insert(accounts).returning(accounts.c.user_id)
-				query = query.on_conflict_do_update(
-					index_elements=[accounts.c.provider, accounts.c.provider_user_id],
-					set_={
-						'name': query.excluded.name,
-						'is_sub': query.excluded.is_sub,
-						'is_mod': query.excluded.is_mod,
-					}
-				)
-				user_data = {
-					"provider": ACCOUNT_PROVIDER_YOUTUBE,
-					"provider_user_id": tags["user-id"],
-					"name": tags['display-name'],
+		if isinstance(conn, irc.client.ServerConnection):
+			provider = ACCOUNT_PROVIDER_TWITCH
+			if event.type == "pubmsg":
+				account = self.accounts.update(provider, tags["user-id"], {
+					"name": nick,
+					"display_name": tags.get("display-name"),
 					"is_sub": is_sub,
 					"is_mod": is_mod,
-				}
-				user_id = db_conn.execute(query, user_data).scalar_one()
+				})
 			else:
-				user_id = None
-
-			if user_id is not None:
-				accounts = db_conn.execute(
-					sqlalchemy.select(accounts.c.provider, accounts.c.is_sub, accounts.c.is_mod)
-					.where(accounts.c.user_id == user_id)
-				).all()
-				tags['subscriber_anywhere'] = any(account.is_sub for account in accounts)
-				tags['mod_anywhere'] = any(account.is_mod for account in accounts)
-			db_conn.commit()
+				account = self.accounts.lookup(provider, tags["user-id"])
+				if account is not None:
+					tags['subscriber'], tags['mod'] = account['is_sub'], account['is_mod']
+				else:
+					tags['subscriber'] = False
+					tags['mod'] = False
+		elif isinstance(conn, youtube_chat.YoutubeChatConnection):
+			provider = ACCOUNT_PROVIDER_YOUTUBE
+			account = self.accounts.update(provider, tags["user-id"], {
+				"name": tags['display-name'],
+				"is_sub": is_sub,
+				"is_mod": is_mod,
+			})
+		else:
+			account = None
+
+		if account is not None and account['user_id'] is not None:
+			tags['subscriber_anywhere'], tags['mod_anywhere'] = self.accounts.anywhere(provider, tags["user-id"], account)
 
 		tags["display-name"] = tags.get("display-name", nick)
 
@@ -0,0 +1,197 @@
+import collections
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from common import twitch
+from common import utils
+from common.account_providers import ACCOUNT_PROVIDER_TWITCH
+
+log = logging.getLogger('accounts')
+
+CACHE_SIZE = 10000
+CACHE_EXPIRY = 10*60
+FLUSH_INTERVAL = 5
+
+class AccountCache:
+	"""
+	Bounded in-memory cache of the `accounts` table, keyed by provider and
+	provider user ID.
+
+	Chatters are usually seen many times in a row, so rather than writing their
+	details to the database on every message, the cached copy is compared
+	against what's in the message, and only changes are written, coalesced into
+	one batch every `FLUSH_INTERVAL` seconds.
+
+	Entries expire after `expiry` seconds, so that changes made by other
+	processes (eg linking accounts on the website) are eventually picked up.
+	"""
+
+	def __init__(self, engine, metadata, size=CACHE_SIZE, expiry=CACHE_EXPIRY):
+		self.engine = engine
+		self.metadata = metadata
+		self.size = size
+		self.expiry = expiry
+
+		self.entries = collections.OrderedDict()
+		self.pending = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.writes = 0
+
+	def _get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		if entry['expires'] < time.time():
+			del self.entries[key]
+			return None
+		self.entries.move_to_end(key)
+		return entry
+
+	def _store(self, key, entry):
+		entry['expires'] = time.time() + self.expiry
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	def _upsert_query(self, columns):
+		accounts = self.metadata.tables["accounts"]
+		query = insert(accounts)
+		return query.on_conflict_do_update(
+			index_elements=[accounts.c.provider, accounts.c.provider_user_id],
+			set_={column: query.excluded[column] for column in columns},
+		)
+
+	def _load_linked(self, conn, user_id):
+		if user_id is None:
+			return []
+		accounts = self.metadata.tables["accounts"]
+		return conn.execute(
+			sqlalchemy.select(accounts.c.provider, accounts.c.provider_user_id, accounts.c.is_sub, accounts.c.is_mod)
+			.where(accounts.c.user_id == user_id)
+		).all()
+
+	def update(self, provider, provider_user_id, data):
+		"""
+		Record the latest details for an account, as seen in chat.
+
+		`data` is a dict of the columns to update, eg `name` and `is_sub`. If the
+		account isn't cached it is written to the database immediately, otherwise
+		the write is deferred until the next `flush`, and skipped entirely if
+		nothing has changed.
+
+		Returns the cache entry for the account.
+		"""
+		key = (provider, provider_user_id)
+		entry = self._get(key)
+		if entry is not None:
+			self.hits += 1
+			if any(entry.get(column) != value for column, value in data.items()):
+				entry.update(data)
+				self.pending.setdefault(key, {'provider': provider, 'provider_user_id': provider_user_id}).update(data)
+			return entry
+
+		self.misses += 1
+		accounts = self.metadata.tables["accounts"]
+		# Anything still waiting to be written for this account is older than this.
+		self.pending.pop(key, None)
+		with self.engine.connect() as conn:
+			query = self._upsert_query(data.keys()).returning(accounts.c.user_id)
+			user_id = conn.execute(query, dict(data, provider=provider, provider_user_id=provider_user_id)).scalar_one()
+			linked = self._load_linked(conn, user_id)
+			if provider == ACCOUNT_PROVIDER_TWITCH and 'name' in data:
+				twitch.invalidate_user(conn, provider_user_id)
+			conn.commit()
+		self.writes += 1
+		entry = dict(data, user_id=user_id, linked=linked)
+		self._store(key, entry)
+		return entry
+
+	def lookup(self, provider, provider_user_id):
+		"""
+		Get the cache entry for an account, without updating it. Returns `None` if
+		the account isn't in the database.
+		"""
+		key = (provider, provider_user_id)
+		entry = self._get(key)
+		if entry is not None:
+			self.hits += 1
+			return entry
+
+		self.misses += 1
+		accounts = self.metadata.tables["accounts"]
+		with self.engine.connect() as conn:
+			row = conn.execute(
+				sqlalchemy.select(accounts.c.user_id, accounts.c.name, accounts.c.display_name, accounts.c.is_sub, accounts.c.is_mod)
+				.where(accounts.c.provider == provider)
+				.where(accounts.c.provider_user_id == provider_user_id)
+			).first()
+			if row is None:
+				return None
+			entry = {
+				'user_id': row.user_id,
+				'name': row.name,
+				'display_name': row.display_name,
+				'is_sub': row.is_sub,
+				'is_mod': row.is_mod,
+				'linked': self._load_linked(conn, row.user_id),
+			}
+		# Pending writes haven't made it to the database yet, so they're newer.
+		entry.update({
+			column: value
+			for column, value in self.pending.get(key, {}).items()
+			if column not in ('provider', 'provider_user_id')
+		})
+		self._store(key, entry)
+		return entry
+
+	def anywhere(self, provider, provider_user_id, entry):
+		"""
+		Check whether any of the accounts linked to this one is a subscriber or a
+		moderator. Returns a tuple `(is_sub, is_mod)`.
+		"""
+		is_sub = bool(entry['is_sub'])
+		is_mod = bool(entry['is_mod'])
+		for linked_provider, linked_id, linked_sub, linked_mod in entry['linked']:
+			if (linked_provider, linked_id) == (provider, provider_user_id):
+				# Use the cached values for this account, they may not have been written yet
+				continue
+			is_sub = is_sub or bool(linked_sub)
+			is_mod = is_mod or bool(linked_mod)
+		return is_sub, is_mod
+
+	@utils.swallow_errors
+	def flush(self):
+		"""
+		Write all the deferred account changes to the database.
+		"""
+		if not self.pending:
+			return
+		rows, self.pending = list(self.pending.values()), {}
+
+		batches = {}
+		for row in rows:
+			columns = tuple(sorted(column for column in row if column not in ('provider', 'provider_user_id')))
+			batches.setdefault(columns, []).append(row)
+
+		try:
+			with self.engine.connect() as conn:
+				for columns, batch in batches.items():
+					conn.execute(self._upsert_query(columns), batch)
+				for row in rows:
+					if row['provider'] == ACCOUNT_PROVIDER_TWITCH and 'name' in row:
+						twitch.invalidate_user(conn, row['provider_user_id'])
+				conn.commit()
+		except Exception:
+			# Put the changes back, with any that came in in the meantime taking priority.
+			for row in rows:
+				key = (row['provider'], row['provider_user_id'])
+				self.pending[key] = dict(row, **self.pending.get(key, {}))
+			raise
+		self.writes += len(batches)
+		log.debug("Wrote %d changed accounts, cache hits: %d, misses: %d", len(rows), self.hits, self.misses)
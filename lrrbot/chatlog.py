@@ -1,4 +1,6 @@
+import concurrent.futures
 import json
+import multiprocessing
 import re
 import pytz
 import datetime
@@ -12,6 +14,8 @@ from markupsafe import Markup, escape
 import sqlalchemy
 
 import common.http
+import common.postgres
+import common.state
 import common.twitch
 import common.url
 from common import utils
@@ -22,27 +26,101 @@ log = logging.getLogger('chatlog')
 CACHE_EXPIRY = 7*24*60*60
 PURGE_PERIOD = datetime.timedelta(minutes=5)
 
+# Start of the message text in the HTML for a chat log line
+MESSAGE_SPAN = '<span class="message">'
+
+# Seconds to wait before trying again when writing the chat log fails
+FLUSH_RETRY_INTERVAL = 5
+# Maximum number of chat log lines to hold on to while the database can't be written
+MAX_PENDING_ROWS = 10000
+
+# Number of message ids handled by each worker process in a rebuild
+REBUILD_CHUNK_SIZE = 10000
+# Number of rows to update in each query in a rebuild
+REBUILD_BATCH_SIZE = 1000
+# State key for the progress of an interrupted rebuild
+REBUILD_STATE_KEY = "lrrbot.chatlog.rebuild"
+
 queue = asyncio.Queue()
 
 def urlize(text):
 	return real_urlize(text).replace('<a ', '<a target="_blank" rel="noopener nofollow" ')
 
+def _is_transient(e):
+	"""Whether a database error is worth retrying, rather than a problem with the data."""
+	return isinstance(e, (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)) or getattr(e, 'connection_invalidated', False)
+
+def _rebuild_worker_init():
+	# Don't share the parent process's database connections, including the
+	# LISTEN connections for the state and Twitch user caches
+	common.postgres.after_fork()
+
+async def _rebuild_chunk(engine, metadata, start_id, end_id, since):
+	try:
+		return await ChatLog(engine, metadata).rebuild_range(start_id, end_id, since)
+	finally:
+		await common.http.close_http_request_sessions()
+
+def _rebuild_range(start_id, end_id, since):
+	engine, metadata = common.postgres.get_engine_and_metadata()
+	try:
+		return asyncio.run(_rebuild_chunk(engine, metadata, start_id, end_id, since))
+	finally:
+		# Don't keep connections open in idle workers between chunks
+		engine.dispose()
+
 class ChatLog:
-	def __init__(self, engine, metadata):
+	def __init__(self, engine, metadata, batch_size=None, batch_latency=None):
 		self.engine = engine
 		self.metadata = metadata
 
 		self.queue = asyncio.Queue()
 
+		# Chat lines are written to the database in batches of up to `batch_size`
+		# rows, waiting at most `batch_latency` seconds for a batch to fill up.
+		self.batch_size = max(batch_size or config['chatlog_batch_size'], 1)
+		if batch_latency is None:
+			batch_latency = config['chatlog_batch_latency'] / 1000
+		self.batch_latency = batch_latency
+		self.pending_rows = []
+		self.flush_failures = 0
+		self.max_queue_depth = 0
+
 	# Chat-log handling functions live in an asyncio task, so that functions that take
 	# a long time to run, like downloading the emote list, don't block the bot... but
 	# one master task, with a message queue, so that things still happen in the right order.
 	async def run_task(self):
+		loop = asyncio.get_running_loop()
+		deadline = None
 		while True:
-			ev, params = await self.queue.get()
+			item = await self._next_event(loop, deadline)
+			if item is None:
+				# Batch latency expired before the batch filled up.
+				await self.flush_log()
+				deadline = self._retry_deadline(loop)
+				continue
+
+			ev, params = item
 			if ev == "log_chat":
-				await self.do_log_chat(*params)
-			elif ev == "clear_chat_log":
+				row = await self.build_log_row(*params)
+				if row is not None:
+					if deadline is None:
+						deadline = loop.time() + self.batch_latency
+					self.pending_rows.append(row)
+				# While the database is failing, only retry on the deadline
+				if len(self.pending_rows) >= self.batch_size and not self.flush_failures:
+					await self.flush_log()
+					deadline = self._retry_deadline(loop)
+				continue
+
+			# Everything else needs to see the lines that came before it, so if they
+			# can't be written yet, wait until they can.
+			await self.flush_log()
+			while self.pending_rows and ev != "exit":
+				await asyncio.sleep(FLUSH_RETRY_INTERVAL)
+				await self.flush_log()
+			deadline = self._retry_deadline(loop)
+			if ev == "clear_chat_log":
 				await self.do_clear_chat_log(*params)
 			elif ev == "clear_chat_log_msg":
 				await self.do_clear_chat_log_msg(*params)
@@ -51,6 +129,34 @@ class ChatLog:
 			elif ev == "exit":
 				break
 
+	async def _next_event(self, loop, deadline):
+		"""
+		Get the next event from the queue, or `None` if `deadline` passes first.
+		"""
+		self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+		try:
+			return self.queue.get_nowait()
+		except asyncio.QueueEmpty:
+			pass
+		if deadline is None:
+			return await self.queue.get()
+		timeout = deadline - loop.time()
+		if timeout <= 0:
+			return None
+		try:
+			return await asyncio.wait_for(self.queue.get(), timeout)
+		except asyncio.TimeoutError:
+			return None
+
+	def _retry_deadline(self, loop):
+		"""
+		When to next try to write the chat log, if a flush failed and left lines
+		pending, or `None` if there's nothing waiting.
+		"""
+		if self.pending_rows:
+			return loop.time() + FLUSH_RETRY_INTERVAL
+		return None
+
 	def log_chat(self, event, metadata):
 		self.queue.put_nowait(("log_chat", (datetime.datetime.now(pytz.utc), event, metadata)))
 
@@ -60,38 +166,81 @@ class ChatLog:
 	def clear_chat_log_msg(self, msgid):
 		self.queue.put_nowait(("clear_chat_log_msg", (msgid,)))
 
-	def rebuild_all(self, period=7):
-		self.queue.put_nowait(("rebuild_all", (period,)))
+	def rebuild_all(self, period=7, workers=None, restart=False):
+		self.queue.put_nowait(("rebuild_all", (period, workers, restart)))
 
 	def stop_task(self):
 		self.queue.put_nowait(("exit", ()))
 
 	@utils.swallow_errors
-	async def do_log_chat(self, time, event, metadata):
+	async def build_log_row(self, time, event, metadata):
 		"""
-		Add a new message to the chat log.
+		Render a new message for the chat log. Returns the row to insert into the
+		`log` table, or `None` if the message shouldn't be logged.
 		"""
 		# Don't log blank lines or server commands like .timeout
 		message = event.arguments[0]
 		if not message or (message[0] in "./" and message[1:4].lower() != "me "):
-			return
+			return None
 
 		source = irc.client.NickMask(event.source).nick
 		html = await self.build_message_html(time, source, event.target, event.arguments[0], metadata.get('specialuser', []), metadata.get('usercolor'), metadata.get('emoteset', []), metadata.get('emotes'), metadata.get('display-name'))
+		return {
+			"time": time,
+			"source": source,
+			"target": event.target,
+			"message": event.arguments[0],
+			"specialuser": list(metadata.get('specialuser', [])),
+			"usercolor": metadata.get('usercolor'),
+			"emoteset": list(metadata.get('emoteset', [])),
+			"emotes": metadata.get('emotes'),
+			"displayname": metadata.get('display-name'),
+			"messagehtml": html,
+			"msgid": metadata.get('id'),
+		}
+
+	@utils.swallow_errors
+	async def flush_log(self):
+		"""
+		Add all the pending messages to the chat log, in a single multi-row INSERT.
+
+		If the database is unavailable, the messages are kept to try again later. If
+		the batch is rejected, the messages are written one at a time so only the
+		offending ones are lost.
+		"""
+		if not self.pending_rows:
+			return
+		rows, self.pending_rows = self.pending_rows, []
+		try:
+			await common.postgres.run(self._insert_rows, rows)
+		except Exception as e:
+			if _is_transient(e):
+				self._requeue(rows)
+				raise
+			log.exception("Failed to write %d lines to the chat log, retrying one at a time", len(rows))
+			for i, row in enumerate(rows):
+				try:
+					await common.postgres.run(self._insert_rows, [row])
+				except Exception as e:
+					if _is_transient(e):
+						self._requeue(rows[i:])
+						raise
+					log.exception("Dropping chat log line: %r", row)
+		self.flush_failures = 0
+		log.debug("Wrote %d lines to the chat log, %d events queued (max %d)", len(rows), self.queue.qsize(), self.max_queue_depth)
+
+	def _requeue(self, rows):
+		"""Put lines that couldn't be written back at the front of the queue."""
+		self.flush_failures += 1
+		self.pending_rows = rows + self.pending_rows
+		if len(self.pending_rows) > MAX_PENDING_ROWS:
+			dropped = len(self.pending_rows) - MAX_PENDING_ROWS
+			log.error("Chat log can't be written, dropping %d oldest lines", dropped)
+			del self.pending_rows[:dropped]
+
+	def _insert_rows(self, rows):
 		with self.engine.connect() as conn:
-			conn.execute(self.metadata.tables["log"].insert(), {
-				"time": time,
-				"source": source,
-				"target": event.target,
-				"message": event.arguments[0],
-				"specialuser": list(metadata.get('specialuser', [])),
-				"usercolor": metadata.get('usercolor'),
-				"emoteset": list(metadata.get('emoteset', [])),
-				"emotes": metadata.get('emotes'),
-				"displayname": metadata.get('display-name'),
-				"messagehtml": html,
-				"msgid": metadata.get('id'),
-			})
+			conn.execute(self.metadata.tables["log"].insert(), rows)
 			conn.commit()
 
 	@utils.swallow_errors
@@ -110,25 +259,69 @@ class ChatLog:
 		log = self.metadata.tables["log"]
 		await self._delete_messages((log.c.msgid == msgid))
 
-	async def _delete_messages(self, condition, undelete=False):
+	def _select_messages(self, condition):
 		log = self.metadata.tables["log"]
 		with self.engine.connect() as conn:
 			query = sqlalchemy.select(
 				log.c.id, log.c.time, log.c.source, log.c.target, log.c.message, log.c.specialuser,
 				log.c.usercolor, log.c.emoteset, log.c.emotes, log.c.displayname
 			).where(condition)
-			rows = conn.execute(query).fetchall()
+			return conn.execute(query).fetchall()
+
+	def _update_messages(self, new_rows):
+		log = self.metadata.tables["log"]
+		with self.engine.connect() as conn:
+			conn.execute(log.update().where(log.c.id == sqlalchemy.bindparam("_key")), new_rows)
+			conn.commit()
+
+	def _clear_messages(self, condition):
+		"""
+		Mark messages as deleted with a single UPDATE, building the "deleted" HTML
+		in the database rather than re-rendering each message.
+
+		This has to produce the same HTML as `build_message_html` does for a
+		message with the "cleared" flag: everything up to the message span is
+		kept, and the message itself is replaced by the escaped raw text.
+		"""
+		log = self.metadata.tables["log"]
+		is_action = sqlalchemy.func.lower(sqlalchemy.func.substr(log.c.message, 1, 4)).in_([".me ", "/me "])
+		text = sqlalchemy.case((is_action, sqlalchemy.func.substr(log.c.message, 5)), else_=log.c.message)
+		# Same as markupsafe.escape
+		for char, entity in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&#34;"), ("'", "&#39;")]:
+			text = sqlalchemy.func.replace(text, char, entity)
+		message_start = sqlalchemy.func.strpos(log.c.messagehtml, MESSAGE_SPAN, type_=sqlalchemy.Integer)
+		html = sqlalchemy.func.concat(
+			sqlalchemy.func.substr(log.c.messagehtml, 1, message_start - 1),
+			'<span class="deleted">&lt;message deleted&gt;</span><span class="message cleared">',
+			text,
+			'</span>',
+			sqlalchemy.case((is_action, '</span></div>'), else_='</div>'),
+		)
+		with self.engine.connect() as conn:
+			conn.execute(log.update()
+				.where(condition)
+				.where(message_start > 0)
+				.where(sqlalchemy.func.coalesce(sqlalchemy.func.array_position(log.c.specialuser, "cleared"), 0) == 0)
+				.values(
+					specialuser=sqlalchemy.func.array_append(log.c.specialuser, "cleared"),
+					messagehtml=html,
+				))
+			conn.commit()
+
+	async def _delete_messages(self, condition, undelete=False):
+		if not undelete:
+			await common.postgres.run(self._clear_messages, condition)
+			return
+
+		# Restoring the message needs the full renderer
+		rows = await common.postgres.run(self._select_messages, condition)
 		if len(rows) == 0:
 			return
 		new_rows = []
 		for key, time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname in rows:
 			specialuser = set(specialuser) if specialuser else set()
 			emoteset = set(emoteset) if emoteset else set()
-
-			if undelete:
-				specialuser.discard("cleared")
-			else:
-				specialuser.add("cleared")
+			specialuser.discard("cleared")
 
 			html = await self.build_message_html(time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname)
 			new_rows.append({
@@ -136,63 +329,130 @@ class ChatLog:
 				"messagehtml": html,
 				"_key": key,
 			})
-		with self.engine.connect() as conn:
-			conn.execute(log.update().where(log.c.id == sqlalchemy.bindparam("_key")), new_rows)
-			conn.commit()
+		await common.postgres.run(self._update_messages, new_rows)
 
 	@utils.swallow_errors
-	async def do_rebuild_all(self, period):
+	async def do_rebuild_all(self, period, workers=None, restart=False):
 		"""
 		Rebuild all the message HTML blobs in the database.
+
+		The messages are split into ranges of `REBUILD_CHUNK_SIZE` ids, which are
+		rebuilt in parallel by a pool of `workers` processes. Progress is saved
+		after each range, so an interrupted rebuild carries on from where it left
+		off next time, unless `restart` is set. If any range fails, the rest are
+		still rebuilt, and running the rebuild again retries the ones that failed.
+		"""
+		checkpoint = None if restart else common.state.get(self.engine, self.metadata, REBUILD_STATE_KEY)
+		if checkpoint is not None:
+			print("Resuming rebuild of messages since %s" % checkpoint['since'])
+		else:
+			since = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=period)
+			log_table = self.metadata.tables["log"]
+			with self.engine.connect() as conn:
+				min_id, max_id = conn.execute(sqlalchemy.select(sqlalchemy.func.min(log_table.c.id), sqlalchemy.func.max(log_table.c.id))
+					.where(log_table.c.time >= since)).first()
+			if min_id is None:
+				return
+			checkpoint = {
+				'since': since.isoformat(),
+				'min_id': min_id,
+				'max_id': max_id,
+				'done': [],
+			}
+			common.state.set(self.engine, self.metadata, REBUILD_STATE_KEY, checkpoint)
+
+		since = datetime.datetime.fromisoformat(checkpoint['since'])
+		done = set(checkpoint['done'])
+		chunks = [
+			start
+			for start in range(checkpoint['min_id'], checkpoint['max_id'] + 1, REBUILD_CHUNK_SIZE)
+			if start not in done
+		]
+
+		# Fetch these before starting the workers, so they inherit the cached copies
+		await get_twitch_emotes()
+		await get_cheermotes_data()
+
+		loop = asyncio.get_running_loop()
+		total_rows = total_changed = failed = 0
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=_rebuild_worker_init) as pool:
+			pending = {
+				loop.run_in_executor(pool, _rebuild_range, start, min(start + REBUILD_CHUNK_SIZE, checkpoint['max_id'] + 1), since): start
+				for start in chunks
+			}
+			print("\r%d/%d" % (len(done), len(done) + len(pending)), end='')
+			while pending:
+				finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+				for future in finished:
+					start = pending.pop(future)
+					try:
+						rows, changed = future.result()
+					except Exception:
+						failed += 1
+						log.exception("Failed to rebuild messages %d to %d", start, start + REBUILD_CHUNK_SIZE - 1)
+						continue
+					total_rows += rows
+					total_changed += changed
+					done.add(start)
+				checkpoint['done'] = sorted(done)
+				common.state.set(self.engine, self.metadata, REBUILD_STATE_KEY, checkpoint)
+				print("\r%d/%d" % (len(done), len(done) + len(pending)), end='')
+		print()
+		print("%d messages rebuilt, %d changed" % (total_rows, total_changed))
+		if failed:
+			# Keep the checkpoint, so running the rebuild again picks these up
+			raise Exception("Failed to rebuild %d of %d ranges" % (failed, len(chunks)))
+		common.state.delete(self.engine, self.metadata, REBUILD_STATE_KEY)
+
+	async def rebuild_range(self, start_id, end_id, since):
+		"""
+		Rebuild the message HTML blobs for messages with ids in `[start_id, end_id)`
+		that were sent after `since`. Only messages where the HTML has changed are
+		written back. Returns the number of messages, and how many changed.
 		"""
-		since = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=period)
 		log = self.metadata.tables["log"]
-		conn_select = self.engine.connect()
-		count, = conn_select.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(log).where(log.c.time >= since)).first()
-		rows = conn_select.execute(sqlalchemy.select(
-			log.c.id, log.c.time, log.c.source, log.c.target, log.c.message, log.c.specialuser,
-			log.c.usercolor, log.c.emoteset, log.c.emotes, log.c.displayname
-		).where(log.c.time >= since).execution_options(stream_results=True))
+		with self.engine.connect() as conn:
+			rows = conn.execute(sqlalchemy.select(
+				log.c.id, log.c.time, log.c.source, log.c.target, log.c.message, log.c.specialuser,
+				log.c.usercolor, log.c.emoteset, log.c.emotes, log.c.displayname, log.c.messagehtml
+			).where(log.c.id >= start_id).where(log.c.id < end_id).where(log.c.time >= since)).fetchall()
 
-		conn_update = self.engine.connect()
+		changed = []
+		for key, time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname, oldhtml in rows:
+			specialuser = set(specialuser) if specialuser else set()
+			emoteset = set(emoteset) if emoteset else set()
+			html = await self.build_message_html(time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname)
+			if html != oldhtml:
+				changed.append((key, html))
 
-		try:
-			for i, (key, time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname) in enumerate(rows):
-				if i % 100 == 0:
-					print("\r%d/%d" % (i, count), end='')
-				specialuser = set(specialuser) if specialuser else set()
-				emoteset = set(emoteset) if emoteset else set()
-				html = await self.build_message_html(time, source, target, message, specialuser, usercolor, emoteset, emotes, displayname)
-				conn_update.execute(log.update().where(log.c.id == key), {"messagehtml": html})
-			print("\r%d/%d" % (count, count))
-			conn_update.commit()
-		except:
-			conn_update.rollback()
-			raise
-		finally:
-			conn_select.close()
-			conn_update.close()
+		with self.engine.connect() as conn:
+			for i in range(0, len(changed), REBUILD_BATCH_SIZE):
+				new = sqlalchemy.values(
+					sqlalchemy.column("id", sqlalchemy.Integer),
+					sqlalchemy.column("messagehtml", sqlalchemy.Text),
+					name="new",
+				).data(changed[i:i + REBUILD_BATCH_SIZE])
+				conn.execute(log.update().where(log.c.id == new.c.id).values(messagehtml=new.c.messagehtml))
+			conn.commit()
+		return len(rows), len(changed)
 
 	async def format_message(self, message, emotes, emoteset, size="1", cheer=False):
 		if emotes is not None:
 			return await self.format_message_explicit_emotes(message, emotes, size=size, cheer=cheer)
 		else:
-			return await self.format_message_emoteset(message, (await get_filtered_emotes(emoteset)), cheer=cheer)
+			return await self.format_message_emoteset(message, (await get_emote_matcher(emoteset)), cheer=cheer)
 
 	async def format_message_emoteset(self, message, emotes, cheer=False):
-		ret = ""
-		stack = [(message, "")]
-		while len(stack) != 0:
-			prefix, suffix = stack.pop()
-			for emote in emotes:
-				parts = emote["regex"].split(prefix, 1)
-				if len(parts) >= 3:
-					stack.append((parts[-1], suffix))
-					stack.append((parts[0], Markup(emote["html"].format(escape(parts[1])))))
-					break
-			else:
-				ret += Markup(await self.format_message_cheer(prefix, cheer=cheer)) + suffix
-		return ret
+		bits = []
+		prev = 0
+		for start, end, html in emotes.find_all(message):
+			if prev < start:
+				bits.append(await self.format_message_cheer(message[prev:start], cheer=cheer))
+			bits.append(html.format(escape(message[start:end])))
+			prev = end
+		if prev < len(message) or not bits:
+			bits.append(await self.format_message_cheer(message[prev:], cheer=cheer))
+		return Markup(''.join(bits))
 
 	async def format_message_explicit_emotes(self, message, emotes, size="1", cheer=False):
 		if not emotes:
@@ -291,7 +551,7 @@ class ChatLog:
 			ret.append('<span class="message cleared">%s</span>' % escape(message))
 		else:
 			messagehtml = await self.format_message(message, emotes, emoteset, cheer='cheer' in specialuser)
-			ret.append('<span class="message">%s</span>' % messagehtml)
+			ret.append('%s%s</span>' % (MESSAGE_SPAN, messagehtml))
 
 		if is_action:
 			ret.append('</span>')
@@ -308,6 +568,7 @@ async def get_display_name(nick):
 		return nick
 
 re_just_words = re.compile(r"^\w+$")
+re_words = re.compile(r"\w+")
 @utils.cache(CACHE_EXPIRY)
 async def get_twitch_emotes():
 	"""
@@ -318,32 +579,104 @@ async def get_twitch_emotes():
 		"Client-ID": config['twitch_clientid'],
 		"Authorization": f"Bearer {await common.twitch.get_token()}",
 	}
-	data = await common.http.request("https://api.twitch.tv/helix/chat/emotes/set", headers=headers, data=[
+	data = await common.twitch.helix_request("https://api.twitch.tv/helix/chat/emotes/set", headers=headers, data=[
 		('emote_set_id', '0'), # global emotes
 		('emote_set_id', '317'), # LRR emotes
-	])
+	], cache=common.http.response_cache)
 	data = json.loads(data)["data"]
 	emotesets = {}
 	for emote in data:
 		emoticon_set = int(emote['emote_set_id'])
 		emotesets.setdefault(emoticon_set, {})[emote['name']] = {
-			"regex": re.compile(r"(\b%s\b)" % re.escape(emote['name'])),
 			"html": '<img src="%s" alt="{0}" title="{0}">' % emote["images"]['url_1x']
 		}
 	return emotesets
 
-async def get_filtered_emotes(setids):
+class EmoteMatcher:
+	"""
+	Finds every emote from a set of emotes in a message, in a single pass.
+
+	An emote matches wherever its name appears with word boundaries on either
+	side. For names that are entirely word characters that's exactly the
+	maximal runs of word characters, so those are found with a dict lookup on
+	each word in the message. The few names with other characters in them are
+	combined into one regex.
+
+	Boundaries are checked against the whole message. The old renderer split the
+	message around each emote it found and checked the pieces separately, so
+	whether both of two adjacent emotes like `R)Kappa` or `LUL<3` were linked
+	depended on the order of the emote list. Now both always are, and rebuilding
+	the chat log will update old messages like these to match. Where two emotes
+	overlap, the leftmost wins.
+	"""
+	def __init__(self, emotes):
+		self.words = {}
+		self.others = {}
+		for name, emote in emotes.items():
+			if re_just_words.match(name):
+				self.words[name] = emote["html"]
+			else:
+				self.others[name] = emote["html"]
+		if self.others:
+			# Longest first, so that eg ":-)" beats ":-" when they start at the same place
+			names = sorted(self.others, key=len, reverse=True)
+			self.re_others = re.compile(r"\b(?:%s)\b" % "|".join(map(re.escape, names)))
+		else:
+			self.re_others = None
+
+	def find_all(self, message):
+		"""
+		Yields `(start, end, html)` for each emote in the message, in order.
+		`html` is a format string, expecting the matched text as its argument.
+		"""
+		matches = [
+			(match.start(), match.end(), self.words[match.group()])
+			for match in re_words.finditer(message)
+			if match.group() in self.words
+		]
+		if self.re_others is not None:
+			matches.extend(
+				(match.start(), match.end(), self.others[match.group()])
+				for match in self.re_others.finditer(message)
+			)
+			matches.sort(key=lambda match: match[0])
+		prev = 0
+		for start, end, html in matches:
+			# Skip anything that overlaps an emote we've already found
+			if start >= prev:
+				yield start, end, html
+				prev = end
+
+_emote_matchers = {}
+_emote_matchers_source = None
+MAX_EMOTE_MATCHERS = 1000
+
+async def get_emote_matcher(setids):
+	"""
+	Get an `EmoteMatcher` for the global emotes plus the given emote sets.
+	Matchers are reused until the emote list is refreshed.
+	"""
+	global _emote_matchers_source
 	try:
 		emotesets = await get_twitch_emotes()
-		emotes = dict(emotesets[0])
-		for setid in setids:
-			emotes.update(emotesets.get(setid, {}))
-		return emotes.values()
 	except utils.PASSTHROUGH_EXCEPTIONS:
 		raise
 	except Exception:
 		log.exception("Error fetching emotes")
-		return []
+		return EmoteMatcher({})
+
+	if emotesets is not _emote_matchers_source or len(_emote_matchers) > MAX_EMOTE_MATCHERS:
+		_emote_matchers.clear()
+		_emote_matchers_source = emotesets
+
+	key = frozenset(setid for setid in setids if setid in emotesets)
+	matcher = _emote_matchers.get(key)
+	if matcher is None:
+		emotes = dict(emotesets.get(0, {}))
+		for setid in setids:
+			emotes.update(emotesets.get(setid, {}))
+		matcher = _emote_matchers[key] = EmoteMatcher(emotes)
+	return matcher
 
 @utils.cache(CACHE_EXPIRY)
 async def get_cheermotes_data():
@@ -352,7 +685,7 @@ async def get_cheermotes_data():
 		'Client-ID': config['twitch_clientid'],
 		'Authorization': f'Bearer {await common.twitch.get_token()}',
 	}
-	data = await common.http.request("https://api.twitch.tv/helix/bits/cheermotes", headers=headers)
+	data = await common.twitch.helix_request("https://api.twitch.tv/helix/bits/cheermotes", headers=headers, cache=common.http.response_cache)
 	data = json.loads(data)
 	cheermotes = {
 		action['prefix'].lower(): {
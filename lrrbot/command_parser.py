@@ -1,4 +1,6 @@
 import asyncio
+import hashlib
+import json
 import logging
 
 import irc.client
@@ -6,6 +8,7 @@ import irc.client
 from common import utils
 from common import command_parser
 from common.config import config
+import lrrbot.docstring
 from lrrbot.youtube_chat import YoutubeChatConnection
 
 log = logging.getLogger('command_parser')
@@ -15,9 +18,55 @@ class CommandParser(command_parser.CommandParser):
 		super().__init__(loop)
 		self.lrrbot = lrrbot
 
+		# Number of patterns each function is registered under
+		self.functions = {}
+		# function -> (docstring, parsed metadata)
+		self.parsed_docs = {}
+		# (version, list of command metadata), or None if it needs rebuilding
+		self.metadata = None
+
 		self.lrrbot.reactor.add_global_handler('pubmsg', self.on_message, 99)
 		self.lrrbot.reactor.add_global_handler('privmsg', self.on_message, 99)
 
+	def add(self, pattern, function):
+		super().add(pattern, function)
+		function = self.commands[self.normalise_pattern(pattern)]["func"]
+		if function not in self.functions:
+			self.functions[function] = 0
+			self.parsed_docs[function] = (function.__doc__, lrrbot.docstring.command_metadata(function.__doc__))
+			self.metadata = None
+		self.functions[function] += 1
+
+	def remove(self, pattern):
+		function = self.commands[self.normalise_pattern(pattern)]["func"]
+		super().remove(pattern)
+		self.functions[function] -= 1
+		if self.functions[function] == 0:
+			del self.functions[function]
+			self.parsed_docs.pop(function, None)
+			self.metadata = None
+
+	def get_command_metadata(self):
+		"""
+		Get the documentation for all the registered commands, as a tuple of a
+		version string and a list of dicts as returned by
+		`lrrbot.docstring.command_metadata`.
+
+		Docstrings are only parsed again when they change, and the version only
+		changes when the documentation does.
+		"""
+		changed = self.metadata is None
+		for function in self.functions:
+			doc, metadata = self.parsed_docs.get(function, (None, None))
+			if metadata is None or doc is not function.__doc__:
+				self.parsed_docs[function] = (function.__doc__, lrrbot.docstring.command_metadata(function.__doc__))
+				changed = True
+		if changed:
+			commands = [command for function in self.functions for command in self.parsed_docs[function][1]]
+			version = hashlib.sha1(json.dumps(commands, sort_keys=True).encode("utf-8")).hexdigest()
+			self.metadata = (version, commands)
+		return self.metadata
+
 	def register_blueprint(self, blueprint):
 		for pattern, func in blueprint.commands:
 			self.add(pattern, func)
@@ -27,7 +27,7 @@ def set_cardview(bot, conn, event, respond_to, youtube, setting):
 
 @blueprint.command(r"(?:card|mtg) (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def mtg_card_lookup(bot, conn, event, respond_to, search):
+async def mtg_card_lookup(bot, conn, event, respond_to, search):
 	"""
 	Command: !card card-name
 	Command: !mtg card-name
@@ -35,11 +35,11 @@ def mtg_card_lookup(bot, conn, event, respond_to, search):
 
 	Show the details of a given Magic: The Gathering card.
 	"""
-	real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_MTG)
+	await real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_MTG)
 
 @blueprint.command(r"(?:kf|keyforge) (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def keyforge_card_lookup(lrrbot, conn, event, respond_to, search):
+async def keyforge_card_lookup(lrrbot, conn, event, respond_to, search):
 	"""
 	Command: !keyforge card-name
 	Command: !kf card-name
@@ -47,11 +47,11 @@ def keyforge_card_lookup(lrrbot, conn, event, respond_to, search):
 
 	Show the details of a given KeyForge card.
 	"""
-	real_card_lookup(lrrbot, conn, event, respond_to, search, game=common.card.CARD_GAME_KEYFORGE)
+	await real_card_lookup(lrrbot, conn, event, respond_to, search, game=common.card.CARD_GAME_KEYFORGE)
 
 @blueprint.command(r"(?:pok[eé]mon|pok[eé]|pkmn|ptcg) (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def pokemon_card_lookup(lrrbot, conn, event, respond_to, search):
+async def pokemon_card_lookup(lrrbot, conn, event, respond_to, search):
 	"""
 	Command: !pokemon card-name
 	Command: !ptcg card-name
@@ -59,22 +59,22 @@ def pokemon_card_lookup(lrrbot, conn, event, respond_to, search):
 
 	Show the details of a given Pokémon TCG card.
 	"""
-	real_card_lookup(lrrbot, conn, event, respond_to, search, game=common.card.CARD_GAME_PTCG)
+	await real_card_lookup(lrrbot, conn, event, respond_to, search, game=common.card.CARD_GAME_PTCG)
 
 @blueprint.command(r"(?:lorcana) (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def lorcana_card_lookup(bot, conn, event, respond_to, search):
+async def lorcana_card_lookup(bot, conn, event, respond_to, search):
 	"""
 	Command: !lorcana card-name
 	Section: misc
 
 	Show the details of a given Disney Lorcana TCG card.
 	"""
-	real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_LORCANA)
+	await real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_LORCANA)
 
 @blueprint.command(r"altered(?:tcg)? (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def altered_card_lookup(bot, conn, event, respond_to, search):
+async def altered_card_lookup(bot, conn, event, respond_to, search):
 	"""
 	Command: !altered card-name
 	Command: !alteredtcg card-name
@@ -82,21 +82,21 @@ def altered_card_lookup(bot, conn, event, respond_to, search):
 
 	Show the details of a given Altered TCG card.
 	"""
-	real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_ALTERED)
+	await real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_ALTERED)
 
 @blueprint.command(r"riftbound (.+)")
 @lrrbot.decorators.throttle(60, count=3)
-def riftbound_card_lookup(bot, conn, event, respond_to, search):
+async def riftbound_card_lookup(bot, conn, event, respond_to, search):
 	"""
 	Command: !riftbound card-name
 	Section: misc
 
 	Show the details of a given Riftbound card.
 	"""
-	real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_RIFTBOUND)
+	await real_card_lookup(bot, conn, event, respond_to, search, game=common.card.CARD_GAME_RIFTBOUND)
 
-def real_card_lookup(bot, conn, event, respond_to, search, noerror=False, includehidden=False, game=common.card.CARD_GAME_MTG):
-	cards = find_card(bot, search, includehidden, game)
+async def real_card_lookup(bot, conn, event, respond_to, search, noerror=False, includehidden=False, game=common.card.CARD_GAME_MTG):
+	cards = await common.postgres.run(find_card, bot, search, includehidden, game)
 
 	if noerror and len(cards) != 1:
 		return
@@ -10,7 +10,6 @@ import sqlalchemy
 
 import common.http
 import common.time
-import common.storm
 import lrrbot.decorators
 from common import googlecalendar
 from common import utils
@@ -40,27 +39,19 @@ def stormcount(bot, conn, event, respond_to):
 
 	Show the current storm counts.
 	"""
-	twitch_subscription = common.storm.get(bot.engine, bot.metadata, 'twitch-subscription')
-	twitch_resubscription = common.storm.get(bot.engine, bot.metadata, 'twitch-resubscription')
-	twitch_follow = common.storm.get(bot.engine, bot.metadata, 'twitch-follow')
-	twitch_cheer = common.storm.get(bot.engine, bot.metadata, 'twitch-cheer')
-	patreon_pledge = common.storm.get(bot.engine, bot.metadata, 'patreon-pledge')
-	youtube_membership = common.storm.get(bot.engine, bot.metadata, 'youtube-membership')
-	youtube_membership_milestone = common.storm.get(bot.engine, bot.metadata, 'youtube-membership-milestone')
-	youtube_super_chat = common.storm.get(bot.engine, bot.metadata, 'youtube-super-chat')
-	youtube_super_sticker = common.storm.get(bot.engine, bot.metadata, 'youtube-super-sticker')
-	storm_count = common.storm.get_combined(bot.engine, bot.metadata)
+	counts = bot.storm.get_all()
+	storm_count = bot.storm.get_combined()
 	conn.privmsg(respond_to, "Today's storm count: %d (new subscribers: %d, returning subscribers: %d, new patrons: %d, new YouTube members: %d, returning Youtube members: %d), bits cheered: %d, new followers: %d, YouTube super chats: %d, YouTube super stickers: %d" % (
 		storm_count,
-		twitch_subscription,
-		twitch_resubscription,
-		patreon_pledge,
-		youtube_membership,
-		youtube_membership_milestone,
-		twitch_cheer,
-		twitch_follow,
-		youtube_super_chat,
-		youtube_super_sticker,
+		counts['twitch-subscription'],
+		counts['twitch-resubscription'],
+		counts['patreon-pledge'],
+		counts['youtube-membership'],
+		counts['youtube-membership-milestone'],
+		counts['twitch-cheer'],
+		counts['twitch-follow'],
+		counts['youtube-super-chat'],
+		counts['youtube-super-sticker'],
 	))
 
 @blueprint.command(r"spam(?:count)?")
@@ -40,10 +40,20 @@ def format_quote(tag, qid, quote, name, date, context):
 		quote_msg += " [{date!s}]".format(date=date)
 	return quote_msg
 
+def pick_random_row(engine, query):
+	with engine.connect() as pg_conn:
+		return common.utils.pick_random_elements(pg_conn.execute(query), 1)[0]
+
+def insert_quote(engine, quotes, data):
+	with engine.connect() as pg_conn:
+		qid, = pg_conn.execute(quotes.insert().returning(quotes.c.id), data).first()
+		pg_conn.commit()
+	return qid
+
 @blueprint.command(r"quote(?: (?:(game|show) (.+)|(?:(\d+)|(.+))))?")
 @lrrbot.decorators.sub_only
 @lrrbot.decorators.throttle(60, count=2)
-def quote(bot, conn, event, respond_to, meta_param, meta_value, qid, attrib):
+async def quote(bot, conn, event, respond_to, meta_param, meta_value, qid, attrib):
 	"""
 	Command: !quote
 	Command: !quote ATTRIB
@@ -75,8 +85,7 @@ def quote(bot, conn, event, respond_to, meta_param, meta_value, qid, attrib):
 	elif attrib:
 		query = query.where(quotes.c.attrib_name.ilike("%" + common.postgres.escape_like(attrib.lower()) + "%"))
 	query = query.select_from(source).where(~quotes.c.deleted)
-	with bot.engine.connect() as pg_conn:
-		row = common.utils.pick_random_elements(pg_conn.execute(query), 1)[0]
+	row = await common.postgres.run(pick_random_row, bot.engine, query)
 	if row is None:
 		conn.privmsg(respond_to, "Could not find any matching quotes.")
 		return
@@ -105,16 +114,14 @@ async def addquote(bot, conn, event, respond_to, name, date, quote, context):
 	quotes = bot.metadata.tables["quotes"]
 	game_id = await bot.get_game_id()
 	show_id = bot.get_show_id()
-	with bot.engine.connect() as pg_conn:
-		qid, = pg_conn.execute(quotes.insert().returning(quotes.c.id), {
-			"quote": quote,
-			"attrib_name": name,
-			"attrib_date": date,
-			"context": context,
-			"game_id": game_id,
-			"show_id": show_id,
-		}).first()
-		pg_conn.commit()
+	qid = await common.postgres.run(insert_quote, bot.engine, quotes, {
+		"quote": quote,
+		"attrib_name": name,
+		"attrib_date": date,
+		"context": context,
+		"game_id": game_id,
+		"show_id": show_id,
+	})
 
 	conn.privmsg(respond_to, format_quote("New quote", qid, quote, name, date, context))
 
@@ -1,13 +1,13 @@
-import itertools
+import collections
 import logging
 import aiomas
+import random
 import re
 import irc.client
 import sqlalchemy
 
 import lrrbot.decorators
 from common.config import config
-import common.utils
 from lrrbot.command_parser import Blueprint
 
 blueprint = Blueprint()
@@ -17,104 +17,126 @@ ACCESS_ANY = 0
 ACCESS_SUB = 1
 ACCESS_MOD = 2
 
-def _get_command_id(bot, conn, command):
+# Snapshot of all the static commands, so that responding to them doesn't need
+# to touch the database. It is never modified, only replaced as a whole by
+# `generate_hook` when the commands are edited.
+#   ids - alias -> command ID
+#   aliases - command ID -> list of aliases
+#   access - command ID -> access level
+#   responses - command ID -> list of responses
+Catalog = collections.namedtuple('Catalog', ['ids', 'aliases', 'access', 'responses'])
+catalog = Catalog({}, {}, {}, {})
+
+def load_catalog(bot):
+	commands = bot.metadata.tables["commands"]
+	aliases = bot.metadata.tables["commands_aliases"]
+	responses = bot.metadata.tables["commands_responses"]
+
+	with bot.engine.connect() as conn:
+		access = dict(conn.execute(sqlalchemy.select(commands.c.id, commands.c.access)).all())
+		alias_rows = conn.execute(
+			sqlalchemy.select(aliases.c.command_id, aliases.c.alias)
+				.order_by(aliases.c.command_id, aliases.c.id)
+		).all()
+		response_rows = conn.execute(
+			sqlalchemy.select(responses.c.command_id, responses.c.response)
+				.order_by(responses.c.command_id, responses.c.id)
+		).all()
+
+	command_aliases = {}
+	for command_id, alias in alias_rows:
+		command_aliases.setdefault(command_id, []).append(alias)
+	command_responses = {}
+	for command_id, response in response_rows:
+		command_responses.setdefault(command_id, []).append(response)
+
+	return Catalog(
+		ids={alias: command_id for command_id, alias in alias_rows},
+		aliases=command_aliases,
+		access=access,
+		responses=command_responses,
+	)
+
+def _get_command_id(catalog, command):
 	if isinstance(command, int):
 		return command
 	else:
-		command = " ".join(command.lower().split())
-		aliases = bot.metadata.tables["commands_aliases"]
-		query = sqlalchemy.select(aliases.c.command_id).where(aliases.c.alias == command)
-		return conn.execute(query).scalar()
+		return catalog.ids.get(" ".join(command.lower().split()))
 
 def get_response(bot, command):
-	responses = bot.metadata.tables["commands_responses"]
-
-	with bot.engine.connect() as conn:
-		command_id = _get_command_id(bot, conn, command)
-		if command_id is None:
-			return None
-
-		query = sqlalchemy.select(responses.c.response).where(responses.c.command_id == command_id)
-		return common.utils.pick_random_elements(conn.execute(query).scalars(), 1)[0]
-
-def generate_docstring(bot):
-	commands = bot.metadata.tables["commands"]
-	aliases = bot.metadata.tables["commands_aliases"]
-	responses = bot.metadata.tables["commands_responses"]
+	snapshot = catalog
+	responses = snapshot.responses.get(_get_command_id(snapshot, command))
+	if not responses:
+		return None
+	return random.choice(responses)
 
+def generate_docstring(catalog):
 	def generator():
-		with bot.engine.connect() as conn:
-			query = sqlalchemy.select(commands.c.id, commands.c.access, aliases.c.alias)
-			query = query.select_from(commands.join(aliases, aliases.c.command_id == commands.c.id))
-			query = query.order_by(commands.c.id, aliases.c.id)
-
-			first = True
-			for command_id, rows in itertools.groupby(conn.execute(query), key=lambda row:row[0]):
-				if not first:
-					yield "--command"
-				first = False
-
-				for _, access, alias in rows:
-					yield f"Command: {config['commandprefix']}{alias}"
-				yield "Throttled: 30"
-				yield "Throttle-Count: 2"
-				yield "Literal-Response: true"
-				if access == ACCESS_SUB:
-					yield "Sub-Only: true"
-				elif access == ACCESS_MOD:
-					yield "Mod-Only: true"
-				yield "Section: text"
-				yield ""
-
-				resp_query = sqlalchemy.select(responses.c.response).where(responses.c.command_id == command_id)
-				resp_query = resp_query.order_by(responses.c.id).limit(1)
-				yield conn.execute(resp_query).scalar()
+		first = True
+		for command_id, aliases in sorted(catalog.aliases.items()):
+			if not first:
+				yield "--command"
+			first = False
+
+			for alias in aliases:
+				yield f"Command: {config['commandprefix']}{alias}"
+			yield "Throttled: 30"
+			yield "Throttle-Count: 2"
+			yield "Literal-Response: true"
+			access = catalog.access.get(command_id)
+			if access == ACCESS_SUB:
+				yield "Sub-Only: true"
+			elif access == ACCESS_MOD:
+				yield "Mod-Only: true"
+			yield "Section: text"
+			yield ""
+
+			yield catalog.responses.get(command_id, [""])[0]
 
 	return "\n".join(generator())
 
-def generate_expression(bot):
-	aliases = bot.metadata.tables["commands_aliases"]
-	with bot.engine.connect() as conn:
-		query = sqlalchemy.select(aliases.c.alias)
-		aliases = conn.execute(query).scalars().all()
-	return "(%s)" % "|".join(re.escape(c).replace("\\ ", " ") for c in aliases)
+def generate_expression(alias):
+	return "(%s)" % re.escape(alias).replace("\\ ", " ")
 
-@lrrbot.decorators.throttle(30, params=[4], count=2)
-def static_response(bot, conn, event, respond_to, command):
-	commands = bot.metadata.tables["commands"]
+def get_access_and_response(bot, command):
+	snapshot = catalog
+	command_id = _get_command_id(snapshot, command)
+	if command_id is None:
+		return None, None
+	return snapshot.access.get(command_id), get_response(bot, command_id)
 
-	with bot.engine.connect() as dbconn:
-		command_id = _get_command_id(bot, dbconn, command)
-		if command_id is None:
+@lrrbot.decorators.throttle(30, params=[4], count=2)
+async def static_response(bot, conn, event, respond_to, command):
+	access, response = get_access_and_response(bot, command)
+	if response is None:
+		return
+
+	source = irc.client.NickMask(event.source)
+	if access == ACCESS_SUB:
+		if not bot.is_sub(event) and not bot.is_mod(event):
+			log.info("Refusing %s due to inadequate access" % command)
+			conn.privmsg(source.nick, "That is a sub-only command.")
 			return
-
-		query = sqlalchemy.select(commands.c.access).where(commands.c.id == command_id)
-		access = dbconn.execute(query).scalar()
-		source = irc.client.NickMask(event.source)
-		if access == ACCESS_SUB:
-			if not bot.is_sub(event) and not bot.is_mod(event):
-				log.info("Refusing %s due to inadequate access" % command)
-				conn.privmsg(source.nick, "That is a sub-only command.")
-				return
-		if access == ACCESS_MOD:
-			if not bot.is_mod(event):
-				log.info("Refusing %s due to inadequate access" % command)
-				conn.privmsg(source.nick, "That is a mod-only command.")
-				return
-
-		response = get_response(bot, command_id)
-		if response is None:
+	if access == ACCESS_MOD:
+		if not bot.is_mod(event):
+			log.info("Refusing %s due to inadequate access" % command)
+			conn.privmsg(source.nick, "That is a mod-only command.")
 			return
+
 	conn.privmsg(respond_to, response.format(user=event.tags.get('display-name') or source.nick))
 
-command_expression = None
 def generate_hook(bot):
-	global command_expression
-	if command_expression is not None:
-		bot.commands.remove(command_expression)
-	static_response.__doc__ = generate_docstring(bot)
-	command_expression = generate_expression(bot)
-	bot.commands.add(command_expression, static_response)
+	global catalog
+	old_catalog, catalog = catalog, load_catalog(bot)
+	static_response.__doc__ = generate_docstring(catalog)
+	# Each alias is registered as its own command, so that only the aliases that
+	# actually changed need to be touched.
+	old_aliases = set(old_catalog.ids)
+	new_aliases = set(catalog.ids)
+	for alias in old_aliases - new_aliases:
+		bot.commands.remove(generate_expression(alias))
+	for alias in new_aliases - old_aliases:
+		bot.commands.add(generate_expression(alias), static_response)
 
 @blueprint.on_init
 def register(bot):
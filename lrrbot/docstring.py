@@ -23,3 +23,26 @@ def add_header(doc, name, value):
 		if part.get_content_maintype() != "multipart":
 			part[name] = value
 	return doc
+
+def command_metadata(docstring):
+	"""
+	Parse a command's docstring into a list of dicts describing each of the
+	commands it documents, as shown on the help page.
+	"""
+	ret = []
+	for cmd in parse_docstring(docstring).walk():
+		if cmd.get_content_maintype() == "multipart":
+			continue
+		if cmd.get_all("command") is None:
+			continue
+		ret.append({
+			"aliases": cmd.get_all("command"),
+			"mod-only": cmd.get("mod-only") == "true",
+			"sub-only": cmd.get("sub-only") == "true",
+			"public-only": cmd.get("public-only") == "true",
+			"throttled": (int(cmd.get("throttle-count", 1)), int(cmd.get("throttled"))) if "throttled" in cmd else None,
+			"literal-response": cmd.get("literal-response") == "true",
+			"section": cmd.get("section"),
+			"description": cmd.get_payload(),
+		})
+	return ret
@@ -10,7 +10,6 @@ from common import utils
 from common.config import config
 from common import twitch
 from lrrbot import storage
-import lrrbot.docstring
 from lrrbot.commands.static import get_response
 
 log = logging.getLogger('serverevents')
@@ -59,25 +58,21 @@ class Server(common.rpc.Server):
 
 	@aiomas.expose
 	def get_commands(self):
-		ret = []
-		for command in self.lrrbot.commands.commands.values():
-			doc = lrrbot.docstring.parse_docstring(command['func'].__doc__)
-			for cmd in doc.walk():
-				if cmd.get_content_maintype() == "multipart":
-					continue
-				if cmd.get_all("command") is None:
-					continue
-				ret += [{
-					"aliases": cmd.get_all("command"),
-					"mod-only": cmd.get("mod-only") == "true",
-					"sub-only": cmd.get("sub-only") == "true",
-					"public-only": cmd.get("public-only") == "true",
-					"throttled": (int(cmd.get("throttle-count", 1)), int(cmd.get("throttled"))) if "throttled" in cmd else None,
-					"literal-response": cmd.get("literal-response") == "true",
-					"section": cmd.get("section"),
-					"description": cmd.get_payload(),
-				}]
-		return ret
+		version, commands = self.lrrbot.commands.get_command_metadata()
+		return commands
+
+	@aiomas.expose
+	def get_commands_if_changed(self, version):
+		"""
+		Get the command list, if it's changed since `version`. Returns a dict with
+		the current `version`, and the `commands` list, or `None` if the caller's
+		copy is still current.
+		"""
+		current_version, commands = self.lrrbot.commands.get_command_metadata()
+		return {
+			"version": current_version,
+			"commands": commands if current_version != version else None,
+		}
 
 	@aiomas.expose
 	async def get_header_info(self):
@@ -15,10 +15,7 @@ class Spam:
 	def __init__(self, lrrbot, loop):
 		self.loop = loop
 		self.lrrbot = lrrbot
-		self.rules = [
-			(common.spam.compile_rule(rule), rule["message"], rule.get('type', 'spam'))
-			for rule in storage.data.get("spam_rules", [])
-		]
+		self.rules = common.spam.RuleSet(storage.data.get("spam_rules", []))
 		self.lrrbot.rpc_server.spam = self
 		self.lrrbot.reactor.add_global_handler("pubmsg", self.check_spam, 20)
 
@@ -27,22 +24,19 @@ class Spam:
 		log.info("Setting spam rules to %r" % (data,))
 		storage.data['spam_rules'] = data
 		storage.save()
-		self.rules = [
-			(common.spam.compile_rule(rule), rule['message'], rule.get('type', 'spam'))
-			for rule in storage.data['spam_rules']
-		]
+		self.rules = common.spam.RuleSet(storage.data['spam_rules'])
 
 	def check_spam(self, conn, event):
 		"""Check the message against spam detection rules"""
 		message = event.arguments[0]
 		source = irc.client.NickMask(event.source)
 
-		for re, desc, type in self.rules:
-			matches = re.search(message)
-			if matches:
-				log.info("Detected spam from %s - %r matches %s" % (source.nick, message, re.pattern))
-				groups = {str(i+1):v for i,v in enumerate(matches.groups())}
-				desc = desc % groups
-				asyncio.ensure_future(self.lrrbot.ban(conn, event, desc, type), loop=self.loop).add_done_callback(utils.check_exception)
-				# Halt message handling
-				return "NO MORE"
+		result = self.rules.search(message)
+		if result is not None:
+			rule, matches = result
+			log.info("Detected spam from %s - %r matches %s" % (source.nick, message, rule['pattern'].pattern))
+			groups = {str(i+1):v for i,v in enumerate(matches.groups())}
+			desc = rule['message'] % groups
+			asyncio.ensure_future(self.lrrbot.ban(conn, event, desc, rule.get('type', 'spam')), loop=self.loop).add_done_callback(utils.check_exception)
+			# Halt message handling
+			return "NO MORE"
@@ -3,7 +3,7 @@ import asyncio
 import irc.client
 import sqlalchemy
 
-from common import utils, twitch
+from common import postgres, utils, twitch
 from common.config import config
 
 INITIAL_DELAY = 15
@@ -38,10 +38,10 @@ class Timers:
 		if self.lrrbot.youtube_chat:
 			await self.lrrbot.youtube_chat.broadcast_message(message)
 
-	async def check_timers(self):
+	def _claim_expired_timers(self):
 		timers = self.lrrbot.metadata.tables['timers']
 		with self.lrrbot.engine.begin() as conn:
-			expired_timers = conn.execute(
+			return conn.execute(
 				timers.update()
 					.values(last_run=sqlalchemy.func.current_timestamp())
 					.where(
@@ -51,7 +51,9 @@ class Timers:
 					.where(timers.c.enabled)
 					.returning(timers.c.mode, timers.c.message)
 			).all()
-			conn.commit()
+
+	async def check_timers(self):
+		expired_timers = await postgres.run(self._claim_expired_timers)
 
 		for mode, message in expired_timers:
 			if mode == 'command':
@@ -1,6 +1,5 @@
 import asyncio
 import common.rpc
-import common.storm
 from common import utils
 
 import logging
@@ -27,7 +26,7 @@ class TwitchCheer:
 			'message': event.arguments[0],
 			'messagehtml': await self.lrrbot.chatlog.format_message(event.arguments[0], event.tags.get('emotes'), event.tags.get('emoteset', []), cheer=True),
 			'bits': event.tags['bits'],
-			'count': common.storm.increment(self.lrrbot.engine, self.lrrbot.metadata, eventname, event.tags['bits']),
+			'count': self.lrrbot.storm.increment(eventname, event.tags['bits']),
 			'level': self.get_level(event.tags['bits']),
 		}
 
@@ -1,7 +1,6 @@
 import asyncio
 
 from common import rpc
-from common import storm
 from common import twitch
 from common import utils
 import dateutil.parser
@@ -53,6 +52,6 @@ class TwitchFollows:
 				timestamp = dateutil.parser.parse(timestamp)
 				event = {
 					'name': name,
-					'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'twitch-follow'),
+					'count': self.lrrbot.storm.increment('twitch-follow'),
 				}
 				await rpc.eventserver.event('twitch-follow', event, timestamp)
@@ -8,7 +8,6 @@ from common import utils
 from common.config import config
 from common import twitch
 import common.rpc
-import common.storm
 from common.account_providers import ACCOUNT_PROVIDER_TWITCH
 
 log = logging.getLogger('twitchnotify')
@@ -208,10 +207,10 @@ class TwitchNotify:
 		if monthcount > 1:
 			event = "twitch-resubscription"
 			data['monthcount'] = monthcount
-			data['count'] = common.storm.increment(self.lrrbot.engine, self.lrrbot.metadata, event)
+			data['count'] = self.lrrbot.storm.increment(event)
 		else:
 			event = "twitch-subscription"
-			data['count'] = common.storm.increment(self.lrrbot.engine, self.lrrbot.metadata, event)
+			data['count'] = self.lrrbot.storm.increment(event)
 
 		if tier is not None:
 			data['tier'] = tier
@@ -226,7 +225,7 @@ class TwitchNotify:
 				await self.on_multi_gift_end(conn, channel, multi_gift)
 		else:
 			data['ismulti'] = False
-			storm_count = common.storm.get_combined(self.lrrbot.engine, self.lrrbot.metadata)
+			storm_count = self.lrrbot.storm.get_combined()
 			conn.privmsg(channel, "lrrSPOT Thanks for subscribing, %s! (Today's storm count: %d)" % (data['name'], storm_count))
 
 		await common.rpc.eventserver.event(event, data, eventtime)
@@ -275,7 +274,7 @@ class TwitchNotify:
 			names[-1] = "and " + names[-1]
 			names = ", ".join(names)
 
-		storm_count = common.storm.get_combined(self.lrrbot.engine, self.lrrbot.metadata)
+		storm_count = self.lrrbot.storm.get_combined()
 
 		welcomemsg = "lrrSPOT Thanks for the gift%s, %s! Welcome to %s! (Today's storm count: %d)" % (
 			'' if multi_gift['subcount'] == 1 else 's',
@@ -330,7 +329,7 @@ class TwitchNotify:
 
 		await common.rpc.eventserver.event(event, data, eventtime)
 
-		common.storm.increment(self.lrrbot.engine, self.lrrbot.metadata, event)
+		self.lrrbot.storm.increment(event)
 
 	async def on_unknown_message(self, conn, eventtime, message):
 		event = "twitch-message"
@@ -7,7 +7,7 @@ from urllib.error import HTTPError
 import irc.client
 
 import common.rpc
-from common import utils, state, storm, slack, time
+from common import utils, state, slack, time
 from common import youtube
 from common.config import config
 
@@ -263,12 +263,12 @@ class YoutubeChat:
 			'avatar': message['authorDetails']['profileImageUrl'],
 			'tier': message['snippet']['newSponsorDetails'].get('memberLevelName'),
 			'is_upgrade': message['snippet']['newSponsorDetails'].get('isUpgrade'),
-			'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'youtube-membership'),
+			'count': self.lrrbot.storm.increment('youtube-membership'),
 		}
 
 		await common.rpc.eventserver.event('youtube-membership', data, time)
 
-		storm_count = common.storm.get_combined(self.lrrbot.engine, self.lrrbot.metadata)
+		storm_count = self.lrrbot.storm.get_combined()
 		await youtube.send_chat_message(
 			config['youtube_bot_id'], chat_id,
 			f"Thanks for becoming a channel member, {data['name']}! (Today's storm count: {storm_count})",
@@ -299,12 +299,12 @@ class YoutubeChat:
 			'tier': message['snippet']['memberMilestoneChatDetails'].get('memberLevelName'),
 			'monthcount': message['snippet']['memberMilestoneChatDetails']['memberMonth'],
 			'message': message['snippet']['memberMilestoneChatDetails'].get('userComment'),
-			'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'youtube-membership-milestone'),
+			'count': self.lrrbot.storm.increment('youtube-membership-milestone'),
 		}
 
 		await common.rpc.eventserver.event('youtube-membership-milestone', data, time)
 
-		storm_count = common.storm.get_combined(self.lrrbot.engine, self.lrrbot.metadata)
+		storm_count = self.lrrbot.storm.get_combined()
 		await youtube.send_chat_message(
 			config['youtube_bot_id'], chat_id,
 			f"Thanks for being a channel member, {data['name']}! (Today's storm count: {storm_count})",
@@ -377,7 +377,7 @@ class YoutubeChat:
 			'benefactor': self.pending_gifts[gift_id]['name'],
 			'tier': message['snippet']['giftMembershipReceivedDetails'].get('memberLevelName'),
 			'ismulti': self.pending_gifts[gift_id]['count'] > 1,
-			'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'youtube-membership'),
+			'count': self.lrrbot.storm.increment('youtube-membership'),
 		}
 
 		await common.rpc.eventserver.event('youtube-membership', data, time)
@@ -399,7 +399,7 @@ class YoutubeChat:
 		time = data.pop('time')
 		await common.rpc.eventserver.event('youtube-membership-gift', data, time)
 
-		storm_count = common.storm.get_combined(self.lrrbot.engine, self.lrrbot.metadata)
+		storm_count = self.lrrbot.storm.get_combined()
 
 		if len(data['members']) == 1:
 			message = f"Thanks for the gift, {data['name']}! Welcome to {data['members'][0]['name']}! (Today's storm count: {storm_count})",
@@ -430,7 +430,7 @@ class YoutubeChat:
 			'amount_currency': message['snippet']['superChatDetails']['currency'],
 			'level': message['snippet']['superChatDetails']['tier'],
 			'message': message['snippet']['superChatDetails'].get('userComment'),
-			'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'youtube-super-chat'),
+			'count': self.lrrbot.storm.increment('youtube-super-chat'),
 		}
 
 		await common.rpc.eventserver.event('youtube-super-chat', data, time)
@@ -467,7 +467,7 @@ class YoutubeChat:
 			'sticker_url': sticker_urls.get(message['snippet']['superStickerDetails']['superStickerMetadata']['stickerId']),
 			'alt_text': message['snippet']['superStickerDetails']['superStickerMetadata']['altText'],
 			'alt_text_language': message['snippet']['superStickerDetails']['superStickerMetadata']['language'],
-			'count': storm.increment(self.lrrbot.engine, self.lrrbot.metadata, 'youtube-super-sticker'),
+			'count': self.lrrbot.storm.increment('youtube-super-sticker'),
 		}
 
 		await common.rpc.eventserver.event('youtube-super-sticker', data, time)
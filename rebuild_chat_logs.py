@@ -3,9 +3,16 @@ import common
 common.FRAMEWORK_ONLY = True
 from common import postgres
 from lrrbot.chatlog import ChatLog
+import argparse
 import asyncio
 
+parser = argparse.ArgumentParser(description="Rebuild the HTML for the chat log")
+parser.add_argument('-d', '--days', type=int, default=7, help="Rebuild messages from this many days back (default: %(default)s)")
+parser.add_argument('-j', '--workers', type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+parser.add_argument('--restart', action='store_true', help="Start from scratch, rather than resuming an interrupted rebuild")
+args = parser.parse_args()
+
 chatlog = ChatLog(*postgres.get_engine_and_metadata())
-chatlog.rebuild_all()
+chatlog.rebuild_all(args.days, workers=args.workers, restart=args.restart)
 chatlog.stop_task()
 asyncio.run(chatlog.run_task())
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Compare the speed of the spam rule and URL matchers against the
+implementations they replaced, on the same messages as the equivalence tests.
+
+Run with: python3 tests/bench_matching.py
+"""
+import timeit
+
+# Sets up the config, as for the tests
+import conftest
+from common import spam, url
+import test_spam
+import test_url
+
+def per_message(func, messages, repeat=3):
+	best = min(timeit.repeat(lambda: [func(message) for message in messages], number=1, repeat=repeat))
+	return best / len(messages) * 1e6
+
+def bench_spam():
+	messages = test_spam.make_messages(2000)
+	print("Spam rules, microseconds per message:")
+	print("%8s %10s %10s" % ("rules", "old", "RuleSet"))
+	for count in [10, 100, 1000]:
+		rules = list(test_spam.RULES)
+		rules += [{'re': 'spamword%d' % i, 'message': "spam"} for i in range(count - len(rules))]
+		old = [spam.compile_rule(rule) for rule in rules]
+		def old_search(message):
+			for pattern in old:
+				if pattern.search(message):
+					return pattern
+		ruleset = spam.RuleSet(rules)
+		print("%8d %10.1f %10.1f" % (count, per_message(old_search, messages), per_message(ruleset.search, messages)))
+
+def bench_url():
+	messages = test_url.make_messages(2000)
+	print("URLs, with %d TLDs:" % len(test_url.TLDS))
+	old_compile = min(timeit.repeat(lambda: test_url.old_url_regex(test_url.TLDS), number=1, repeat=3))
+	new_compile = min(timeit.repeat(lambda: url.URLExtractor(test_url.TLDS), number=1, repeat=3))
+	old = test_url.old_url_regex(test_url.TLDS)
+	new = url.URLExtractor(test_url.TLDS)
+	print("%10s %10s %10s" % ("", "old", "extractor"))
+	print("%10s %10.1f %10.1f" % ("compile ms", old_compile * 1e3, new_compile * 1e3))
+	print("%10s %10.1f %10.1f" % ("us/message", per_message(lambda message: test_url.old_findall(old, message), messages), per_message(new.findall, messages)))
+
+if __name__ == '__main__':
+	bench_spam()
+	print()
+	bench_url()
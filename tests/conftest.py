@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Don't parse pytest's command line as the bot's, and run with a config that
+# has nothing but the defaults.
+import common
+common.FRAMEWORK_ONLY = True
+from common import commandline
+
+_conf = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+_conf.write("[lrrbot]\n[apipass]\n")
+_conf.close()
+commandline.argv.conf = _conf.name
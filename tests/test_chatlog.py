@@ -0,0 +1,41 @@
+import pytest
+import sqlalchemy.exc
+
+try:
+	# The lrrbot package connects to the database as it's imported
+	from lrrbot.chatlog import EmoteMatcher
+except sqlalchemy.exc.OperationalError:
+	pytest.skip("needs a database", allow_module_level=True)
+except SyntaxError:
+	pytest.skip("needs a newer Python", allow_module_level=True)
+
+def make_matcher(*names):
+	return EmoteMatcher({name: {"html": name + ":{0}"} for name in names})
+
+def find(matcher, message):
+	return [(message[start:end], html) for start, end, html in matcher.find_all(message)]
+
+def test_word_emotes():
+	matcher = make_matcher("Kappa", "LUL")
+	assert find(matcher, "Kappa LUL") == [("Kappa", "Kappa:{0}"), ("LUL", "LUL:{0}")]
+	# Only whole words
+	assert find(matcher, "KappaLUL xKappa Kappa_") == []
+
+def test_adjacent_emotes():
+	# Both emotes are linked, whichever order they are in the emote list. The
+	# old renderer only linked both for some orders.
+	for names in [("R)", "Kappa"), ("Kappa", "R)")]:
+		assert find(make_matcher(*names), "R)Kappa") == [("R)", "R):{0}"), ("Kappa", "Kappa:{0}")]
+	for names in [("LUL", "<3"), ("<3", "LUL")]:
+		assert find(make_matcher(*names), "LUL<3") == [("LUL", "LUL:{0}"), ("<3", "<3:{0}")]
+
+def test_non_word_emotes_need_word_boundaries():
+	matcher = make_matcher("<3", ":)")
+	# Boundaries are checked against the whole message, as with the old regexes
+	assert find(matcher, "<3 a<3b :)") == []
+	assert find(matcher, "a<3 b:)c") == [("<3", "<3:{0}"), (":)", ":):{0}")]
+
+def test_overlapping_emotes():
+	# The leftmost emote wins
+	matcher = make_matcher("x:Kappa", "Kappa")
+	assert find(matcher, "x:Kappa Kappa") == [("x:Kappa", "x:Kappa:{0}"), ("Kappa", "Kappa:{0}")]
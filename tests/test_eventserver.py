@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import datetime
+
+import pytz
+import sqlalchemy.exc
+
+import eventserver
+
+class FakeDatabase:
+	"""
+	Stands in for `EventWriter._write`, failing however the test asks it to.
+	"""
+	def __init__(self):
+		self.rows = collections.OrderedDict()
+		self.down = False
+		# Number of writes to fail before coming back up
+		self.outage = 0
+		self.rejected = set()
+		self.calls = 0
+
+	def write(self, batch):
+		self.calls += 1
+		if self.outage:
+			self.outage -= 1
+			raise sqlalchemy.exc.OperationalError("INSERT", {}, Exception("connection refused"))
+		if self.down:
+			raise sqlalchemy.exc.OperationalError("INSERT", {}, Exception("connection refused"))
+		for event, data, queued in batch:
+			if event.id in self.rejected:
+				raise sqlalchemy.exc.DataError("INSERT", {}, Exception("bad data"))
+		for event, data, queued in batch:
+			self.rows.setdefault(event.id, data)
+
+def make_writer(monkeypatch):
+	monkeypatch.setattr(eventserver, 'WRITE_RETRY_INTERVAL', 0.01)
+	writer = eventserver.EventWriter(None, None)
+	db = FakeDatabase()
+	writer._write = db.write
+	return writer, db
+
+def add_events(writer, ids):
+	now = datetime.datetime.now(tz=pytz.utc)
+	for id in ids:
+		writer.add(eventserver.make_event(id, "test", {"n": id}, now), {"n": id})
+
+async def wait_for_pending(writer):
+	while writer.pending:
+		await asyncio.sleep(0.01)
+
+def test_outage_keeps_retrying(monkeypatch):
+	async def test():
+		writer, db = make_writer(monkeypatch)
+		writer.start()
+		db.down = True
+		add_events(writer, range(1, 201))
+		# Well past the point where a capped retry would have given up
+		while db.calls < 20:
+			await asyncio.sleep(0.01)
+		assert not db.rows
+		assert len(writer.pending) == 200
+
+		db.down = False
+		await asyncio.wait_for(wait_for_pending(writer), 5)
+		await writer.close()
+		assert list(db.rows) == list(range(1, 201))
+		assert writer.stats()['dropped'] == 0
+		assert writer.stats()['written'] == 200
+	asyncio.run(test())
+
+def test_rejected_event_is_dropped_alone(monkeypatch):
+	async def test():
+		writer, db = make_writer(monkeypatch)
+		writer.start()
+		db.rejected = {5}
+		add_events(writer, range(1, 11))
+		await asyncio.wait_for(wait_for_pending(writer), 5)
+		await writer.close()
+		assert list(db.rows) == [1, 2, 3, 4, 6, 7, 8, 9, 10]
+		assert writer.stats()['dropped'] == 1
+	asyncio.run(test())
+
+def test_outage_while_writing_one_at_a_time(monkeypatch):
+	async def test():
+		writer, db = make_writer(monkeypatch)
+		real_write = db.write
+		outages = [2]
+		def write(batch):
+			try:
+				return real_write(batch)
+			except sqlalchemy.exc.DataError:
+				# The database goes away right after first rejecting the batch
+				if outages:
+					db.outage = outages.pop()
+				raise
+		writer._write = write
+		writer.start()
+		db.rejected = {3}
+		add_events(writer, range(1, 6))
+		await asyncio.wait_for(wait_for_pending(writer), 5)
+		await writer.close()
+		assert list(db.rows) == [1, 2, 4, 5]
+		assert writer.stats()['dropped'] == 1
+	asyncio.run(test())
+
+def test_close_writes_pending(monkeypatch):
+	async def test():
+		writer, db = make_writer(monkeypatch)
+		add_events(writer, range(1, 4))
+		# Writer was never started, eg the process is shutting down straight away
+		await writer.close()
+		assert list(db.rows) == [1, 2, 3]
+	asyncio.run(test())
+
+Row = collections.namedtuple('Row', ['id', 'event', 'data', 'time'])
+
+def make_server(written, buffered, page_size):
+	"""
+	A server with `written` events in the database, and `buffered` events in the
+	replay buffer, which only sees the newest events.
+	"""
+	server = eventserver.Server.__new__(eventserver.Server)
+	server.replay_buffer = eventserver.ReplayBuffer(size=len(buffered))
+	server.replay_buffer.complete_from = buffered[0].id if buffered else 1
+	server.replay_buffer.events.extend(buffered)
+	def get_events_page(last_event_id, start):
+		return [
+			Row(event.id, event.event, {"n": event.id}, event.time)
+			for event in written
+			if event.id > last_event_id and (start is None or event.time > start)
+		][:page_size]
+	server.get_events_page = get_events_page
+	return server
+
+def collect(server, last_event_id, interval):
+	async def test():
+		return [event.id async for page in server.get_last_events(last_event_id, interval) for event in page]
+	return asyncio.run(test())
+
+def make_events(ids, age=0):
+	time = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(seconds=age)
+	return [eventserver.make_event(id, "test", {"n": id}, time) for id in ids]
+
+def test_replay_includes_unwritten_events(monkeypatch):
+	monkeypatch.setattr(eventserver, 'REPLAY_PAGE_SIZE', 10)
+	events = make_events(range(1, 31))
+	# 24-30 have been delivered, but not written yet, so the last page is short
+	server = make_server(events[:23], events[20:], 10)
+	assert collect(server, 5, None) == list(range(6, 31))
+
+def test_interval_includes_unwritten_events(monkeypatch):
+	monkeypatch.setattr(eventserver, 'REPLAY_PAGE_SIZE', 10)
+	old = make_events(range(1, 11), age=7200)
+	new = make_events(range(11, 31))
+	server = make_server((old + new)[:25], (old + new)[5:], 10)
+	start = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(hours=1)
+	server.get_interval_start = lambda interval: start
+	assert collect(server, 0, "1 hour") == list(range(11, 31))
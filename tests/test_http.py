@@ -0,0 +1,221 @@
+import asyncio
+import time
+
+import aiohttp.test_utils
+import aiohttp.web
+
+from common import http
+
+class RateLimitedServer:
+	"""
+	Fake API that enforces a token bucket rate limit the way Twitch does, and
+	reports it in the response headers.
+	"""
+	def __init__(self, limit, period):
+		self.limit = limit
+		self.period = period
+		self.tokens = limit
+		self.updated = time.monotonic()
+		self.served = []
+		self.throttled = 0
+
+	async def handle(self, request):
+		now = time.monotonic()
+		self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+		self.updated = now
+		headers = {
+			'Ratelimit-Limit': str(self.limit),
+			'Ratelimit-Reset': str(time.time() + (self.limit - self.tokens) * self.period / self.limit),
+		}
+		if self.tokens < 1:
+			self.throttled += 1
+			headers['Ratelimit-Remaining'] = '0'
+			return aiohttp.web.Response(status=429, headers=headers)
+		self.tokens -= 1
+		headers['Ratelimit-Remaining'] = str(int(self.tokens))
+		self.served.append(request.query['name'])
+		return aiohttp.web.Response(text=request.query['name'], headers=headers)
+
+async def run_server(handler):
+	app = aiohttp.web.Application()
+	app.router.add_get('/', handler)
+	server = aiohttp.test_utils.TestServer(app)
+	await server.start_server()
+	return server
+
+def test_rate_limit_simulation():
+	async def test():
+		fake = RateLimitedServer(limit=5, period=0.5)
+		server = await run_server(fake.handle)
+		try:
+			limiter = http.RateLimiter(5, period=0.5)
+			url = str(server.make_url('/'))
+			low = [
+				http.request(url, {'name': 'low%d' % i}, ratelimit=limiter, priority=http.PRIORITY_LOW, timeout=0.5)
+				for i in range(10)
+			]
+			high = [
+				http.request(url, {'name': 'high%d' % i}, ratelimit=limiter, priority=http.PRIORITY_HIGH, timeout=0.5)
+				for i in range(5)
+			]
+			# Queue up the low priority requests first, then the moderation actions
+			low = [asyncio.ensure_future(request) for request in low]
+			await asyncio.sleep(0)
+			results = await asyncio.gather(*low, *high)
+		finally:
+			await http.close_http_request_sessions()
+			await server.close()
+
+		assert sorted(results) == sorted(['low%d' % i for i in range(10)] + ['high%d' % i for i in range(5)])
+		# Waiting for the limit doesn't count towards the timeout, so nothing failed
+		# even though the last requests waited longer than it for their turn.
+		assert fake.throttled == 0
+		# The first bucketful went out straight away, after that the high priority
+		# requests jumped the queue.
+		assert all(name.startswith('high') for name in fake.served[5:10])
+
+		stats = limiter.stats()
+		assert stats['requests'] == 15
+		assert stats['delays'][http.PRIORITY_LOW]['max'] > 0.5
+		assert stats['delays'][http.PRIORITY_HIGH]['max'] < stats['delays'][http.PRIORITY_LOW]['max']
+	asyncio.run(test())
+
+def test_retry_after():
+	async def test():
+		calls = []
+		async def handler(request):
+			calls.append(time.monotonic())
+			if len(calls) == 1:
+				return aiohttp.web.Response(status=429, headers={'Retry-After': '0.3'})
+			return aiohttp.web.Response(text="ok")
+		server = await run_server(handler)
+		try:
+			limiter = http.RateLimiter(100)
+			assert await http.request(str(server.make_url('/')), ratelimit=limiter) == "ok"
+		finally:
+			await http.close_http_request_sessions()
+			await server.close()
+		assert len(calls) == 2
+		assert calls[1] - calls[0] >= 0.3
+		assert limiter.stats()['throttled'] == 1
+	asyncio.run(test())
+
+class CachingServer:
+	"""
+	Fake API that serves one resource with the given caching headers, and
+	answers conditional requests.
+	"""
+	def __init__(self, **headers):
+		self.body = "version 1"
+		self.headers = headers
+		self.requests = []
+
+	async def handle(self, request):
+		self.requests.append(request)
+		etag = '"%d"' % hash(self.body)
+		headers = dict(self.headers)
+		headers.setdefault('ETag', etag)
+		if request.headers.get('If-None-Match') == etag:
+			return aiohttp.web.Response(status=304, headers=headers)
+		return aiohttp.web.Response(text=self.body, headers=headers)
+
+def fetch_twice(fake, cache, change=False, **kwargs):
+	"""
+	Request the resource twice, optionally changing it in between. Returns both
+	responses.
+	"""
+	async def test():
+		server = await run_server(fake.handle)
+		try:
+			url = str(server.make_url('/'))
+			first = await http.request(url, cache=cache, **kwargs)
+			if change:
+				fake.body = "version 2"
+			second = await http.request(url, cache=cache, **kwargs)
+		finally:
+			await http.close_http_request_sessions()
+			await server.close()
+		return first, second
+	return asyncio.run(test())
+
+def test_cache_revalidates_with_etag():
+	fake = CachingServer()
+	cache = http.ResponseCache()
+	assert fetch_twice(fake, cache) == ("version 1", "version 1")
+	assert len(fake.requests) == 2
+	assert 'If-None-Match' not in fake.requests[0].headers
+	assert fake.requests[1].headers['If-None-Match'] == '"%d"' % hash("version 1")
+	assert cache.stats()['revalidated'] == 1
+	assert cache.stats()['bytes_saved'] == len("version 1")
+
+def test_cache_gets_changed_body():
+	fake = CachingServer()
+	cache = http.ResponseCache()
+	assert fetch_twice(fake, cache, change=True) == ("version 1", "version 2")
+	assert cache.stats()['revalidated'] == 0
+
+def test_cache_revalidates_with_last_modified():
+	last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+	async def handle(request):
+		handle.requests.append(request)
+		if request.headers.get('If-Modified-Since') == last_modified:
+			return aiohttp.web.Response(status=304)
+		return aiohttp.web.Response(text="body", headers={'Last-Modified': last_modified})
+	handle.requests = []
+	fake = CachingServer()
+	fake.handle = handle
+	cache = http.ResponseCache()
+	assert fetch_twice(fake, cache) == ("body", "body")
+	assert len(handle.requests) == 2
+	assert cache.stats()['revalidated'] == 1
+
+def test_cache_serves_fresh_responses():
+	fake = CachingServer(**{'Cache-Control': 'max-age=60'})
+	cache = http.ResponseCache()
+	assert fetch_twice(fake, cache, change=True) == ("version 1", "version 1")
+	assert len(fake.requests) == 1
+	assert cache.stats()['hits'] == 1
+
+def test_cache_persists_to_disk(tmp_path):
+	async def test():
+		fake = CachingServer()
+		server = await run_server(fake.handle)
+		try:
+			url = str(server.make_url('/'))
+			headers = {'Authorization': 'Bearer secret'}
+			await http.request(url, headers=dict(headers), cache=http.ResponseCache(str(tmp_path)))
+			# As if the process had restarted
+			cache = http.ResponseCache(str(tmp_path))
+			assert await http.request(url, headers=dict(headers), cache=cache) == "version 1"
+		finally:
+			await http.close_http_request_sessions()
+			await server.close()
+		assert fake.requests[1].headers['If-None-Match'] == '"%d"' % hash("version 1")
+		assert cache.stats()['revalidated'] == 1
+		assert cache.stats()['misses'] == 0
+		# The credentials aren't written out
+		for filename in tmp_path.iterdir():
+			assert 'secret' not in filename.read_text()
+	asyncio.run(test())
+
+def test_cache_does_not_store():
+	for headers in [
+		{'Cache-Control': 'no-store'},
+		{'Cache-Control': 'private, max-age=60'},
+		{'Vary': 'Accept'},
+		{'Vary': '*'},
+	]:
+		fake = CachingServer(**headers)
+		cache = http.ResponseCache()
+		assert fetch_twice(fake, cache, change=True) == ("version 1", "version 2")
+		assert 'If-None-Match' not in fake.requests[1].headers, headers
+		assert cache.stats()['entries'] == 0, headers
+
+def test_cache_varies_on_authorization():
+	fake = CachingServer(**{'Cache-Control': 'max-age=60', 'Vary': 'Authorization, Accept-Encoding'})
+	cache = http.ResponseCache()
+	fetch_twice(fake, cache, headers={'Authorization': 'Bearer one'})
+	assert len(fake.requests) == 1
+	fake.body = "version 2"
+	assert fetch_twice(fake, cache, headers={'Authorization': 'Bearer two'}) == ("version 2", "version 2")
+	assert len(fake.requests) == 2
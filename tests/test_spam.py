@@ -0,0 +1,82 @@
+import random
+
+from common import spam
+
+# A mix of the kinds of rules that get used: plain text, regexes with and
+# without a usable literal, case-insensitive ones and confusables.
+RULES = [
+	{'re': '^I am a spambot!$', 'message': "claims to be a spambot"},
+	{'re': 'free followers', 'message': "follower spam", 'pattern_type': 'text'},
+	{'re': r'(?i)cheap viewers', 'message': "viewer spam"},
+	{'re': r'buy (\w+) at (\S+)\.com', 'message': "advertising %(1)s"},
+	{'re': r'\b(\w)\1{9,}\b', 'message': "repeated letters"},
+	{'re': 'primes', 'message': "confusable spam", 'pattern_type': 'confusables'},
+	{'re': r'bigfollows', 'message': "bigfollows"},
+	{'re': r'big(?:follows|views)', 'message': "bigfollows or views"},
+	{'re': r'(?:ab|cd)efg', 'message': "short literals"},
+	{'re': r'discord\.gg/\w+', 'message': "discord invite", 'type': 'spam'},
+]
+
+WORDS = [
+	"hello", "free", "followers", "cheap", "CHEAP", "Viewers", "buy", "stuff", "at",
+	"example.com", "I", "am", "a", "spambot!", "aaaaaaaaaaaa", "prіmes", "primes",
+	"bigfollows", "bigviews", "abefg", "cdefg", "discord.gg/abc", "Kappa", "LUL",
+	"the", "stream", "is", "great",
+]
+
+def old_search(rules, message):
+	"""The first rule to match, checking each rule in turn, as before RuleSet."""
+	for i, rule in enumerate(rules):
+		match = spam.compile_rule(rule).search(message)
+		if match is not None:
+			return i, match.span(), match.groups()
+	return None
+
+def new_search(ruleset, message):
+	result = ruleset.search(message)
+	if result is None:
+		return None
+	rule, match = result
+	return ruleset.rules.index(rule), match.span(), match.groups()
+
+def make_messages(count, seed=0):
+	rng = random.Random(seed)
+	messages = [
+		"I am a spambot!",
+		"get free followers and cheap viewers",
+		"buy followers at bigfollows.com",
+		"primes bigfollows",
+		"",
+	]
+	for i in range(count):
+		messages.append(" ".join(rng.choice(WORDS) for j in range(rng.randint(1, 12))))
+	return messages
+
+def test_same_as_checking_each_rule():
+	ruleset = spam.RuleSet(RULES)
+	for message in make_messages(5000):
+		assert new_search(ruleset, message) == old_search(RULES, message), message
+
+def test_most_rules_are_prefiltered():
+	ruleset = spam.RuleSet(RULES)
+	# Case-insensitive, confusables and too-short literals can't be
+	assert len(ruleset.literals) >= 5
+	assert len(ruleset.literals) + len(ruleset.standalone) == len(RULES)
+
+def test_without_the_regex_parser(monkeypatch):
+	monkeypatch.setattr(spam, 'sre_parse', None)
+	ruleset = spam.RuleSet(RULES)
+	assert ruleset.literals == []
+	assert ruleset.prefilter is None
+	for message in make_messages(500):
+		assert new_search(ruleset, message) == old_search(RULES, message), message
+
+def test_overlapping_literals():
+	rules = [
+		{'re': 'bcde', 'message': "first"},
+		{'re': 'abc', 'message': "second"},
+		{'re': 'abcdef', 'message': "third"},
+	]
+	ruleset = spam.RuleSet(rules)
+	for message in ["abcde", "xabcdefx", "abcdef", "bcd", "abc"]:
+		assert new_search(ruleset, message) == old_search(rules, message), message
@@ -0,0 +1,63 @@
+import random
+import re
+
+from common import url
+
+TLDS = set()
+for tld in ["com", "co", "net", "org", "io", "uk", "tv", "gg", "ly", "me", "museum", "info",
+		"app", "dev", "xn--p1ai", "xn--80asehdb", "xn--mgbaam7a8h", "community", "comcast", "moe"]:
+	TLDS.add(tld)
+	TLDS.add(tld.encode("ascii").decode("idna"))
+
+def old_url_regex(tlds):
+	"""The regex that URLExtractor replaced."""
+	parens = ["()", "[]", "{}", "<>", '""', "''"]
+	tlds = sorted(tlds, key=lambda e: len(e), reverse=True)
+	re_tld = "(?:" + "|".join(map(re.escape, tlds)) + ")"
+	re_hostname = r"(?:(?:(?:[\w-]+\.)+%s\.?)|(?:\d{,3}(?:\.\d{,3}){3})|(?:\[[0-9a-fA-F:.]+\]))" % re_tld
+	re_url = r"((?:https?://)?%s(?::\d+)?(?:/[\x5E\s\u200b]*)?)" % re_hostname
+	re_url = re_url + "|" + "|".join(map(lambda parens: re.escape(parens[0]) + re_url + re.escape(parens[1]), parens))
+	return re.compile(re_url, re.IGNORECASE)
+
+def old_findall(re_url, message):
+	urls = []
+	for match in re_url.finditer(message):
+		for found in match.groups():
+			if found is not None:
+				urls.append(found)
+				break
+	return urls
+
+PIECES = [
+	"http://", "https://", "HTTPS://", "www.", "example", "Example", "sub-domain", "a_b", "123",
+	".", ".", ".", "com", "co", "COM", "comcast", "community", "net", "uk", "moe", "рф",
+	"xn--p1ai", "онлайн", "ﻣﺼﺮ", "museum", "1.2.3.4", "256.1.1.1", "[::1]", "[2001:db8::1]",
+	":8080", ":", "/", "/path", "/a?b=c&d", "#frag", " ", " ", " ", "\u200b", "^", "(", ")", "[", "]",
+	"{", "}", "<", ">", '"', "'", ",", "!", "Kappa", "check", "this", "out",
+]
+
+def make_messages(count, seed=0):
+	rng = random.Random(seed)
+	messages = [
+		"check out example.com/path and https://www.example.co.uk:8080/a?b=c",
+		"(example.com) [example.net] {example.org} <example.io> \"example.tv\" 'example.gg'",
+		"1.2.3.4 and [::1]:80/x",
+		"нет ссылок здесь",
+		"пример.рф and example.comcast.net",
+		"no urls here",
+	]
+	for i in range(count):
+		messages.append("".join(rng.choice(PIECES) for j in range(rng.randint(1, 20))))
+	return messages
+
+def test_same_as_old_regex():
+	old = old_url_regex(TLDS)
+	new = url.URLExtractor(TLDS)
+	for message in make_messages(20000):
+		assert new.findall(message) == old_findall(old, message), message
+
+def test_longest_tld_wins():
+	extractor = url.URLExtractor(TLDS)
+	assert extractor.findall("see example.com, not example.co") == ["example.com", "example.co"]
+	assert extractor.findall("example.comcast.net") == ["example.comcast.net"]
+	assert extractor.findall("example.community") == ["example.community"]
@@ -15,6 +15,7 @@ from common.config import config
 from common.postgres import escape_like
 from www import login
 from www import server
+import www.help
 
 log = logging.getLogger("api_v2")
 
@@ -111,6 +112,14 @@ async def events():
 	else:
 		return flask.jsonify(message="Server not set up correctly."), 500
 
+# Implemented in `eventserver.py`
+@blueprint.route("/events/history")
+async def events_history():
+	if server.app.debug:
+		return flask.redirect("http://localhost:8080/api/v2/events/history?" + urllib.parse.urlencode(list(flask.request.args.items(multi=True))))
+	else:
+		return flask.jsonify(message="Server not set up correctly."), 500
+
 CLIP_URL = "https://clips.twitch.tv/{}"
 @blueprint.route("/clips")
 @require_mod
@@ -245,7 +254,10 @@ async def get_header():
 
 @blueprint.route('/commands')
 async def get_commands():
-	return flask.jsonify(await common.rpc.bot.get_commands())
+	version, commands = await www.help.get_commands()
+	response = flask.jsonify(commands)
+	response.set_etag(version)
+	return response.make_conditional(flask.request)
 
 @blueprint.route('/quote', methods=["GET", "POST"])
 @server.csrf.exempt
@@ -14,7 +14,23 @@ SECTIONS = OrderedDict((
 ))
 DEFAULT_SECTION = "misc"
 
+# (version, commands) as last fetched from the bot
+cached_commands = (None, None)
+
+async def get_commands():
+	"""
+	Get the bot's command list, as a tuple of a version string and the list.
+	The list is only sent over again if it's changed since it was last fetched.
+	"""
+	global cached_commands
+	version, commands = cached_commands
+	index = await common.rpc.bot.get_commands_if_changed(version)
+	if index['commands'] is not None:
+		cached_commands = version, commands = index['version'], index['commands']
+	return version, commands
+
 def command_format(cmd):
+	cmd = dict(cmd)
 	cmd['raw-aliases'] = cmd["aliases"]
 	cmd["aliases"] = "<code>" + "</code> or <code>".join(map(html.escape, cmd["aliases"])) + "</code>"
 	cmd["description"] = cmd["description"].split("\n\n")
@@ -23,7 +39,8 @@ def command_format(cmd):
 @blueprint.route('/help')
 @login.with_session
 async def help(session):
-	commandlist = sorted(map(command_format, await common.rpc.bot.get_commands()), key=lambda c: c["raw-aliases"])
+	version, commands = await get_commands()
+	commandlist = sorted(map(command_format, commands), key=lambda c: c["raw-aliases"])
 	commands = {}
 	for command in commandlist:
 		section = command['section']
@@ -13,7 +13,7 @@ import www.utils
 from common.account_providers import ACCOUNT_PROVIDER_TWITCH, ACCOUNT_PROVIDER_YOUTUBE
 from www import server
 from common.config import config, from_apipass
-from common import utils, youtube
+from common import utils, youtube, twitch
 from common import http
 from common import googlecalendar
 import common.rpc
@@ -392,6 +392,7 @@ async def login(return_to=None):
 				if user_id is None:
 					user_id = conn.execute(users.insert().returning(users.c.id)).scalar_one()
 					conn.execute(accounts.update().where(accounts.c.id == account_id), {'user_id': user_id})
+				twitch.invalidate_user(conn, account['provider_user_id'])
 				conn.commit()
 
 			# Store the user ID into the session
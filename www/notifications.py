@@ -40,26 +40,45 @@ VISIBLE_EVENTS = {
 	'youtube-super-sticker',
 }
 
+# Number of events to read from the database at a time
+PAGE_SIZE = 100
+
 def get_events():
+	"""
+	Get the ID of the latest event, and the visible events from the last two days,
+	newest first.
+
+	The events are read from the database a page at a time as they're iterated
+	over, so they can be streamed out without holding them all in memory.
+	"""
+	events = server.db.metadata.tables['events']
+	with server.db.engine.connect() as conn:
+		last_event_id = conn.execute(sqlalchemy.select(sqlalchemy.func.max(events.c.id))).scalar() or 0
+	return last_event_id, iter_events(last_event_id)
+
+def iter_events(last_event_id):
 	events = server.db.metadata.tables['events']
-	recent_events = []
 	query = sqlalchemy.select(events.c.id, events.c.event, events.c.data, events.c.time, sqlalchemy.func.current_timestamp() - events.c.time) \
 		.where(events.c.time > sqlalchemy.func.current_timestamp() - datetime.timedelta(days=2)) \
 		.where(events.c.event.in_(VISIBLE_EVENTS)) \
-		.order_by(events.c.id.desc())
-	with server.db.engine.connect() as conn:
-		for id, event, data, time, duration in conn.execute(query):
-			if not data.get('ismulti') and not (event == 'youtube-membership-gift' and data['count'] == 1):
-				data['time'] = time
-				recent_events.append({
-					'id': id,
-					'event': event,
-					'data': data,
-					'duration': common.time.nice_duration(duration, 2)
-				})
-		last_event_id = conn.execute(sqlalchemy.select(sqlalchemy.func.max(events.c.id))).first()
-		last_event_id = last_event_id[0] if last_event_id is not None else 0
-	return last_event_id, recent_events
+		.where(~events.c.data.contains({'ismulti': True})) \
+		.where(~((events.c.event == 'youtube-membership-gift') & events.c.data.contains({'count': 1}))) \
+		.order_by(events.c.id.desc()) \
+		.limit(PAGE_SIZE)
+	while True:
+		with server.db.engine.connect() as conn:
+			rows = conn.execute(query.where(events.c.id <= last_event_id)).all()
+		for id, event, data, time, duration in rows:
+			data['time'] = time
+			yield {
+				'id': id,
+				'event': event,
+				'data': data,
+				'duration': common.time.nice_duration(duration, 2)
+			}
+		if len(rows) < PAGE_SIZE:
+			return
+		last_event_id = rows[-1].id - 1
 
 def get_milestones():
 	now = datetime.datetime.now(config['timezone'])
@@ -81,7 +100,7 @@ def notifications(session):
 			.where(accounts.c.provider_user_id == config['patreon_creator_user_id'])
 		).scalar_one_or_none()
 
-	return flask.render_template('notifications.html', events=events, last_event_id=last_event_id, session=session, patreon_creator_name=name, milestones=get_milestones())
+	return flask.Response(flask.stream_template('notifications.html', events=events, last_event_id=last_event_id, session=session, patreon_creator_name=name, milestones=get_milestones()))
 
 # Compatibility shim
 @blueprint.route('/notifications/events')
@@ -62,28 +62,23 @@ async def submit(session):
 	return flask.json.jsonify(success='OK')
 
 async def do_check(line, rules):
-	for rule in rules:
-		matches = rule['re'].search(line)
-		if matches:
-			groups = {str(i+1):v for i,v in enumerate(matches.groups())}
-			return rule['message'] % groups
+	result = rules.search(line)
+	if result is not None:
+		rule, matches = result
+		groups = {str(i+1):v for i,v in enumerate(matches.groups())}
+		return rule['message'] % groups
 	return None
 
 async def do_check_links(message, rules):
-	re_url = await common.url.url_regex()
-	urls = []
-	for match in re_url.finditer(message):
-		for url in match.groups():
-			if url is not None:
-				urls.append(url)
-				break
+	url_extractor = await common.url.url_extractor()
+	urls = url_extractor.findall(message)
 	canonical_urls = await asyncio.gather(*map(common.url.canonical_url, urls))
 	for url_chain in canonical_urls:
 		for url in url_chain:
-			for rule in rules:
-				match = rule["re"].search(url)
-				if match is not None:
-					return rule["message"] % {str(i+1): v for i, v in enumerate(match.groups())}
+			result = rules.search(url)
+			if result is not None:
+				rule, match = result
+				return rule["message"] % {str(i+1): v for i, v in enumerate(match.groups())}
 
 @blueprint.route('/redirects')
 @login.require_mod
@@ -103,8 +98,7 @@ async def test(session):
 	if error:
 		return flask.json.jsonify(error=error)
 
-	for rule in rules:
-		rule['re'] = common.spam.compile_rule(rule)
+	rules = common.spam.RuleSet(rules)
 
 	result = []
 
@@ -140,8 +134,7 @@ async def test(session):
 @login.require_mod
 async def find(session):
 	rules = await common.rpc.bot.get_data('spam_rules')
-	for rule in rules:
-		rule['re'] = common.spam.compile_rule(rule)
+	rules = common.spam.RuleSet(rules)
 
 	starttime = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=14)
 	log = server.db.metadata.tables["log"]